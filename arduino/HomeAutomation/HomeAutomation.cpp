@@ -8,6 +8,10 @@
 #define MESSAGE_PUB_CHANNEL 2
 #define MESSAGE_SUB_CHANNEL 3
 #define MESSAGE_PUB 4
+// gateways with several radios take registrations on this channel and tell clients the channel to move to
+#define REGISTRATION_CHANNEL 0x4c
+// last byte of the registration payload, tells the gateway the client moves to the channel in the ack
+#define REGISTER_FLAG_SWITCHES_CHANNEL 1
 
 #ifdef HOMEAUTOMATION_DEBUG
 void printCharArray(char *label, char *data, int length) {
@@ -36,7 +40,7 @@ void HomeAutomation::begin() {
 #endif
     this->radio->begin();
     this->radio->setRetries(10, 10);
-    this->radio->setChannel(0x4c);
+    this->radio->setChannel(REGISTRATION_CHANNEL);
     this->radio->setDataRate(RF24_250KBPS);
     this->radio->setPALevel(RF24_PA_HIGH);
     this->radio->setCRCLength(RF24_CRC_16);
@@ -56,8 +60,10 @@ bool HomeAutomation::registerWithGateway() {
     char payload[8] = "";
     bool registerSuccess = false;
     memcpy(&payload[0], &listenAddress, 8);
+    payload[7] = REGISTER_FLAG_SWITCHES_CHANNEL;
 
     this->counter = random(0, 65535);
+    this->radio->setChannel(REGISTRATION_CHANNEL);
 
 #ifdef HOMEAUTOMATION_DEBUG
         Serial.print("Registering;\n");
@@ -67,6 +73,9 @@ bool HomeAutomation::registerWithGateway() {
         if (this->waitForPacket(MESSAGE_REGISTER_ACK, received, 500)) {
             this->clientId = (uint8_t) received[4];
             memcpy(&(this->serverId), &received[5], 8);
+            if ((uint8_t) received[3] > 9) {
+                this->radio->setChannel((uint8_t) received[13]);
+            }
 #ifdef HOMEAUTOMATION_DEBUG
                 Serial.print("Register Success; ClientId: ");
                 Serial.print(clientId);
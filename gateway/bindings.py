@@ -0,0 +1,123 @@
+"""Bind the routing keys the clients subscribed to to the queue of the gateway"""
+
+import asyncio
+import logging
+from settings import BINDING_WINDOW, UNBIND_GRACE_PERIOD
+
+LOGGER = logging.getLogger(__name__)
+
+
+class BindingManager():
+    """Reference counts routing keys and keeps the queue bound to the keys somebody is interested in
+
+    A key is bound when its count goes from 0 to 1 and unbound after a grace period when it drops back to 0, so
+    clients registering again do not cause any broker round trips. Bind requests are collected for a short window
+    and then issued concurrently. While the bus is not connected only the references are taken, the keys are bound
+    by rebind once it is.
+    """
+
+    def __init__(self, window=BINDING_WINDOW, grace_period=UNBIND_GRACE_PERIOD):
+        self.loop = asyncio.get_event_loop()
+        self.bus = None
+        self.window = window
+        self.grace_period = grace_period
+        self.refcounts = {}
+        self.bound = set()
+        self.pending_binds = {}
+        self.pending_unbinds = {}
+        self.flush_handle = None
+
+    def attach(self, bus):
+        """Set the message bus the routing keys are bound on"""
+        self.bus = bus
+
+    @property
+    def connected(self):
+        """If the bus is connected"""
+        return self.bus is not None and self.bus.connected
+
+    @asyncio.coroutine
+    def acquire(self, routing_key):
+        """Take a reference on a routing key, returns when the key is bound"""
+        self.refcounts[routing_key] = self.refcounts.get(routing_key, 0) + 1
+        unbind_handle = self.pending_unbinds.pop(routing_key, None)
+        if unbind_handle:
+            unbind_handle.cancel()
+        if routing_key in self.bound or not self.connected:
+            return
+        future = self.pending_binds.get(routing_key)
+        if future is None:
+            future = self.pending_binds[routing_key] = asyncio.Future()
+            if self.flush_handle is None:
+                self.flush_handle = self.loop.call_later(self.window, self.flush)
+        yield from asyncio.shield(future)
+
+    def release(self, routing_key):
+        """Drop a reference on a routing key, the key is unbound after the grace period if nobody takes it again"""
+        if routing_key not in self.refcounts:
+            return
+        self.refcounts[routing_key] -= 1
+        if self.refcounts[routing_key] > 0:
+            return
+        del self.refcounts[routing_key]
+        self.pending_unbinds[routing_key] = self.loop.call_later(self.grace_period, self.start_unbind, routing_key)
+
+    def start_unbind(self, routing_key):
+        """Called when the grace period of a routing key is over"""
+        asyncio.async(self.unbind(routing_key))
+
+    def flush(self):
+        """Bind all keys requested during the window"""
+        self.flush_handle = None
+        pending, self.pending_binds = self.pending_binds, {}
+        if not self.connected:
+            # the bus went away during the window, rebind takes care of the keys
+            for future in pending.values():
+                future.set_result(None)
+            return
+        asyncio.async(self.bind(pending))
+
+    @asyncio.coroutine
+    def bind(self, pending):
+        """Bind a number of routing keys concurrently and resolve the futures waiting for them"""
+        routing_keys = list(pending)
+        results = yield from asyncio.gather(
+            *[self.bus.bind(routing_key) for routing_key in routing_keys],
+            return_exceptions=True
+        )
+        for routing_key, result in zip(routing_keys, results):
+            future = pending[routing_key]
+            if isinstance(result, Exception):
+                LOGGER.error('Binding routing key {0} failed: {1!r}'.format(routing_key, result))
+                future.set_exception(result)
+                continue
+            self.bound.add(routing_key)
+            future.set_result(None)
+            if routing_key not in self.refcounts and routing_key not in self.pending_unbinds:
+                # everybody left while the bind was in flight
+                self.pending_unbinds[routing_key] = self.loop.call_later(self.grace_period, self.start_unbind,
+                                                                         routing_key)
+
+    @asyncio.coroutine
+    def rebind(self):
+        """Bind the routing keys again after the bus reconnected, the bindings went away with the old connection"""
+        routing_keys = (set(self.refcounts) | self.bound) - set(self.pending_binds)
+        self.bound = set()
+        pending = {routing_key: asyncio.Future() for routing_key in routing_keys}
+        yield from self.bind(pending)
+        for future in pending.values():
+            future.exception()  # failures were logged, nobody waits for these
+
+    @asyncio.coroutine
+    def unbind(self, routing_key):
+        """Unbind a routing key nobody is interested in anymore"""
+        self.pending_unbinds.pop(routing_key, None)
+        if routing_key in self.refcounts:
+            return
+        if routing_key not in self.bound:
+            return
+        self.bound.discard(routing_key)
+        try:
+            yield from self.bus.unbind(routing_key)
+        except Exception as error: # pylint: disable=broad-except
+            LOGGER.error('Unbinding routing key {0} failed: {1!r}'.format(routing_key, error))
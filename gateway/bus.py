@@ -0,0 +1,222 @@
+"""Message buses the router talks to, a RabbitMQ one and one within the process"""
+
+import asyncio
+import logging
+import asynqp
+from settings import MESSAGE_BUS, RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USERNAME, RABBITMQ_PASSWORD, \
+    RABBITMQ_VIRTUAL_HOST
+from serialization import decode
+from topics import TopicTrie
+
+EXCHANGE = 'gateway.exchange'
+QUEUE = 'gateway.queue'
+
+LOGGER = logging.getLogger(__name__)
+
+
+class MessageBus():
+    """Interface of a topic exchange with a single queue for the gateway
+
+    Messages passed to the consumer have a routing_key, a body and a content_type. When a connected bus loses its
+    connection it calls on_disconnect.
+    """
+
+    def __init__(self):
+        self.connected = False
+        self.on_disconnect = lambda: None
+
+    def disconnected(self):
+        """Mark the bus as disconnected and tell the owner"""
+        if self.connected:
+            self.connected = False
+            self.on_disconnect()
+
+    def check_connected(self):
+        """Raise if the bus is not connected"""
+        if not self.connected:
+            raise ConnectionError('Message bus is not connected')
+
+    @asyncio.coroutine
+    def connect(self):
+        """Connect to the bus"""
+        raise NotImplementedError()
+
+    def publish(self, routing_key, body, content_type):
+        """Publish a message"""
+        raise NotImplementedError()
+
+    def write_buffer_size(self):
+        """Bytes of published messages that were not written to the broker yet"""
+        return 0
+
+    @asyncio.coroutine
+    def consume(self, handler):
+        """Call the handler with every message routed to the queue"""
+        raise NotImplementedError()
+
+    @asyncio.coroutine
+    def bind(self, routing_key):
+        """Route messages with a routing key (or topic pattern) to the queue"""
+        raise NotImplementedError()
+
+    @asyncio.coroutine
+    def unbind(self, routing_key):
+        """Stop routing messages with a routing key (or topic pattern) to the queue"""
+        raise NotImplementedError()
+
+
+def log_returned_message(message):
+    """Log when message has no handler in message queue"""
+    LOGGER.info("Nobody cared for {0} {1}".format(message.routing_key, decode(message.body, message.content_type)))
+
+
+class AmqpBus(MessageBus):
+    """Topic exchange and queue on a RabbitMQ server"""
+
+    def __init__(self):
+        super().__init__()
+        self.connection = None
+        self.channel = None
+        self.exchange = None
+        self.queue = None
+        self.consumer = None
+        self.bindings = {}
+
+    @asyncio.coroutine
+    def connect(self):
+        """Connects to the amqp exchange and queue"""
+        self.connection = yield from asynqp.connect(
+            RABBITMQ_HOST,
+            RABBITMQ_PORT,
+            RABBITMQ_USERNAME,
+            RABBITMQ_PASSWORD,
+            RABBITMQ_VIRTUAL_HOST
+        )
+        self.channel = yield from self.connection.open_channel()
+        self.channel.set_return_handler(log_returned_message)
+        self.exchange = yield from self.channel.declare_exchange(EXCHANGE, 'topic')
+        self.queue = yield from self.channel.declare_queue(QUEUE, auto_delete=True)
+        self.bindings = {}
+        self.connected = True
+        asyncio.get_event_loop().set_exception_handler(self.handle_exception)
+
+    def handle_exception(self, loop, context):
+        """Exception handler of the event loop, asynqp reports a lost connection through it"""
+        if isinstance(context.get('exception'), asynqp.exceptions.ConnectionLostError):
+            LOGGER.warning('Lost the connection to RabbitMQ')
+            self.disconnected()
+        else:
+            loop.default_exception_handler(context)
+
+    def publish(self, routing_key, body, content_type):
+        """Publish a message to the exchange"""
+        self.check_connected()
+        self.exchange.publish(asynqp.Message(body, content_type=content_type), routing_key)
+
+    def write_buffer_size(self):
+        """Bytes waiting in the write buffer of the connection"""
+        if not self.connected:
+            return 0
+        return self.connection.transport.get_write_buffer_size()
+
+    @asyncio.coroutine
+    def consume(self, handler):
+        """Consume the messages of the queue"""
+        self.consumer = yield from self.queue.consume(handler)
+
+    @asyncio.coroutine
+    def bind(self, routing_key):
+        """Bind the queue to the exchange"""
+        self.check_connected()
+        self.bindings[routing_key] = yield from self.queue.bind(self.exchange, routing_key)
+
+    @asyncio.coroutine
+    def unbind(self, routing_key):
+        """Unbind the queue from the exchange"""
+        binding = self.bindings.pop(routing_key, None)
+        if binding is not None:
+            yield from binding.unbind()
+
+
+class LocalMessage():
+    """A message on the local bus"""
+    __slots__ = ('routing_key', 'body', 'content_type')
+
+    def __init__(self, routing_key, body, content_type):
+        self.routing_key = routing_key
+        self.body = body
+        self.content_type = content_type
+
+
+class LocalExchange():
+    """Topic exchange within the process, every local bus attached to it has its own queue"""
+
+    def __init__(self):
+        self.queues = []
+        self.unrouted = 0
+
+    def publish(self, message):
+        """Deliver a message to the handlers of all queues bound to its routing key"""
+        delivered = False
+        for queue in self.queues:
+            if queue.handler and queue.topics.match(message.routing_key):
+                queue.loop.call_soon(queue.handler, message)
+                delivered = True
+        if not delivered:
+            self.unrouted += 1
+
+
+class LocalBus(MessageBus):
+    """Message bus within the process, for single node setups and for running the router without a broker"""
+
+    def __init__(self, exchange=None):
+        super().__init__()
+        self.loop = asyncio.get_event_loop()
+        self.exchange = exchange or LocalExchange()
+        self.topics = TopicTrie()
+        self.handler = None
+
+    @asyncio.coroutine
+    def connect(self):
+        """Attach the queue to the exchange"""
+        if self not in self.exchange.queues:
+            self.exchange.queues.append(self)
+        self.connected = True
+
+    def disconnect(self):
+        """Detach the queue from the exchange, like a lost connection its bindings are gone"""
+        if self in self.exchange.queues:
+            self.exchange.queues.remove(self)
+        self.topics = TopicTrie()
+        self.disconnected()
+
+    def publish(self, routing_key, body, content_type):
+        """Publish a message to the exchange"""
+        self.check_connected()
+        self.exchange.publish(LocalMessage(routing_key, body, content_type))
+
+    @asyncio.coroutine
+    def consume(self, handler):
+        """Consume the messages of the queue"""
+        self.handler = handler
+
+    @asyncio.coroutine
+    def bind(self, routing_key):
+        """Bind the queue to the exchange"""
+        self.topics.add(routing_key)
+
+    @asyncio.coroutine
+    def unbind(self, routing_key):
+        """Unbind the queue from the exchange"""
+        self.topics.remove(routing_key)
+
+
+BUSES = {
+    'amqp': AmqpBus,
+    'local': LocalBus
+}
+
+
+def create_bus(name=MESSAGE_BUS):
+    """Create the configured message bus"""
+    return BUSES[name]()
@@ -0,0 +1,191 @@
+"""Registry of the clients that registered with the gateway"""
+
+from time import monotonic
+from settings import REPLAY_WINDOW_SIZE, REPLAY_MAX_JUMP, CLIENT_LOAD_HALF_LIFE
+
+MAX_CLIENT_ID = 254
+ALL_CLIENT_IDS = ((1 << (MAX_CLIENT_ID + 1)) - 1) & ~1
+COUNTER_MASK = 0xFFFF
+COUNTER_HALF_RANGE = 0x8000
+# a client id of the gateway is the index of the radio followed by the byte the client uses on air
+RADIO_SHIFT = 8
+LOCAL_ID_MASK = (1 << RADIO_SHIFT) - 1
+
+
+def global_client_id(radio, on_air_id):
+    """Client id within the gateway of a client id on a radio"""
+    return (radio << RADIO_SHIFT) | on_air_id
+
+
+def radio_index(client_id):
+    """Index of the radio a client was assigned to"""
+    return client_id >> RADIO_SHIFT
+
+
+def local_client_id(client_id):
+    """Client id the client uses on air"""
+    return client_id & LOCAL_ID_MASK
+
+
+class ReplayWindow():
+    """Sliding window over the uint16_t packet counters of a client (like the IPsec anti-replay window)
+
+    Bit n of the bitmap is set if the counter last - n has been accepted. Counters behind the last one are accepted
+    once as long as they are inside the window, counters ahead of it up to max_jump move the window forward.
+    """
+    __slots__ = ('size', 'max_jump', 'last', 'bitmap', 'rejected', 'duplicates', 'resynced')
+
+    def __init__(self, last, size=REPLAY_WINDOW_SIZE, max_jump=REPLAY_MAX_JUMP):
+        self.size = size
+        self.max_jump = max_jump
+        self.last = last & COUNTER_MASK
+        self.bitmap = 1
+        self.rejected = 0
+        self.duplicates = 0
+        self.resynced = 0
+
+    def check(self, counter):
+        """Check a received counter and mark it as seen, returns if the packet should be accepted"""
+        ahead = (counter - self.last) & COUNTER_MASK
+        if ahead == 0:
+            self.duplicates += 1
+            return False
+        if ahead < COUNTER_HALF_RANGE:
+            if ahead > self.max_jump:
+                self.rejected += 1
+                return False
+            if ahead >= self.size:
+                self.resynced += 1
+                self.bitmap = 1
+            else:
+                self.bitmap = ((self.bitmap << ahead) | 1) & ((1 << self.size) - 1)
+            self.last = counter
+            return True
+
+        behind = COUNTER_MASK + 1 - ahead
+        if behind >= self.size:
+            self.rejected += 1
+            return False
+        if self.bitmap & (1 << behind):
+            self.duplicates += 1
+            return False
+        self.bitmap |= 1 << behind
+        return True
+
+
+class Client():
+    """State the gateway keeps for a single registered client
+
+    The radio is the one the client was last heard on, packets to the client are sent from there. The load counts
+    the packets exchanged with the client, older ones count less the longer ago they were.
+    """
+    __slots__ = ('client_id', 'address', 'replay_window', 'server_counter', 'radio', 'load', 'load_updated')
+
+    def __init__(self, client_id, address, client_counter, server_counter):
+        self.client_id = client_id
+        self.address = address
+        self.replay_window = ReplayWindow(client_counter)
+        self.server_counter = server_counter
+        self.radio = radio_index(client_id)
+        self.load = 0.0
+        self.load_updated = 0.0
+
+    @property
+    def client_counter(self):
+        """The highest counter received from the client"""
+        return self.replay_window.last
+
+    def load_at(self, now):
+        """The load of the client at a time"""
+        return self.load * 0.5 ** ((now - self.load_updated) / CLIENT_LOAD_HALF_LIFE)
+
+    def count_packet(self, now):
+        """Add a packet to the load"""
+        self.load = self.load_at(now) + 1
+        self.load_updated = now
+
+    def __repr__(self):
+        return 'Client({0}, {1}, {2}, {3})'.format(self.client_id, self.address, self.client_counter,
+                                                   self.server_counter)
+
+
+class ClientRegistry():
+    """Clients of all radios indexed by client id and address, free client ids are tracked in a bitmap per radio
+
+    New clients go to the radio with the lowest load, they start with the average load of the clients so a burst of
+    registrations is spread over the radios as well. Clients that can not switch channels stay on the first radio,
+    which is the one on the registration channel.
+    """
+
+    def __init__(self, radios=1):
+        self.by_id = {}
+        self.by_address = {}
+        self.free_ids = [ALL_CLIENT_IDS] * radios
+
+    def __contains__(self, client_id):
+        return client_id in self.by_id
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        # a snapshot, the metrics iterate on the event loop while a radio worker thread registers clients
+        return iter(list(self.by_id.values()))
+
+    def get(self, client_id):
+        """Get the client for a client id, None if it is not registered"""
+        return self.by_id.get(client_id)
+
+    def get_by_address(self, address):
+        """Get the client for an address, None if it is not registered"""
+        return self.by_address.get(tuple(address))
+
+    def loads(self, now):
+        """Load and number of clients of every radio"""
+        loads = [[0.0, 0] for dummy in self.free_ids]
+        for client in self.by_id.values():
+            radio_load = loads[radio_index(client.client_id)]
+            radio_load[0] += client.load_at(now)
+            radio_load[1] += 1
+        return loads
+
+    def get_client_id(self, address, switches_channel=False):
+        """Get the client id of an already registered address or the lowest free one on the radio with the lowest
+        load, False if all are taken"""
+        client = self.by_address.get(tuple(address))
+        if client and (switches_channel or radio_index(client.client_id) == 0):
+            return client.client_id
+        radios = [
+            radio for radio, free_ids in enumerate(self.free_ids) if free_ids and (switches_channel or radio == 0)
+        ]
+        if not radios:
+            return False
+        if len(radios) > 1:
+            loads = self.loads(monotonic())
+            radios.sort(key=lambda radio: loads[radio])
+        free_ids = self.free_ids[radios[0]]
+        return global_client_id(radios[0], (free_ids & -free_ids).bit_length() - 1)
+
+    def register(self, client_id, address, client_counter, server_counter):
+        """Register a client, replacing everything previously registered under its client id or address"""
+        self.remove(client_id)
+        existing = self.by_address.get(tuple(address))
+        if existing:
+            self.remove(existing.client_id)
+
+        client = Client(client_id, address, client_counter, server_counter)
+        if len(self.free_ids) > 1 and self.by_id:
+            client.load_updated = monotonic()
+            client.load = sum(other.load_at(client.load_updated) for other in self.by_id.values()) / len(self.by_id)
+        self.by_id[client_id] = client
+        self.by_address[tuple(address)] = client
+        self.free_ids[radio_index(client_id)] &= ~(1 << local_client_id(client_id))
+        return client
+
+    def remove(self, client_id):
+        """Remove a client from the registry, returns the removed client"""
+        client = self.by_id.pop(client_id, None)
+        if client:
+            self.by_address.pop(tuple(client.address), None)
+            self.free_ids[radio_index(client_id)] |= (1 << local_client_id(client_id)) & ALL_CLIENT_IDS
+        return client
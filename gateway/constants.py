@@ -10,3 +10,14 @@ class PacketTypes(IntEnum):
     PUB_CHANNEL = 2
     SUB_CHANNEL = 3
     PUB = 4
+
+
+class RegisterFlags(IntEnum):
+    """Bits of the last byte of the registration payload, features the firmware of a client supports"""
+    SWITCHES_CHANNEL = 1
+
+
+class Priority(IntEnum):
+    """Transmit priorities of packets sent to the clients, lower values are sent first"""
+    HIGH = 0
+    NORMAL = 1
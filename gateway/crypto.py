@@ -1,39 +1,91 @@
 """Crypto functions used in the gateway"""
 
+from functools import lru_cache
 from Crypto.Cipher import AES
 from settings import PRESHARED_KEY
 
-def decrypt_packet(packet):
-    """Decrypt packet for transmission over rf24"""
-    cipher = AES.new(PRESHARED_KEY, AES.MODE_ECB)
+BLOCK_SIZE = 16
+PACKET_SIZE = 2 * BLOCK_SIZE
 
-    encrypted_part1 = bytes(packet[0:16])
-    encrypted_part2 = bytes(packet[16:32])
 
-    intermediate_part1 = cipher.decrypt(encrypted_part1)
-    decrypted_part1 = bytes([e ^ i for e, i in zip(encrypted_part2, intermediate_part1)])
-    decrypted_part2 = cipher.decrypt(encrypted_part2)
+def xor_block(first, second):
+    """XOR two 16 byte blocks"""
+    return (int.from_bytes(first, 'little') ^ int.from_bytes(second, 'little')).to_bytes(BLOCK_SIZE, 'little')
 
-    return decrypted_part1 + decrypted_part2
 
+class CryptoEngine():
+    """Keeps the AES cipher context for a key and en-/decrypts packets (single ones or whole lists of them)
 
-def encrypt_packet(packet):
-    """Encrypt packet for transmission over rf24"""
-    cipher = AES.new(PRESHARED_KEY, AES.MODE_ECB)
+    A packet consists of two blocks, the second block is encrypted first and the first one is chained to it,
+    so a change in any byte changes both blocks of the encrypted packet. As all blocks are independent ECB
+    operations, lists of packets are passed to the cipher in one call.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.cipher = AES.new(key, AES.MODE_ECB)
+
+    def decrypt_packet(self, packet):
+        """Decrypt packet for transmission over rf24"""
+        encrypted = bytes(packet[:PACKET_SIZE])
+        decrypted = self.cipher.decrypt(encrypted)
+        return xor_block(encrypted[BLOCK_SIZE:], decrypted[:BLOCK_SIZE]) + decrypted[BLOCK_SIZE:]
+
+    def encrypt_packet(self, packet):
+        """Encrypt packet for transmission over rf24"""
+        decrypted = bytes(packet[:PACKET_SIZE])
+        encrypted_part2 = self.cipher.encrypt(decrypted[BLOCK_SIZE:])
+        encrypted_part1 = self.cipher.encrypt(xor_block(encrypted_part2, decrypted[:BLOCK_SIZE]))
+        return encrypted_part1 + encrypted_part2
+
+    def decrypt_packets(self, packets):
+        """Decrypt a list of packets"""
+        if not packets:
+            return []
+        encrypted = b''.join(bytes(packet[:PACKET_SIZE]) for packet in packets)
+        decrypted = self.cipher.decrypt(encrypted)
+        return [
+            xor_block(encrypted[offset+BLOCK_SIZE:offset+PACKET_SIZE], decrypted[offset:offset+BLOCK_SIZE]) +
+            decrypted[offset+BLOCK_SIZE:offset+PACKET_SIZE]
+            for offset in range(0, len(encrypted), PACKET_SIZE)
+        ]
+
+    def encrypt_packets(self, packets):
+        """Encrypt a list of packets"""
+        if not packets:
+            return []
+        decrypted = [bytes(packet[:PACKET_SIZE]) for packet in packets]
+        encrypted_parts2 = self.cipher.encrypt(b''.join(packet[BLOCK_SIZE:] for packet in decrypted))
+        encrypted_parts1 = self.cipher.encrypt(b''.join(
+            xor_block(encrypted_parts2[index*BLOCK_SIZE:(index+1)*BLOCK_SIZE], packet[:BLOCK_SIZE])
+            for index, packet in enumerate(decrypted)
+        ))
+        return [
+            encrypted_parts1[index*BLOCK_SIZE:(index+1)*BLOCK_SIZE] +
+            encrypted_parts2[index*BLOCK_SIZE:(index+1)*BLOCK_SIZE]
+            for index in range(len(decrypted))
+        ]
 
-    decrypted_part1 = bytes(packet[0:16])
-    decrypted_part2 = bytes(packet[16:32])
 
-    encrypted_part2 = cipher.encrypt(decrypted_part2)
-    intermediate_part1 = bytes([e ^ i for e, i in zip(encrypted_part2, decrypted_part1)])
-    encrypted_part1 = cipher.encrypt(intermediate_part1)
+@lru_cache(maxsize=4)
+def get_engine(key):
+    """Get the (cached) crypto engine for a key"""
+    return CryptoEngine(key)
+
+
+def decrypt_packet(packet):
+    """Decrypt packet for transmission over rf24"""
+    return get_engine(PRESHARED_KEY).decrypt_packet(packet)
+
+
+def encrypt_packet(packet):
+    """Encrypt packet for transmission over rf24"""
+    return get_engine(PRESHARED_KEY).encrypt_packet(packet)
 
-    return encrypted_part1 + encrypted_part2
 
 def xor_checksum(array):
-    """Calculate XOR Checksum for an array of bytes"""
+    """Calculate XOR Checksum for an array of bytes, bytes after the eighth are shifted out completely"""
     result = 0
-    for index, value in enumerate(bytes(array)):
-        result = result & 0xFF ^ (value << index) & 0xFF
+    for index, value in enumerate(bytes(array[:8])):
+        result ^= (value << index) & 0xFF
     return result
-
@@ -0,0 +1,190 @@
+"""Find out what keeps the event loop busy, a loop lag monitor and a sampling profiler"""
+
+import asyncio
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from time import monotonic
+from metrics import REGISTRY
+from settings import LOOP_LAG_INTERVAL, LOOP_BLOCKED_THRESHOLD, PROFILER_RATE, PROFILER_DURATION, \
+    PROFILER_MAX_DURATION, PROFILER_DIRECTORY
+
+LOGGER = logging.getLogger(__name__)
+
+LAG_SECONDS = REGISTRY.histogram('loop_lag_seconds', 'How late the event loop ran a scheduled callback',
+                                 buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+
+
+class LoopStats():
+    """Lag of the event loop"""
+
+    def __init__(self):
+        self.beats = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.blocked = 0
+
+    def as_dict(self):
+        """All metrics as dict"""
+        return dict(vars(self))
+
+
+class LoopMonitor():
+    """Measures how late the event loop runs a heartbeat callback
+
+    A watchdog thread checks that the heartbeat keeps coming. When the loop is blocked for longer than the threshold,
+    the stack of the loop thread is logged while it is still stuck, which names the offending callback. Both only
+    wake up once per interval, so the monitor can stay enabled.
+    """
+
+    def __init__(self, loop=None, interval=LOOP_LAG_INTERVAL, threshold=LOOP_BLOCKED_THRESHOLD):
+        self.loop = loop or asyncio.get_event_loop()
+        self.interval = interval
+        self.threshold = threshold
+        self.stats = LoopStats()
+        self.expected = None
+        self.last_beat = monotonic()
+        self.thread_id = None
+        self.handle = None
+        self.stopped = threading.Event()
+        self.watchdog = None
+
+    def start(self):
+        """Start the heartbeat and the watchdog, has to be called from the thread running the loop"""
+        self.thread_id = threading.get_ident()
+        self.stopped.clear()
+        self.last_beat = monotonic()
+        self.expected = self.loop.time() + self.interval
+        self.handle = self.loop.call_later(self.interval, self.beat)
+        self.watchdog = threading.Thread(target=self.watch, name='loop-watchdog', daemon=True)
+        self.watchdog.start()
+
+    def stop(self):
+        """Stop the heartbeat and the watchdog"""
+        self.stopped.set()
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+
+    def beat(self):
+        """The heartbeat, records how late it runs and schedules the next one"""
+        now = self.loop.time()
+        lag = max(now - self.expected, 0.0)
+        self.last_beat = monotonic()
+        self.stats.beats += 1
+        self.stats.lag_total += lag
+        self.stats.lag_max = max(self.stats.lag_max, lag)
+        LAG_SECONDS.observe(lag)
+        self.expected = now + self.interval
+        self.handle = self.loop.call_later(self.interval, self.beat)
+
+    def watch(self):
+        """Body of the watchdog thread"""
+        reported = None
+        while not self.stopped.wait(self.interval):
+            last_beat = self.last_beat
+            blocked_for = monotonic() - last_beat - self.interval
+            if blocked_for > self.threshold and reported != last_beat:
+                reported = last_beat
+                self.report(blocked_for)
+
+    def report(self, blocked_for):
+        """Log where the loop thread is stuck"""
+        self.stats.blocked += 1
+        frame = sys._current_frames().get(self.thread_id) # pylint: disable=protected-access
+        stack = ''.join(traceback.format_stack(frame)) if frame is not None else 'unknown\n'
+        LOGGER.warning('Event loop blocked for {0:.3f}s in\n{1}'.format(blocked_for, stack.rstrip()))
+
+
+def collapse(thread_name, frame):
+    """A stack in the collapsed format of flamegraph.pl, root first"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    names.append(thread_name)
+    return ';'.join(reversed(names))
+
+
+def render(stacks):
+    """Collapsed stacks with their sample counts, one per line"""
+    return ''.join('{0} {1}\n'.format(stack, count) for stack, count in sorted(stacks.items()))
+
+
+class SamplingProfiler():
+    """Samples the stacks of all threads at a fixed rate for a while
+
+    Started by SIGUSR1, which writes the profile to a file, or by GET /profile?seconds=N on the metrics endpoint.
+    Sampling runs on an executor thread only while a profile is taken and only one profile is taken at a time, the
+    duration is capped.
+    """
+
+    def __init__(self, rate=PROFILER_RATE, directory=PROFILER_DIRECTORY, max_duration=PROFILER_MAX_DURATION):
+        self.loop = asyncio.get_event_loop()
+        self.interval = 1.0 / rate
+        self.directory = directory
+        self.max_duration = max_duration
+        self.running = False
+
+    def install(self):
+        """Take a profile on SIGUSR1"""
+        self.loop.add_signal_handler(signal.SIGUSR1, self.on_signal)
+
+    def on_signal(self):
+        """Called on SIGUSR1"""
+        asyncio.async(self.dump())
+
+    def sample(self, duration):
+        """Sample all other threads for duration seconds, blocks"""
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = Counter()
+        deadline = monotonic() + duration
+        while monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items(): # pylint: disable=protected-access
+                if thread_id != own:
+                    stacks[collapse(names.get(thread_id, str(thread_id)), frame)] += 1
+            time.sleep(self.interval)
+        return stacks
+
+    @asyncio.coroutine
+    def profile(self, duration=PROFILER_DURATION):
+        """Take a profile, returns the sample counts by collapsed stack or None if a profile is already running"""
+        if self.running:
+            return None
+        self.running = True
+        try:
+            return (yield from self.loop.run_in_executor(None, self.sample, min(duration, self.max_duration)))
+        finally:
+            self.running = False
+
+    @asyncio.coroutine
+    def dump(self, duration=PROFILER_DURATION):
+        """Take a profile and write it to a file in the directory"""
+        stacks = yield from self.profile(duration)
+        if stacks is None:
+            LOGGER.warning('Not starting a profile, another one is running')
+            return None
+        path = os.path.join(self.directory, 'gateway-{0}.folded'.format(time.strftime('%Y%m%d-%H%M%S')))
+        with open(path, 'w') as profile_file:
+            profile_file.write(render(stacks))
+        LOGGER.info('Wrote profile with {0} samples to {1}'.format(sum(stacks.values()), path))
+        return path
+
+    @asyncio.coroutine
+    def handle_request(self, query):
+        """Handler of the profile endpoint, takes a profile and returns it"""
+        try:
+            duration = float(query.get('seconds', [PROFILER_DURATION])[0])
+        except ValueError:
+            return '400 Bad Request', 'text/plain', b'seconds has to be a number\n'
+        stacks = yield from self.profile(duration)
+        if stacks is None:
+            return '409 Conflict', 'text/plain', b'A profile is running already\n'
+        return '200 OK', 'text/plain; charset=utf-8', render(stacks).encode()
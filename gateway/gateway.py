@@ -7,7 +7,7 @@ import logging
 try:
     import RPi.GPIO as GPIO
 except(RuntimeError, ImportError) as error:
-    if 'TEST_ENV' in os.environ:
+    if 'TEST_ENV' in os.environ or 'SIMULATION' in os.environ:
         LOGGER = logging.getLogger(__name__)
         LOGGER.warn("Assuming test-environment.")
         class GPIO:
@@ -18,39 +18,166 @@ except(RuntimeError, ImportError) as error:
         raise error
 from functools import partial
 
-from radio import Radio
+from clients import radio_index
+from diagnostics import LoopMonitor, SamplingProfiler
+from metrics import REGISTRY, start_metrics_server, publish_status
+from radio import MAX_PACKETS_PER_DRAIN, POLL_INTERVAL_MAX, next_poll_interval
+from radio_pool import create_radio_pool
+from radio_worker import RadioWorker
 from router import Router
+from timeseries import flush_periodically
+from settings import RADIOS, RADIO_IRQ_PIN, RADIO_RECEIVE_MODE, RADIO_WORKER_THREAD, METRICS_PORT, \
+    METRICS_STATUS_INTERVAL, PROFILER_ENDPOINT
+
+IRQ_FALLBACK_POLL_INTERVAL = 1.0
 
 def initialize_gpio():
     """Initialize GPIO (handles pin numbering and cleanup)"""
     GPIO.setmode(GPIO.BCM)
     atexit.register(GPIO.cleanup)
 
-def poll(loop, radio, router):
-    """Poll for radio messages, decrypt them and pass them to the handler"""
-    packet = radio.get_packet()
-    if packet:
-        client_id, message_id, payload = packet
+def drain(radio, router):
+    """Read all available radio messages and pass them to the handler, returns the number of packets read"""
+    if not router.accepting_packets():
+        return 0
+    packets, read = radio.get_packets(MAX_PACKETS_PER_DRAIN)
+    for client_id, message_id, payload in packets:
         asyncio.async(router.handle_packet(client_id, message_id, payload))
+    return read
+
+def poll(loop, radio, router, interval=POLL_INTERVAL_MAX):
+    """Drain all available radio messages, pass them to the handler and schedule the next poll"""
+    read = drain(radio, router)
+    interval = next_poll_interval(interval, read, MAX_PACKETS_PER_DRAIN)
+    loop.call_later(interval, partial(poll, loop, radio, router, interval))
+
+def fallback_poll(loop, radio, router):
+    """Drain the radio every now and then in irq mode, so a missed edge can not stall receiving forever"""
+    drain(radio, router)
+    loop.call_later(IRQ_FALLBACK_POLL_INTERVAL, partial(fallback_poll, loop, radio, router))
+
+def handle_radio_interrupt(loop, radio, router):
+    """Drain the radio after an interrupt, continue on the next loop iteration if the limit was hit"""
+    if drain(radio, router) >= MAX_PACKETS_PER_DRAIN:
+        loop.call_soon(handle_radio_interrupt, loop, radio, router)
 
-    loop.call_later(0.04, partial(poll, loop, radio, router))
+def on_radio_interrupt(loop, radio, router, dummy_channel):
+    """Called from the GPIO thread on the falling edge of the irq pin, hands over to the event loop"""
+    loop.call_soon_threadsafe(handle_radio_interrupt, loop, radio, router)
+
+def initialize_irq(callback, pin=RADIO_IRQ_PIN):
+    """Listen for the irq pin of a nrf24 module which is pulled low on received packets"""
+    GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+    GPIO.add_event_detect(pin, GPIO.FALLING, callback=callback)
+
+@asyncio.coroutine
+def dispatch_packets(worker, router):
+    """Pass the packets received by the radio worker thread to the handler, pause the worker while the router does
+    not accept packets"""
+    while True:
+        if not router.accepting_packets():
+            worker.pause()
+            while not router.accepting_packets():
+                yield from asyncio.sleep(POLL_INTERVAL_MAX)
+            worker.resume()
+        client_id, message_id, payload = yield from worker.packets.get()
+        asyncio.async(router.handle_packet(client_id, message_id, payload))
+
+def start_radio_worker(loop, radio, router, irq_pin=RADIO_IRQ_PIN):
+    """Move all io of a radio to a dedicated thread and talk to it through queues and futures"""
+    irq_mode = RADIO_RECEIVE_MODE == 'irq'
+    worker = RadioWorker(loop, radio, IRQ_FALLBACK_POLL_INTERVAL if irq_mode else POLL_INTERVAL_MAX)
+    worker.start()
+    asyncio.async(dispatch_packets(worker, router))
+    if irq_mode:
+        initialize_irq(worker.wake, irq_pin)
+    return worker
+
+def register_metrics(pool, router):
+    """Expose the stats of the components as metrics, the ones of the radios are labelled with their index"""
+    REGISTRY.register_stats('radio_tx', [radio.tx_stats for radio in pool.radios], 'Transmit batches of the radio',
+                            'radio')
+    REGISTRY.register_stats('scheduler', [scheduler.stats for scheduler in pool.schedulers], 'Transmit scheduler',
+                            'radio')
+    REGISTRY.register_stats('publisher', router.publisher.stats, 'Publisher')
+    REGISTRY.register_stats('retained', router.retained.stats, 'Retained messages')
+    if router.publisher.outbox is not None:
+        REGISTRY.register_stats('outbox', router.publisher.outbox.stats, 'Outbox')
+
+    def collect():
+        """Counters kept by the radios and the routing table"""
+        yield 'radio_spi_transactions', 'Spi transactions with the radio by type', {
+            (('radio', index), ('type', kind)): count
+            for index, radio in enumerate(pool.radios) for kind, count in radio.spi_stats.totals.items()
+        }
+        yield 'radio_rx_fifo_overflows', 'Drains that found the rx fifo full', {
+            (('radio', index),): radio.rx_fifo_overflows for index, radio in enumerate(pool.radios)
+        }
+        yield 'radio_utilization', 'Share of the time the radio was busy on air', {
+            (('radio', index),): utilization for index, utilization in enumerate(pool.utilization)
+        }
+        clients = [0] * len(pool.radios)
+        for client in pool.clients:
+            clients[radio_index(client.client_id)] += 1
+        yield 'radio_clients', 'Clients assigned to the radio', {
+            (('radio', index),): count for index, count in enumerate(clients)
+        }
+        topics = router.routes.topics
+        yield 'routing_topic_cache', 'Cached topic matches by result', {
+            (('result', 'hit'),): topics.hits,
+            (('result', 'miss'),): topics.misses
+        }
+    REGISTRY.register_collector(collect)
 
 def main():
     """Runs the gateway"""
     loop = asyncio.get_event_loop()
 
     router = Router()
-    loop.run_until_complete(router.connect_to_message_queue())
 
     initialize_gpio()
-    radio = Radio()
+    pool = create_radio_pool()
+
+    workers = []
+    if RADIO_WORKER_THREAD:
+        workers = [
+            start_radio_worker(loop, radio, router, config['irq_pin']) for radio, config in zip(pool.radios, RADIOS)
+        ]
+    elif RADIO_RECEIVE_MODE == 'irq':
+        for config in RADIOS:
+            initialize_irq(partial(on_radio_interrupt, loop, pool, router), config['irq_pin'])
+        fallback_poll(loop, pool, router)
+    else:
+        poll(loop, pool, router)
+
+    pool.start([worker.send_packets for worker in workers] or [radio.send_packets for radio in pool.radios])
+    router.set_send_packet(pool.send_packet)
 
-    router.set_send_packet(radio.send_packet)
+    monitor = LoopMonitor(loop)
+    monitor.start()
+    profiler = SamplingProfiler()
+    profiler.install()
 
-    poll(loop, radio, router)
+    register_metrics(pool, router)
+    REGISTRY.register_stats('loop', monitor.stats, 'Event loop')
+    # the radios run while the bus is down, publishing goes through the outbox until it is connected
+    asyncio.async(router.connect_to_message_queue())
+    if METRICS_PORT:
+        handlers = {'/profile': profiler.handle_request} if PROFILER_ENDPOINT else {}
+        asyncio.async(start_metrics_server(handlers=handlers))
+    if METRICS_STATUS_INTERVAL:
+        asyncio.async(publish_status(router.publisher))
+    if router.timeseries is not None:
+        asyncio.async(flush_periodically(router.timeseries))
     try:
         loop.run_forever()
     finally:
+        if router.timeseries is not None:
+            router.timeseries.flush()
+        monitor.stop()
+        pool.stop()
+        for worker in workers:
+            worker.stop()
         loop.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,242 @@
+"""Counters and histograms of the stages of the gateway, served in the Prometheus text format"""
+
+import asyncio
+import logging
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import partial
+from urllib.parse import urlsplit, parse_qs
+from settings import METRICS_HOST, METRICS_PORT, METRICS_STATUS_INTERVAL, METRICS_STATUS_KEY
+
+LOGGER = logging.getLogger(__name__)
+
+# seconds, from a single spi transaction up to waiting for the broker
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names, values):
+    """Labels of a sample in the text format"""
+    if not names:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, value) for name, value in zip(names, values)) + '}'
+
+
+def format_value(value):
+    """Value of a sample in the text format"""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric():
+    """Base of the metrics, a metric with label names holds one child per combination of label values"""
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.children = OrderedDict()
+
+    def labels(self, *values):
+        """Get the child for the label values, keep it around when it is used in a hot path"""
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.create_child()
+        return child
+
+    def create_child(self):
+        """Create a child without labels"""
+        raise NotImplementedError()
+
+    def samples(self):
+        """All samples as (suffix, label names, label values, value)"""
+        if not self.label_names:
+            for suffix, names, values, value in self.own_samples():
+                yield suffix, names, values, value
+            return
+        for label_values, child in self.children.items():
+            for suffix, names, values, value in child.own_samples():
+                yield suffix, self.label_names + names, label_values + values, value
+
+    def own_samples(self):
+        """Samples of a metric without labels"""
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+    type = 'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.value = 0
+
+    def create_child(self):
+        return Counter(self.name, self.documentation)
+
+    def inc(self, amount=1):
+        """Increase the counter"""
+        self.value += amount
+
+    def own_samples(self):
+        yield '', (), (), self.value
+
+
+class Histogram(Metric):
+    """Counts observations in fixed buckets, observing is a bisect and two additions"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def create_child(self):
+        return Histogram(self.name, self.documentation, self.buckets)
+
+    def observe(self, value):
+        """Count an observation"""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        """Number of observations"""
+        return sum(self.counts)
+
+    def own_samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            yield '_bucket', ('le',), (format_value(bound),), cumulative
+        yield '_sum', (), (), self.sum
+        yield '_count', (), (), cumulative
+
+
+class Registry():
+    """All metrics of the gateway, plus collectors that turn the stats objects of the components into gauges"""
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.collectors = []
+
+    def register(self, metric):
+        """Add a metric, returns the registered one if there is one with the same name"""
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, label_names=()):
+        """Get or create a counter"""
+        return self.register(Counter(name, documentation, label_names))
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS, label_names=()):
+        """Get or create a histogram"""
+        return self.register(Histogram(name, documentation, buckets, label_names))
+
+    def register_collector(self, collector):
+        """Add a function returning (name, documentation, {label values: value}) for gauges read when rendering,
+        the label values are tuples of (label name, label value)"""
+        self.collectors.append(collector)
+
+    def register_stats(self, prefix, stats, documentation, label_name=None):
+        """Expose all numeric values of a stats object with an as_dict method as gauges, with a label name the stats
+        are a list of stats objects and their index is the label value"""
+        def collect():
+            """Read the stats objects"""
+            values = OrderedDict()
+            for index, item in enumerate(stats if label_name else [stats]):
+                labels = ((label_name, index),) if label_name else ()
+                for key, value in sorted(item.as_dict().items()):
+                    if isinstance(value, (int, float)):
+                        values.setdefault(key, {})[labels] = value
+            for key, samples in values.items():
+                yield '{0}_{1}'.format(prefix, key), '{0}: {1}'.format(documentation, key), samples
+        self.register_collector(collect)
+
+    def collect(self):
+        """All metrics as (name, type, documentation, [(suffix, label names, label values, value)])"""
+        for metric in self.metrics.values():
+            yield metric.name, metric.type, metric.documentation, list(metric.samples())
+        for collector in self.collectors:
+            try:
+                gauges = list(collector())
+            except Exception: # pylint: disable=broad-except
+                LOGGER.exception('Collecting metrics failed')
+                continue
+            for name, documentation, values in gauges:
+                yield name, 'gauge', documentation, [
+                    ('', tuple(label for label, dummy in labels), tuple(label_value for dummy, label_value in labels),
+                     value)
+                    for labels, value in values.items()
+                ]
+
+    def render(self):
+        """All metrics in the Prometheus text format"""
+        lines = []
+        for name, metric_type, documentation, samples in self.collect():
+            lines.append('# HELP {0} {1}'.format(name, documentation))
+            lines.append('# TYPE {0} {1}'.format(name, metric_type))
+            for suffix, label_names, label_values, value in samples:
+                lines.append('{0}{1}{2} {3}'.format(name, suffix, format_labels(label_names, label_values),
+                                                    format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """Flat dict of all values for the status message, histograms contribute their count and sum"""
+        values = OrderedDict()
+        for name, dummy, dummy, samples in self.collect():
+            for suffix, label_names, label_values, value in samples:
+                if suffix == '_bucket':
+                    continue
+                values[name + suffix + format_labels(label_names, label_values)] = value
+        return values
+
+
+REGISTRY = Registry()
+
+
+@asyncio.coroutine
+def handle_request(registry, handlers, reader, writer):
+    """Answer a single http request, GET /metrics returns the metrics and other paths go to the handlers
+
+    A handler is a coroutine function getting the parsed query string and returning status, content type and body.
+    """
+    try:
+        request_line = yield from reader.readline()
+        while True:
+            line = yield from reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+        parts = request_line.decode('ascii', 'replace').split()
+        url = urlsplit(parts[1]) if len(parts) >= 2 and parts[0] == 'GET' else None
+        if url is not None and url.path == '/metrics':
+            status, content_type, body = '200 OK', CONTENT_TYPE, registry.render().encode()
+        elif url is not None and url.path in handlers:
+            status, content_type, body = yield from handlers[url.path](parse_qs(url.query))
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain', b'Not found\n'
+        writer.write('HTTP/1.0 {0}\r\nContent-Type: {1}\r\nContent-Length: {2}\r\n\r\n'.format(
+            status, content_type, len(body)
+        ).encode('ascii') + body)
+        yield from writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def start_metrics_server(registry=REGISTRY, host=METRICS_HOST, port=METRICS_PORT, handlers=None):
+    """Serve the metrics over http, returns the coroutine starting the server"""
+    LOGGER.info('Serving metrics on {0}:{1}'.format(host, port))
+    return asyncio.start_server(partial(handle_request, registry, handlers or {}), host, port)
+
+
+@asyncio.coroutine
+def publish_status(publisher, registry=REGISTRY, interval=METRICS_STATUS_INTERVAL, routing_key=METRICS_STATUS_KEY):
+    """Publish all metrics as status message every interval seconds"""
+    while True:
+        yield from asyncio.sleep(interval)
+        publisher.enqueue(routing_key, registry.snapshot())
@@ -0,0 +1,271 @@
+"""Journal on disk for messages that could not be published yet"""
+
+import logging
+import mmap
+import os
+import time
+from collections import deque
+from struct import Struct
+from settings import OUTBOX_DIRECTORY, OUTBOX_SEGMENT_SIZE, OUTBOX_MAX_SIZE, OUTBOX_MAX_AGE
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = b'GWOB'
+SEGMENT_SUFFIX = '.seg'
+# magic, write offset, read offset, timestamp of the newest record
+SEGMENT_HEADER = Struct('<4sIId')
+# body length, timestamp, content type length, routing key length
+RECORD_HEADER = Struct('<IdBH')
+
+
+class OutboxRecord():
+    """A message in the outbox"""
+    __slots__ = ('routing_key', 'body', 'content_type', 'timestamp')
+
+    def __init__(self, routing_key, body, content_type, timestamp):
+        self.routing_key = routing_key
+        self.body = body
+        self.content_type = content_type
+        self.timestamp = timestamp
+
+
+class Segment():
+    """A memory mapped segment file of the outbox, records are appended after the header and read in order"""
+
+    def __init__(self, path, size=None):
+        self.path = path
+        self.number = int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)])
+        create = size is not None
+        self.file = open(path, 'w+b' if create else 'r+b')
+        try:
+            if create:
+                self.file.truncate(size)
+            self.map = mmap.mmap(self.file.fileno(), 0)
+        except (OSError, ValueError):
+            self.file.close()
+            raise
+        if create:
+            self.write_offset = self.read_offset = SEGMENT_HEADER.size
+            self.newest = 0.0
+            self.store_header()
+            return
+        magic, self.write_offset, self.read_offset, self.newest = SEGMENT_HEADER.unpack_from(self.map)
+        if magic != MAGIC or not SEGMENT_HEADER.size <= self.read_offset <= self.write_offset <= len(self.map):
+            self.close()
+            raise ValueError('{0} is not an outbox segment'.format(path))
+
+    @property
+    def size(self):
+        """Size of the segment file"""
+        return len(self.map)
+
+    @property
+    def empty(self):
+        """If all records of the segment were read"""
+        return self.read_offset == self.write_offset
+
+    def store_header(self):
+        """Write the offsets to the header of the file"""
+        SEGMENT_HEADER.pack_into(self.map, 0, MAGIC, self.write_offset, self.read_offset, self.newest)
+
+    def append(self, routing_key, body, content_type, timestamp):
+        """Append a record, returns False if the segment is full"""
+        end = self.write_offset + RECORD_HEADER.size + len(content_type) + len(routing_key) + len(body)
+        if end > len(self.map):
+            return False
+        RECORD_HEADER.pack_into(self.map, self.write_offset, len(body), timestamp, len(content_type), len(routing_key))
+        offset = self.write_offset + RECORD_HEADER.size
+        for data in (content_type, routing_key, body):
+            self.map[offset:offset + len(data)] = data
+            offset += len(data)
+        # the record is complete before the header points behind it
+        self.write_offset = end
+        self.newest = timestamp
+        self.store_header()
+        return True
+
+    def read(self):
+        """Read the next record, returns the record and the offset behind it"""
+        body_length, timestamp, content_type_length, routing_key_length = RECORD_HEADER.unpack_from(
+            self.map, self.read_offset
+        )
+        offset = self.read_offset + RECORD_HEADER.size
+        content_type = self.map[offset:offset + content_type_length].decode('ascii')
+        offset += content_type_length
+        routing_key = self.map[offset:offset + routing_key_length].decode('ascii')
+        offset += routing_key_length
+        body = self.map[offset:offset + body_length]
+        return OutboxRecord(routing_key, body, content_type, timestamp), offset + body_length
+
+    def count(self):
+        """Count the records that were not read yet"""
+        count = 0
+        offset = self.read_offset
+        while offset < self.write_offset:
+            body_length, dummy, content_type_length, routing_key_length = RECORD_HEADER.unpack_from(self.map, offset)
+            offset += RECORD_HEADER.size + content_type_length + routing_key_length + body_length
+            count += 1
+        return count
+
+    def reset(self):
+        """Reuse the segment from the start once everything was read"""
+        self.write_offset = self.read_offset = SEGMENT_HEADER.size
+        self.store_header()
+
+    def flush(self):
+        """Write the changes to disk"""
+        self.map.flush()
+
+    def close(self):
+        """Close the segment file"""
+        self.map.close()
+        self.file.close()
+
+    def delete(self):
+        """Close and remove the segment file"""
+        self.close()
+        os.remove(self.path)
+
+
+class OutboxStats():
+    """What happened to the messages of the outbox"""
+
+    def __init__(self):
+        self.appended = 0
+        self.replayed = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def as_dict(self):
+        """All metrics as dict"""
+        return dict(vars(self))
+
+
+class Outbox():
+    """Append only journal of messages, split into memory mapped segment files
+
+    Messages are taken out in the order they were appended. A new segment is started when the current one is full,
+    when the segments together grow beyond max_size the oldest one is dropped, and messages older than max_age are
+    dropped instead of being taken out. Everything stays on disk across restarts of the gateway.
+    """
+
+    def __init__(self, directory=OUTBOX_DIRECTORY, segment_size=OUTBOX_SEGMENT_SIZE, max_size=OUTBOX_MAX_SIZE,
+                 max_age=OUTBOX_MAX_AGE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.max_age = max_age
+        self.stats = OutboxStats()
+        self.segments = deque()
+        self.count = 0
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def __len__(self):
+        return self.count
+
+    def load(self):
+        """Open the segments left by an earlier run"""
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                segment = Segment(path)
+            except (OSError, ValueError) as error:
+                LOGGER.error('Dropping broken outbox segment {0}: {1!r}'.format(path, error))
+                os.remove(path)
+                continue
+            self.segments.append(segment)
+            self.count += segment.count()
+        if self.count:
+            LOGGER.info('Outbox has {0} messages left to publish'.format(self.count))
+
+    @property
+    def size(self):
+        """Bytes of all segment files"""
+        return sum(segment.size for segment in self.segments)
+
+    def rotate(self):
+        """Start a new segment"""
+        if self.segments:
+            self.segments[-1].flush()
+        number = self.segments[-1].number + 1 if self.segments else 0
+        path = os.path.join(self.directory, '{0:010d}{1}'.format(number, SEGMENT_SUFFIX))
+        self.segments.append(Segment(path, self.segment_size))
+        while len(self.segments) > 1 and self.size > self.max_size:
+            self.drop_oldest('evicted')
+
+    def drop_oldest(self, reason):
+        """Drop the oldest segment with all records that were not read yet"""
+        segment = self.segments.popleft()
+        dropped = segment.count()
+        self.count -= dropped
+        setattr(self.stats, reason, getattr(self.stats, reason) + dropped)
+        if dropped:
+            LOGGER.warning('Outbox dropped {0} {1} messages'.format(dropped, reason))
+        segment.delete()
+
+    def expire(self, now):
+        """Drop the segments which only hold expired records"""
+        cutoff = now - self.max_age
+        while len(self.segments) > 1 and self.segments[0].newest < cutoff:
+            self.drop_oldest('expired')
+
+    def append(self, routing_key, body, content_type):
+        """Append an encoded message"""
+        routing_key, content_type = routing_key.encode('ascii'), content_type.encode('ascii')
+        record_size = RECORD_HEADER.size + len(content_type) + len(routing_key) + len(body)
+        if SEGMENT_HEADER.size + record_size > self.segment_size:
+            raise ValueError('Message to {0} does not fit into an outbox segment'.format(routing_key.decode()))
+        now = time.time()
+        if not self.segments or not self.segments[-1].append(routing_key, body, content_type, now):
+            self.rotate()
+            self.segments[-1].append(routing_key, body, content_type, now)
+        self.count += 1
+        self.stats.appended += 1
+        self.expire(now)
+
+    def take(self, limit):
+        """Take out up to limit records, oldest first, expired records are dropped"""
+        records = []
+        cutoff = time.time() - self.max_age
+        while self.segments and len(records) < limit:
+            segment = self.segments[0]
+            if segment.empty:
+                if len(self.segments) == 1:
+                    break
+                self.segments.popleft().delete()
+                continue
+            record, segment.read_offset = segment.read()
+            self.count -= 1
+            if record.timestamp < cutoff:
+                self.stats.expired += 1
+                continue
+            records.append(record)
+        while len(self.segments) > 1 and self.segments[0].empty:
+            self.segments.popleft().delete()
+        if self.segments:
+            if self.segments[0].empty:
+                self.segments[0].reset()
+            else:
+                self.segments[0].store_header()
+        self.stats.replayed += len(records)
+        return records
+
+    def sync(self):
+        """Write all segments to disk"""
+        for segment in self.segments:
+            segment.flush()
+
+    def close(self):
+        """Write all segments to disk and close them"""
+        self.sync()
+        for segment in self.segments:
+            segment.close()
+        self.segments.clear()
+
+
+def create_outbox():
+    """Create the outbox if a directory is configured"""
+    return Outbox() if OUTBOX_DIRECTORY else None
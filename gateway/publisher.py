@@ -0,0 +1,249 @@
+"""Publish messages from the clients to the message queue"""
+
+import asyncio
+import logging
+from collections import deque
+from time import perf_counter
+from metrics import REGISTRY
+from serialization import MessageEncoder
+from settings import PUBLISH_QUEUE_SIZE, PUBLISH_POLICY, PUBLISH_RETRY_INTERVAL, PUBLISH_WRITE_BUFFER_LIMIT, \
+    PUBLISH_DRAIN_INTERVAL
+
+LOGGER = logging.getLogger(__name__)
+
+PUBLISH_SECONDS = REGISTRY.histogram('publisher_publish_seconds', 'Time to encode a message and hand it to the bus')
+QUEUE_SECONDS = REGISTRY.histogram('publisher_queue_seconds',
+                                   'Time from queueing a message to handing it to the bus')
+
+DROP = 'drop'
+CONFLATE = 'conflate'
+BLOCK = 'block'
+
+
+class PendingMessage():
+    """A message waiting to be published"""
+    __slots__ = ('routing_key', 'body', 'queued_at', 'content_type')
+
+    def __init__(self, routing_key, body, queued_at, content_type=None):
+        self.routing_key = routing_key
+        self.body = body
+        self.queued_at = queued_at
+        # set when the body is encoded already
+        self.content_type = content_type
+
+
+class PublishQueue():
+    """Messages waiting to be published, the policy decides what happens to new messages when it is full"""
+
+    def __init__(self, max_size, policy, stats):
+        self.max_size = max_size
+        self.policy = policy
+        self.stats = stats
+        self.messages = deque()
+        self.latest = {}
+
+    def __len__(self):
+        return len(self.messages)
+
+    @property
+    def full(self):
+        """If the queue is full"""
+        return len(self.messages) >= self.max_size
+
+    def put(self, message):
+        """Queue a message, returns False if it was dropped"""
+        if self.full:
+            latest = self.latest.get(message.routing_key)
+            if self.policy == CONFLATE and latest:
+                latest.body = message.body
+                latest.content_type = message.content_type
+                self.stats.conflated += 1
+                return True
+            self.stats.dropped += 1
+            if self.policy != CONFLATE:
+                return False
+            self.forget(self.messages.popleft())
+        self.messages.append(message)
+        self.latest[message.routing_key] = message
+        return True
+
+    def get(self):
+        """Take the oldest message out of the queue"""
+        message = self.messages.popleft()
+        self.forget(message)
+        return message
+
+    def put_back(self, message):
+        """Put a message that could not be published back to the front of the queue"""
+        self.messages.appendleft(message)
+        self.latest.setdefault(message.routing_key, message)
+
+    def forget(self, message):
+        """Remove a message that leaves the queue from the latest messages"""
+        if self.latest.get(message.routing_key) is message:
+            del self.latest[message.routing_key]
+
+
+class PublisherStats():
+    """Throughput, backlog and latency metrics of the publisher"""
+
+    def __init__(self):
+        self.published = 0
+        self.failed = 0
+        self.dropped = 0
+        self.conflated = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def as_dict(self):
+        """All metrics as dict"""
+        return dict(vars(self))
+
+
+class Publisher():
+    """Queues messages and publishes them in batches, once per iteration of the event loop
+
+    When the queue is full the policy decides if a new message is dropped, conflated with a queued message for the
+    same routing key or if the sender has to wait. Latency is measured from queueing to the hand over to the bus.
+    Bodies are encoded when they are published, so conflated messages are never encoded.
+
+    Publishing pauses while more than write_buffer_limit bytes handed to the bus wait to be written to the broker, the
+    messages stay in the queue then, so a slow broker is handled by the policy as well.
+
+    With an outbox, messages are written to it instead while the bus is disconnected or the queue is full (the policy
+    does not apply then), and moved back into the queue in order once there is room.
+    """
+
+    def __init__(self, max_queued=PUBLISH_QUEUE_SIZE, policy=PUBLISH_POLICY, encoder=None, outbox=None,
+                 write_buffer_limit=PUBLISH_WRITE_BUFFER_LIMIT):
+        # pylint: disable=too-many-arguments
+        self.loop = asyncio.get_event_loop()
+        self.write_buffer_limit = write_buffer_limit
+        self.bus = None
+        self.encoder = encoder or MessageEncoder()
+        self.stats = PublisherStats()
+        self.pending = PublishQueue(max_queued, policy, self.stats)
+        self.space = asyncio.Event()
+        self.space.set()
+        self.flush_handle = None
+        self.outbox = outbox
+
+    def attach(self, bus):
+        """Set the message bus messages are published to"""
+        self.bus = bus
+        self.schedule_flush()
+
+    @property
+    def blocked(self):
+        """If senders have to wait before publishing"""
+        return self.outbox is None and self.pending.policy == BLOCK and self.pending.full
+
+    @property
+    def connected(self):
+        """If the bus is connected"""
+        return self.bus is not None and self.bus.connected
+
+    @property
+    def spilling(self):
+        """If new messages go to the outbox, they do as long as older messages wait there"""
+        return self.outbox is not None and (not self.connected or self.pending.full or len(self.outbox) > 0)
+
+    @asyncio.coroutine
+    def publish(self, routing_key, body):
+        """Queue a message for publishing, waits for room in the queue with the block policy"""
+        while self.blocked:
+            yield from self.space.wait()
+        return self.enqueue(routing_key, body)
+
+    def enqueue(self, routing_key, body):
+        """Queue a message for publishing, returns False if it was dropped"""
+        if self.spilling:
+            return self.spill(routing_key, body)
+        if not self.pending.put(PendingMessage(routing_key, body, self.loop.time())):
+            return False
+        self.update_backlog()
+        self.schedule_flush()
+        return True
+
+    def spill(self, routing_key, body):
+        """Write a message to the outbox, returns False if that failed"""
+        try:
+            body, content_type = self.encoder.encode(routing_key, body)
+            self.outbox.append(routing_key, body, content_type)
+        except (TypeError, ValueError, OSError):
+            LOGGER.exception('Writing message to {0} to the outbox failed'.format(routing_key))
+            self.stats.failed += 1
+            return False
+        self.schedule_flush()
+        return True
+
+    def replay(self):
+        """Move messages from the outbox to the queue, oldest first, as far as there is room"""
+        now = self.loop.time()
+        for record in self.outbox.take(self.pending.max_size - len(self.pending)):
+            self.pending.put(PendingMessage(record.routing_key, record.body, now, record.content_type))
+
+    def schedule_flush(self):
+        """Publish the queued messages on the next iteration of the event loop"""
+        if self.flush_handle is None and (self.pending or (self.outbox is not None and len(self.outbox) > 0)):
+            self.flush_handle = self.loop.call_soon(self.flush)
+
+    def flush(self):
+        """Publish the queued messages"""
+        self.flush_handle = None
+        if not self.connected:
+            return
+        if self.outbox is not None:
+            self.replay()
+        while self.pending:
+            if self.write_buffer_full():
+                self.flush_handle = self.loop.call_later(PUBLISH_DRAIN_INTERVAL, self.flush)
+                break
+            message = self.pending.get()
+            started_at = perf_counter()
+            if message.content_type is None:
+                try:
+                    body, content_type = self.encoder.encode(message.routing_key, message.body)
+                except (TypeError, ValueError):
+                    LOGGER.exception('Encoding message to {0} failed'.format(message.routing_key))
+                    self.stats.failed += 1
+                    continue
+            else:
+                body, content_type = message.body, message.content_type
+            try:
+                self.bus.publish(message.routing_key, body, content_type)
+            except Exception: # pylint: disable=broad-except
+                LOGGER.exception('Publishing to {0} failed'.format(message.routing_key))
+                self.stats.failed += 1
+                self.pending.put_back(message)
+                self.flush_handle = self.loop.call_later(PUBLISH_RETRY_INTERVAL, self.flush)
+                break
+            PUBLISH_SECONDS.observe(perf_counter() - started_at)
+            self.stats.published += 1
+            latency = self.loop.time() - message.queued_at
+            self.stats.latency_total += latency
+            self.stats.latency_max = max(self.stats.latency_max, latency)
+            QUEUE_SECONDS.observe(latency)
+        self.update_backlog()
+        if self.outbox is not None:
+            # replay the rest of the outbox on the next iteration
+            self.schedule_flush()
+
+    def write_buffer_full(self):
+        """Track the bytes the bus did not write to the broker yet, returns if publishing has to pause"""
+        self.stats.in_flight = self.bus.write_buffer_size()
+        self.stats.max_in_flight = max(self.stats.max_in_flight, self.stats.in_flight)
+        return self.stats.in_flight > self.write_buffer_limit
+
+    def update_backlog(self):
+        """Track the backlog and wake up blocked senders when there is room in the queue again"""
+        self.stats.queued = len(self.pending)
+        self.stats.max_queued = max(self.stats.max_queued, self.stats.queued)
+        if self.pending.full:
+            self.space.clear()
+        else:
+            self.space.set()
@@ -5,7 +5,7 @@ import logging
 try:
     from nrf24 import NRF24
 except(RuntimeError, ImportError) as error:
-    if 'TEST_ENV' in os.environ:
+    if 'TEST_ENV' in os.environ or 'SIMULATION' in os.environ:
         LOGGER = logging.getLogger(__name__)
         LOGGER.warn("Assuming test-environment")
         class NRF24:
@@ -14,39 +14,126 @@ except(RuntimeError, ImportError) as error:
                 pass
     else:
         raise error
+from collections import Counter, OrderedDict
 from struct import pack, unpack
 from random import randint
+from time import monotonic, perf_counter
 from crypto import decrypt_packet, encrypt_packet, xor_checksum
-from settings import SERVER_ADDRESS, SERVER_ID
-from constants import PacketTypes
+from clients import ClientRegistry, global_client_id
+from metrics import REGISTRY
+from scheduler import PACKET_AIRTIME, ACK_AIRTIME
+from settings import SERVER_ADDRESS, SERVER_ID, RADIOS
+from constants import PacketTypes, RegisterFlags
 
 MAX_PAYLOAD_SIZE = 27
 MAX_UINT16 = 65535
+RX_FIFO_DEPTH = 3
+MAX_PACKETS_PER_DRAIN = 32
+POLL_INTERVAL_MIN = 0.005
+POLL_INTERVAL_MAX = 0.04
 
 LOGGER = logging.getLogger(__name__)
 
+READ_SECONDS = REGISTRY.histogram('radio_read_seconds', 'Time to read a packet from the radio')
+DECRYPT_SECONDS = REGISTRY.histogram('radio_decrypt_seconds', 'Time to decrypt a packet')
+PACKETS_READ = REGISTRY.counter('radio_packets_read_total', 'Packets read from the radio by result', ('result',))
+PACKETS_ACCEPTED = PACKETS_READ.labels('accepted')
+PACKETS_UNKNOWN_CLIENT = PACKETS_READ.labels('unknown_client')
+PACKETS_REJECTED_COUNTER = PACKETS_READ.labels('rejected_counter')
+WRITE_ATTEMPTS = REGISTRY.histogram('radio_write_attempts', 'Attempts needed to send a packet',
+                                    buckets=(1, 2, 3, 5, 10))
+WRITE_FAILURES = REGISTRY.counter('radio_write_failures_total', 'Packets that were not acknowledged after all retries')
+
+
+class TxStats():
+    """Timing of the transmit batches, the radio can not receive while it is sending"""
+
+    def __init__(self):
+        self.batches = 0
+        self.packets = 0
+        self.deaf_time_total = 0.0
+        self.deaf_time_max = 0.0
+        self.deaf_time_last = 0.0
+
+    def add_batch(self, packets, deaf_time):
+        """Record a sent batch"""
+        self.batches += 1
+        self.packets += packets
+        self.deaf_time_total += deaf_time
+        self.deaf_time_max = max(self.deaf_time_max, deaf_time)
+        self.deaf_time_last = deaf_time
+        LOGGER.debug("Sent batch of {0} packets, not listening for {1:.1f}ms".format(packets, deaf_time * 1000))
+
+    def as_dict(self):
+        """All timings as dict"""
+        return dict(vars(self))
+
+
+class SpiStats():
+    """Counts the spi transactions with the radio by type"""
+
+    def __init__(self):
+        self.counts = Counter()
+        self.totals = Counter()
+        self.since = monotonic()
+
+    def count(self, kind, transactions=1):
+        """Count transactions of a type"""
+        self.counts[kind] += transactions
+        self.totals[kind] += transactions
+
+    def rates(self):
+        """Transactions per second by type since the last call"""
+        now = monotonic()
+        elapsed = max(now - self.since, 1e-9)
+        rates = {kind: count / elapsed for kind, count in self.counts.items()}
+        self.counts.clear()
+        self.since = now
+        return rates
+
+
+def next_poll_interval(interval, read, limit, max_interval=POLL_INTERVAL_MAX):
+    """Poll again right away while the fifo could not be drained, shortly while traffic is flowing and back
+    off exponentially up to max_interval while the radio is idle"""
+    if read >= limit:
+        return 0
+    if read:
+        return POLL_INTERVAL_MIN
+    return min(max(interval, POLL_INTERVAL_MIN) * 2, max_interval)
+
 class Radio():
     """Wrapper around the nrf24 radio including client_id and crypto handling"""
 
-    def __init__(self):
-        """Setup the radio module"""
-        self.server_address = SERVER_ADDRESS
+    def __init__(self, nrf24=None, config=None, index=0, clients=None):
+        """Setup the radio module, a simulated module can be passed instead of the real one
+
+        The config has the spi device, pins and rf channel of the module. Radios of the same gateway share the client
+        registry and are told apart by their index, which is part of the client ids of the clients assigned to them.
+        """
+        config = config or RADIOS[0]
+        self.index = index
+        self.channel = config['channel']
         self.server_id_checksum = xor_checksum(SERVER_ID)
-        self.clients = []
+        self.ack_payload = bytes(SERVER_ID) + bytes([self.server_id_checksum])
+        self.ack_payload_loaded = False
+        self.spi_stats = SpiStats()
+        self.clients = clients if clients is not None else ClientRegistry()
+        self.rx_fifo_overflows = 0
+        self.tx_stats = TxStats()
 
-        self.nrf24 = NRF24()
-        self.nrf24.begin(0, 0, 25, 24)
+        self.nrf24 = nrf24 if nrf24 is not None else NRF24()
+        self.nrf24.begin(0, config['spi_device'], config['ce_pin'], config['irq_pin'])
 
         self.nrf24.setRetries(10, 10)
         self.nrf24.setPayloadSize(32)
-        self.nrf24.setChannel(0x4c)
-        self.nrf24.setDataRate(NRF24.BR_250KBPS)
-        self.nrf24.setPALevel(NRF24.PA_HIGH)
-        self.nrf24.setCRCLength(NRF24.CRC_16)
+        self.nrf24.setChannel(self.channel)
+        self.nrf24.setDataRate(self.nrf24.BR_250KBPS)
+        self.nrf24.setPALevel(self.nrf24.PA_HIGH)
+        self.nrf24.setCRCLength(self.nrf24.CRC_16)
         self.nrf24.setAutoAck(True)
         self.nrf24.enableAckPayload()
-        self.nrf24.openReadingPipe(1, self.server_address)
-        self.nrf24.openWritingPipe(self.server_address)
+        self.nrf24.openReadingPipe(1, SERVER_ADDRESS)
+        self.nrf24.openWritingPipe(SERVER_ADDRESS)
         self.nrf24.startListening()
 
         if LOGGER.isEnabledFor(logging.INFO):
@@ -54,9 +141,45 @@ class Radio():
 
     def send_packet(self, client_id, packet_id, payload):
         """Send packet to a client"""
-        client = next((c for c in self.clients if c['client_id'] == client_id), None)
-        address = client['address']
-        counter_bytes = pack('H', client['server_counter'])
+        return self.send_packets([(client_id, packet_id, payload)])[0]
+
+    def send_packets(self, packets):
+        """Send a batch of (client_id, packet_id, payload) packets, returns the success of each packet
+
+        The radio leaves rx mode only once per batch and the packets are grouped by destination, so the writing
+        pipe is only opened again when the address changes. Packets to the same client keep their order.
+        """
+        results = [False] * len(packets)
+        by_address = OrderedDict()
+        for index, (client_id, packet_id, payload) in enumerate(packets):
+            client = self.clients.get(client_id)
+            if client is None:
+                LOGGER.warning("Tried to send packet to unknown client {0}".format(client_id))
+                continue
+            by_address.setdefault(tuple(client.address), []).append((index, client, packet_id, payload))
+        if not by_address:
+            return results
+
+        started_at = monotonic()
+        self.spi_stats.count('mode_switch', 2)
+        self.nrf24.stopListening()
+        try:
+            for batch in by_address.values():
+                self.spi_stats.count('open_pipe')
+                self.nrf24.openWritingPipe(batch[0][1].address)
+                for index, client, packet_id, payload in batch:
+                    results[index] = self.write_packet(client, packet_id, payload)
+        finally:
+            # a failing write must not leave the radio deaf
+            self.nrf24.startListening()
+            self.ack_payload_loaded = False
+            self.tx_stats.add_batch(sum(results), monotonic() - started_at)
+
+        return results
+
+    def write_packet(self, client, packet_id, payload):
+        """Encrypt and write a single packet to the already opened writing pipe"""
+        counter_bytes = pack('H', client.server_counter)
         payload_size = len(payload)
         padded_packet = [randint(0, 255) for dummy in range(0, MAX_PAYLOAD_SIZE - payload_size)]
         padded_packet[:0] = payload
@@ -64,32 +187,84 @@ class Radio():
         packed = pack('BBBB27sB', counter_bytes[1], 0, packet_id, payload_size, bytes(padded_packet), counter_bytes[0])
         encrypted = encrypt_packet(bytes(packed))
 
-        LOGGER.info("Sending packet type {0} to client {1}".format(packet_id, client_id))
+        LOGGER.info("Sending packet type {0} to client {1}".format(packet_id, client.client_id))
 
-        self.nrf24.stopListening()
-        self.nrf24.openWritingPipe(address)
         success = False
         retries = 10
         while (not success) and retries != 0:
+            self.spi_stats.count('write')
             success = self.nrf24.write(encrypted)
             retries -= 1
-        self.nrf24.startListening()
+        WRITE_ATTEMPTS.observe(10 - retries)
         if not success:
+            WRITE_FAILURES.inc()
             LOGGER.info("Failed sending packet!")
         else:
-            client['server_counter'] = client['server_counter']+1 if client['server_counter'] != MAX_UINT16 else 0
+            client.server_counter = client.server_counter+1 if client.server_counter != MAX_UINT16 else 0
+            client.count_packet(monotonic())
         return success
 
     def get_packet(self):
         """Get available packet from radio, if it is a registration packet handle it before passing on"""
-        if not self.nrf24.available():
-            ack_payload = bytes(SERVER_ID) + bytes([self.server_id_checksum])
-            self.nrf24.writeAckPayload(1, ack_payload, 8)
+        if not self.available():
+            self.write_ack_payload()
             return False
 
+        return self.read_packet()
+
+    def get_packets(self, limit=MAX_PACKETS_PER_DRAIN):
+        """Drain the rx fifo and return all valid packets, reading at most limit packets from the radio
+
+        Returns a tuple of the valid packets and the number of packets read from the fifo.
+        """
+        packets = []
+        read = 0
+        while read < limit and self.available():
+            packet = self.read_packet()
+            if packet:
+                packets.append(packet)
+            read += 1
+
+        if read >= RX_FIFO_DEPTH:
+            self.rx_fifo_overflows += 1
+            LOGGER.info("RX fifo was full, packets might have been dropped")
+        if read < limit:
+            self.write_ack_payload()
+
+        return packets, read
+
+    def airtime(self):
+        """Seconds the radio was busy on air, receiving packets and acknowledging them or sending"""
+        return self.spi_stats.totals['read'] * (PACKET_AIRTIME + ACK_AIRTIME) + self.tx_stats.deaf_time_total
+
+    def available(self):
+        """Is a packet waiting in the rx fifo"""
+        self.spi_stats.count('available')
+        return self.nrf24.available()
+
+    def write_ack_payload(self):
+        """Put the server id into the ack payload so clients can detect a restarted server
+
+        The payload stays in the tx fifo until it is sent with the next acknowledgement, so it is only written again
+        after a packet was received or the tx fifo was flushed by sending.
+        """
+        if self.ack_payload_loaded:
+            return
+        self.spi_stats.count('ack_payload')
+        self.nrf24.writeAckPayload(1, self.ack_payload, 8)
+        self.ack_payload_loaded = True
+
+    def read_packet(self):
+        """Read and validate a single packet from the radio, assumes that a packet is available"""
         encrypted_packet = []
+        self.spi_stats.count('read')
+        started_at = perf_counter()
         self.nrf24.read(encrypted_packet, 32)
+        read_at = perf_counter()
+        READ_SECONDS.observe(read_at - started_at)
+        self.ack_payload_loaded = False
         decrypted_packet = decrypt_packet(encrypted_packet)
+        DECRYPT_SECONDS.observe(perf_counter() - read_at)
 
         client_id, message_id, payload_length = unpack('BBB', decrypted_packet[1:4])
         received_counter = unpack('H', decrypted_packet[-1:] + decrypted_packet[:1])[0]
@@ -98,59 +273,60 @@ class Radio():
 
         if message_id == PacketTypes.REGISTER:
             client_id = self.handle_registration_message(received_counter, payload)
+        else:
+            client_id = global_client_id(self.index, client_id)
 
         if not self.has_client_id(client_id):
+            PACKETS_UNKNOWN_CLIENT.inc()
             return False
 
-        if not self.is_counter_is_in_expected_range(client_id, received_counter):
+        if not self.accept_counter(client_id, received_counter):
+            PACKETS_REJECTED_COUNTER.inc()
             return False
 
-        client = next((c for c in self.clients if c['client_id'] == client_id), None)
-        client['client_counter'] = received_counter
-
+        PACKETS_ACCEPTED.inc()
         return client_id, message_id, payload
 
-    def is_counter_is_in_expected_range(self, client_id, received_counter):
-        """ Is the received client_counter within the expected range
-            Expected range: [last counter + 1, last_counter+10] with respect to the value range of uint8_t
-        """
-        last_counter = next((c['client_counter'] for c in self.clients if c['client_id'] == client_id))
-        maximum = MAX_UINT16
-        expected_range = [
-            last_counter+i if last_counter+i <= maximum else last_counter+i-maximum-1 for i in range(1, 11)
-        ]
-        return received_counter in expected_range
-
-    def get_client_id(self, address):
-        """Get a client id for a specific address"""
-        all_existing_client_ids = [c['client_id'] for c in self.clients]
-        existing_client_id = next((c['client_id'] for c in self.clients if c['address'] == address), None)
-
-        if existing_client_id:
-            return existing_client_id
+    def accept_counter(self, client_id, received_counter):
+        """Is the received client counter inside the replay window of the client and has not been seen before
 
-        for i in range(1, 255):
-            if not i in all_existing_client_ids:
-                return i
+        The packet of an accepted counter adds to the load of the client, which is now reachable on this radio.
+        """
+        client = self.clients.get(client_id)
+        replay_window = client.replay_window
+        accepted = replay_window.check(received_counter)
+        if not accepted:
+            LOGGER.info("Rejected counter {0} of client {1} (last {2})".format(
+                received_counter,
+                client_id,
+                replay_window.last
+            ))
+            return False
+        client.radio = self.index
+        client.count_packet(monotonic())
+        return True
 
-        return False
+    def get_client_id(self, address, switches_channel=False):
+        """Get a client id for a specific address"""
+        return self.clients.get_client_id(address, switches_channel)
 
     def has_client_id(self, client_id):
         """Does the gateway have this client_id registered"""
-        all_existing_client_ids = [c['client_id'] for c in self.clients]
-        return client_id in all_existing_client_ids
+        return client_id in self.clients
 
     def handle_registration_message(self, counter, payload):
-        """Handle the registration of a client without client_id"""
+        """Handle the registration of a client without client_id
+
+        The payload is the address of the client followed by two unused bytes and the register flags, older firmware
+        sends zeros there and is kept on the first radio.
+        """
         address = list(unpack('<BBBBB', payload[:5])[::-1])
-        new_client_id = self.get_client_id(address)
-
-        self.clients = [c for c in self.clients if c['client_id'] is not new_client_id]
-        self.clients.append({
-            'client_id': new_client_id,
-            'address': address,
-            'client_counter': counter-1,
-            'server_counter': randint(0, MAX_UINT16)
-        })
+        flags = payload[7] if len(payload) > 7 else 0
+        new_client_id = self.get_client_id(address, bool(flags & RegisterFlags.SWITCHES_CHANNEL))
+        if new_client_id is False:
+            LOGGER.warning("No free client id left for {0}".format(address))
+            return False
+
+        self.clients.register(new_client_id, address, counter-1, randint(0, MAX_UINT16))
 
         return new_client_id
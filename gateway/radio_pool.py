@@ -0,0 +1,86 @@
+"""Drive several nrf24 modules on different rf channels as one radio"""
+
+import asyncio
+import logging
+from constants import PacketTypes, Priority
+from clients import ClientRegistry, radio_index
+from radio import Radio
+from scheduler import TransmitScheduler
+from settings import RADIOS, RADIO_UTILIZATION_INTERVAL
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RadioPool():
+    """The radios of the gateway with one client registry, packets of all radios look like they came from one
+
+    Clients register on the channel of the first radio and are assigned to the radio with the lowest load, the
+    registration ack tells them the channel to move to. Packets to a client are queued on the transmit scheduler of
+    the radio it was last heard on, so every radio is paced by its own airtime budget.
+    """
+
+    def __init__(self, radios):
+        self.loop = asyncio.get_event_loop()
+        self.radios = radios
+        self.clients = radios[0].clients
+        self.schedulers = []
+        self.utilization = [0.0] * len(radios)
+        self.airtime = [radio.airtime() for radio in radios]
+        self.measured_at = self.loop.time()
+        self.measure_handle = None
+
+    def get_packets(self, limit):
+        """Drain the rx fifos of all radios, returns the valid packets and the most packets read from a single one"""
+        packets = []
+        most_read = 0
+        for radio in self.radios:
+            radio_packets, read = radio.get_packets(limit)
+            packets.extend(radio_packets)
+            most_read = max(most_read, read)
+        return packets, most_read
+
+    def start(self, send_functions):
+        """Start a transmit scheduler for every radio with the function sending a batch of packets on it"""
+        self.schedulers = [TransmitScheduler(send_packets) for send_packets in send_functions]
+        for scheduler in self.schedulers:
+            scheduler.start()
+        self.measure_handle = self.loop.call_later(RADIO_UTILIZATION_INTERVAL, self.measure)
+
+    def stop(self):
+        """Stop measuring the utilization"""
+        if self.measure_handle:
+            self.measure_handle.cancel()
+            self.measure_handle = None
+
+    def send_packet(self, client_id, packet_id, payload, priority=Priority.NORMAL):
+        """Queue a packet for a client, returns a future which resolves to the success of the send"""
+        client = self.clients.get(client_id)
+        radio = client.radio if client is not None else radio_index(client_id)
+        if packet_id == PacketTypes.REGISTER_SERVER_ACK:
+            payload += bytes([self.radios[radio_index(client_id)].channel])
+        return self.schedulers[radio].send_packet(client_id, packet_id, payload, priority)
+
+    def measure(self):
+        """Share of the time every radio was busy on air since the last measurement"""
+        now = self.loop.time()
+        elapsed = max(now - self.measured_at, 1e-9)
+        for index, radio in enumerate(self.radios):
+            airtime = radio.airtime()
+            self.utilization[index] = min((airtime - self.airtime[index]) / elapsed, 1.0)
+            self.airtime[index] = airtime
+        self.measured_at = now
+        self.measure_handle = self.loop.call_later(RADIO_UTILIZATION_INTERVAL, self.measure)
+
+
+def create_radio_pool(configs=None, modules=None):
+    """Set up a radio for every config (the configured radios by default), modules can be simulated nrf24 modules to
+    use instead of real ones"""
+    configs = configs or RADIOS
+    clients = ClientRegistry(len(configs))
+    modules = modules or [None] * len(configs)
+    radios = [
+        Radio(module, config, index, clients) for index, (config, module) in enumerate(zip(configs, modules))
+    ]
+    channels = ', '.join(str(radio.channel) for radio in radios)
+    LOGGER.info('Using {0} radios on channels {1}'.format(len(radios), channels))
+    return RadioPool(radios)
@@ -0,0 +1,115 @@
+"""Run all radio io on a dedicated thread, so the event loop never blocks on spi"""
+
+import asyncio
+import logging
+import queue
+import threading
+from radio import MAX_PACKETS_PER_DRAIN, POLL_INTERVAL_MAX, next_poll_interval
+
+LOGGER = logging.getLogger(__name__)
+
+STOP = object()
+WAKE = object()
+
+
+def resolve_future(future, result=None, exception=None):
+    """Resolve a future on the event loop unless somebody cancelled it in the meantime"""
+    if future.cancelled():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+class RadioWorker():
+    """Owns the radio on its own thread, received packets are put into an asyncio queue and sends are resolved
+    through futures on the event loop
+
+    While paused the thread keeps executing commands but stops draining the radio, so the rx fifo fills up and the
+    radio stops acknowledging packets instead of the queue growing without limit.
+    """
+
+    def __init__(self, loop, radio, max_interval=POLL_INTERVAL_MAX):
+        self.loop = loop
+        self.radio = radio
+        self.max_interval = max_interval
+        self.packets = asyncio.Queue()
+        self.commands = queue.Queue()
+        self.accepting = threading.Event()
+        self.accepting.set()
+        self.thread = None
+
+    def start(self):
+        """Start the radio thread"""
+        self.thread = threading.Thread(target=self.run, name='radio')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the radio thread and wait for it to finish"""
+        self.commands.put(STOP)
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def wake(self, dummy_channel=None):
+        """Make the radio thread drain the radio right away, safe to be called from any thread"""
+        self.commands.put(WAKE)
+
+    def pause(self):
+        """Stop draining the radio, safe to be called from any thread"""
+        self.accepting.clear()
+
+    def resume(self):
+        """Drain the radio again, right away"""
+        self.accepting.set()
+        self.commands.put(WAKE)
+
+    def send_packet(self, client_id, packet_id, payload):
+        """Queue a packet for sending, returns a future which resolves to the success of the send"""
+        future = asyncio.Future(loop=self.loop)
+        self.commands.put((future, self.radio.send_packet, (client_id, packet_id, payload)))
+        return future
+
+    def send_packets(self, packets):
+        """Queue a batch of packets for sending, returns a future which resolves to the success of each packet"""
+        future = asyncio.Future(loop=self.loop)
+        self.commands.put((future, self.radio.send_packets, (packets,)))
+        return future
+
+    def run(self):
+        """Main loop of the radio thread, alternates between executing commands and draining the radio"""
+        interval = self.max_interval
+        while True:
+            command = None
+            try:
+                command = self.commands.get(timeout=interval)
+                while command is not STOP:
+                    self.execute(command)
+                    command = self.commands.get_nowait()
+            except queue.Empty:
+                pass
+            if command is STOP:
+                return
+            if not self.accepting.is_set():
+                interval = self.max_interval
+                continue
+
+            packets, read = self.radio.get_packets(MAX_PACKETS_PER_DRAIN)
+            for packet in packets:
+                self.loop.call_soon_threadsafe(self.packets.put_nowait, packet)
+            interval = next_poll_interval(interval, read, MAX_PACKETS_PER_DRAIN, self.max_interval)
+
+    def execute(self, command):
+        """Execute a single command on the radio thread and hand the result over to the event loop"""
+        if command is WAKE:
+            return
+        future, function, args = command
+        try:
+            result = function(*args)
+        except Exception as error: # pylint: disable=broad-except
+            LOGGER.exception("Radio command failed")
+            self.loop.call_soon_threadsafe(resolve_future, future, None, error)
+        else:
+            self.loop.call_soon_threadsafe(resolve_future, future, result)
@@ -0,0 +1,137 @@
+"""Keep the most recent message per routing key for clients that subscribe later"""
+
+import asyncio
+from collections import OrderedDict
+from functools import partial
+from settings import RETAINED_CACHE_SIZE, RETAINED_MAX_AGE
+from topics import TopicTrie
+
+
+class RetainedStats():
+    """Hit rate of the retained messages and packets that were not sent because the client had the value already"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.suppressed = 0
+
+    def as_dict(self):
+        """All metrics as dict"""
+        return dict(vars(self))
+
+
+class RetainedCache():
+    """Most recent message per routing key, bounded in size (the least recently used key goes first) and age"""
+
+    def __init__(self, max_size=RETAINED_CACHE_SIZE, max_age=RETAINED_MAX_AGE):
+        self.loop = asyncio.get_event_loop()
+        self.max_size = max_size
+        self.max_age = max_age
+        self.messages = OrderedDict()
+        self.stats = RetainedStats()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, routing_key, message):
+        """Keep a message as the most recent one of its routing key"""
+        self.messages.pop(routing_key, None)
+        self.messages[routing_key] = (message, self.loop.time())
+        while len(self.messages) > self.max_size:
+            self.messages.popitem(last=False)
+            self.stats.evicted += 1
+
+    def lookup(self, routing_key):
+        """Get the message and time of a routing key, None if there is none or it expired"""
+        entry = self.messages.get(routing_key)
+        if entry is None:
+            return None
+        if self.loop.time() - entry[1] > self.max_age:
+            del self.messages[routing_key]
+            self.stats.expired += 1
+            return None
+        self.messages.move_to_end(routing_key)
+        return entry
+
+    def get(self, routing_key):
+        """Get the most recent message of a routing key, None if there is none"""
+        entry = self.lookup(routing_key)
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return entry[0]
+
+    def match(self, pattern):
+        """Get the most recent messages of all routing keys matching a topic pattern, as (routing_key, message)
+        ordered from the oldest to the newest message"""
+        words = pattern.split('.')
+        if '*' in words or '#' in words:
+            topics = TopicTrie()
+            topics.add(pattern)
+            routing_keys = [routing_key for routing_key in self.messages if topics.match(routing_key)]
+        else:
+            routing_keys = [pattern]
+        entries = []
+        for routing_key in routing_keys:
+            entry = self.lookup(routing_key)
+            if entry is not None:
+                entries.append((entry[1], routing_key, entry[0]))
+        if entries:
+            self.stats.hits += 1
+        else:
+            self.stats.misses += 1
+        return [(routing_key, message) for dummy, routing_key, message in sorted(entries, key=lambda entry: entry[0])]
+
+
+class ActuatorStates():
+    """Payload last acknowledged on every subscription channel of the clients, and the sends still in flight
+
+    A payload only counts as known to the client once sending it succeeded. While a send to a channel is queued or
+    retried nothing is suppressed on it, the scheduler conflates the queued payload with the new one, otherwise a
+    command matching the acknowledged payload would be lost behind a different one still waiting to go out.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.payloads = {}
+        self.in_flight = {}
+
+    def changed(self, client_id, channel_id, payload):
+        """If a payload differs from what the client has on the channel or will have once the pending sends are done"""
+        if self.in_flight.get(client_id, {}).get(channel_id):
+            return True
+        if self.payloads.get(client_id, {}).get(channel_id) == payload:
+            self.stats.suppressed += 1
+            return False
+        return True
+
+    def sent(self, client_id, channel_id, payload, result):
+        """Remember a payload sent to a channel once it was acknowledged, result is the future of the send if there
+        is one, without one the payload is remembered right away"""
+        if isinstance(result, asyncio.Future):
+            channels = self.in_flight.setdefault(client_id, {})
+            channels[channel_id] = channels.get(channel_id, 0) + 1
+            result.add_done_callback(partial(self.acknowledged, client_id, channel_id, payload))
+        else:
+            self.payloads.setdefault(client_id, {})[channel_id] = payload
+
+    def acknowledged(self, client_id, channel_id, payload, future):
+        """Remember a payload if the client acknowledged it, sends of a client that registered again are ignored"""
+        channels = self.in_flight.get(client_id, {})
+        if channel_id not in channels:
+            return
+        channels[channel_id] -= 1
+        if not channels[channel_id]:
+            del channels[channel_id]
+            if not channels:
+                del self.in_flight[client_id]
+        if not future.cancelled() and not future.exception() and future.result():
+            self.payloads.setdefault(client_id, {})[channel_id] = payload
+
+    def clear(self, client_id):
+        """Forget everything about a client, after it registered again"""
+        self.payloads.pop(client_id, None)
+        self.in_flight.pop(client_id, None)
@@ -2,41 +2,65 @@
 
 import asyncio
 import logging
-import asynqp
+from collections import OrderedDict
+from time import perf_counter
 from crypto import xor_checksum
+from clients import local_client_id
 from struct import pack, unpack
-from settings import SERVER_ID, RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USERNAME, RABBITMQ_PASSWORD, \
-    RABBITMQ_VIRTUAL_HOST
-from transforms import SwitchTransform, TemperatureTransform
-from constants import PacketTypes
+from settings import SERVER_ID, TRANSFORM_SCHEMAS_FILE, RECONNECT_INTERVAL, RECONNECT_INTERVAL_MAX, \
+    TIMESERIES_QUERY_KEY
+from transforms import BUILTIN_TRANSFORMS
+from schemas import load_schemas
+from constants import PacketTypes, Priority
+from routing import RoutingTable
+from bindings import BindingManager
+from bus import create_bus
+from outbox import create_outbox
+from publisher import Publisher
+from retained import RetainedCache, ActuatorStates
+from timeseries import create_timeseries
+from serialization import decode
+from metrics import REGISTRY
 
 SERVER_ID_CHECKSUM = xor_checksum(SERVER_ID)
 
-EXCHANGE = 'gateway.exchange'
-QUEUE = 'gateway.queue'
+# the channel id byte every PUB payload starts with
+CHANNEL_IDS = [pack('B', channel_id) for channel_id in range(256)]
 
 LOGGER = logging.getLogger(__name__)
 
+HANDLE_SECONDS = REGISTRY.histogram('router_handle_seconds', 'Time to handle a packet from a client by packet type',
+                                    label_names=('type',))
+HANDLE_SECONDS_BY_TYPE = {packet_type: HANDLE_SECONDS.labels(packet_type.name) for packet_type in PacketTypes}
+TRANSFORM_SECONDS = REGISTRY.histogram('router_transform_seconds', 'Time to transform between payloads and messages',
+                                       label_names=('direction',))
+DECODE_SECONDS = TRANSFORM_SECONDS.labels('decode')
+ENCODE_SECONDS = TRANSFORM_SECONDS.labels('encode')
+MESSAGES_RECEIVED = REGISTRY.counter('router_messages_received_total', 'Messages received from the message bus')
+
 
 class Router():
     """Handle packets coming from the clients / message_queue and route them from/to the clients"""
 
-    def __init__(self):
-        self.connection = None
-        self.channel = None
-        self.exchange = None
-        self.queue = None
-        self.consumer = None
+    def __init__(self, bus=None, outbox=None):
+        self.bus = bus or create_bus()
+        self.bus.on_disconnect = self.connection_lost
         self.send_packet = None
-        self.subscription_channels = {}
-        self.publish_channels = {}
+        self.routes = RoutingTable()
+        self.bindings = BindingManager()
+        self.publisher = Publisher(outbox=outbox if outbox is not None else create_outbox())
+        self.retained = RetainedCache()
+        self.actuators = ActuatorStates(self.retained.stats)
+        self.timeseries = create_timeseries()
         self.transforms = {}
-        self.register_transform(0, SwitchTransform)
-        self.register_transform(1, TemperatureTransform)
+        for transform_id, transform in BUILTIN_TRANSFORMS.items():
+            self.register_transform(transform_id, transform)
+        for transform_id, transform in load_schemas(TRANSFORM_SCHEMAS_FILE).items():
+            self.register_transform(transform_id, transform)
 
-    def register_transform(self, transform_id, transform_class):
-        """Register a new transform class with the gateway"""
-        self.transforms[transform_id] = transform_class
+    def register_transform(self, transform_id, transform):
+        """Register a new transform with the gateway"""
+        self.transforms[transform_id] = transform
 
     def set_send_packet(self, send_packet):
         """Set the function to send a packet over the radio"""
@@ -44,28 +68,33 @@ class Router():
 
     @asyncio.coroutine
     def connect_to_message_queue(self):
-        """Connects to the amqp exchange and queue"""
-        def log_returned_message(message):
-            """Log when message has no handler in message queue"""
-            LOGGER.info("Nobody cared for {0} {1}".format(message.routing_key, message.json()))
-
-        self.connection = yield from asynqp.connect(
-            RABBITMQ_HOST,
-            RABBITMQ_PORT,
-            RABBITMQ_USERNAME,
-            RABBITMQ_PASSWORD,
-            RABBITMQ_VIRTUAL_HOST
-        )
-        self.channel = yield from self.connection.open_channel()
-        self.channel.set_return_handler(log_returned_message)
-        self.exchange = yield from self.channel.declare_exchange(EXCHANGE, 'topic')
-        self.queue = yield from self.channel.declare_queue(QUEUE, auto_delete=True)
-        self.consumer = yield from self.queue.consume(self.handle_message)
+        """Connects to the message bus and starts consuming, retries with a growing interval until it succeeds"""
+        interval = RECONNECT_INTERVAL
+        while True:
+            try:
+                yield from self.bus.connect()
+                yield from self.bus.consume(self.handle_message)
+                break
+            except Exception as error: # pylint: disable=broad-except
+                LOGGER.warning('Connecting to the message bus failed, retrying in {0}s: {1!r}'.format(interval, error))
+                yield from asyncio.sleep(interval)
+                interval = min(interval * 2, RECONNECT_INTERVAL_MAX)
+        self.bindings.attach(self.bus)
+        yield from self.bindings.rebind()
+        self.publisher.attach(self.bus)
+        if TIMESERIES_QUERY_KEY not in self.bindings.refcounts:
+            yield from self.bindings.acquire(TIMESERIES_QUERY_KEY)
+
+    def connection_lost(self):
+        """Called by the bus when it lost its connection"""
+        LOGGER.warning('Lost the connection to the message bus, reconnecting')
+        asyncio.async(self.connect_to_message_queue())
 
     @asyncio.coroutine
     def handle_packet(self, client_id, message_id, payload):
         """Handle a single packet from a nrf24 client"""
         LOGGER.info("Recieving packet type {0} from client {1}".format(message_id, client_id))
+        started_at = perf_counter()
         if message_id == PacketTypes.REGISTER:
             yield from self.handle_register_packet(client_id)
         if message_id == PacketTypes.PUB_CHANNEL:
@@ -73,17 +102,24 @@ class Router():
         if message_id == PacketTypes.SUB_CHANNEL:
             yield from self.handle_sub_channel_packet(client_id, payload)
         if message_id == PacketTypes.PUB:
-            self.handle_pub_packet(client_id, payload)
+            yield from self.handle_pub_packet(client_id, payload)
+        histogram = HANDLE_SECONDS_BY_TYPE.get(message_id)
+        if histogram is not None:
+            histogram.observe(perf_counter() - started_at)
+
+    def accepting_packets(self):
+        """If packets should be read from the radio, False while the publisher applies backpressure"""
+        return not self.publisher.blocked
 
     @asyncio.coroutine
     def handle_register_packet(self, client_id):
         """Handle registration packet"""
-        response = pack('B7sB', client_id, bytes(SERVER_ID), SERVER_ID_CHECKSUM)
+        response = pack('B7sB', local_client_id(client_id), bytes(SERVER_ID), SERVER_ID_CHECKSUM)
         self.clear_subscription_channels(client_id)
         self.clear_publish_channels(client_id)
         if self.send_packet:
             yield from asyncio.sleep(0.02)
-            self.send_packet(client_id, PacketTypes.REGISTER_SERVER_ACK, response)
+            self.send_packet(client_id, PacketTypes.REGISTER_SERVER_ACK, response, Priority.HIGH)
 
     @staticmethod
     def extract_channel_packet_data(payload):
@@ -106,16 +142,23 @@ class Router():
         routing_key, channel_id, transform_id = self.extract_channel_packet_data(payload)
         yield from self.add_subscription_channel(client_id, routing_key, channel_id, transform_id)
 
+    @asyncio.coroutine
     def handle_pub_packet(self, client_id, payload):
         """Route publish packet from client to message queue"""
-        if client_id in self.publish_channels:
+        channels = self.routes.get_publish_channels(client_id)
+        if channels is not None:
             channel_id, = unpack('B', payload[:1])
-            channel = next((c for c in self.publish_channels[client_id] if c['channel_id'] == channel_id), None)
+            channel = channels.get(channel_id)
             if channel:
                 transform = self.transforms[channel['transform_id']]
                 routing_key = channel['routing_key']
-                msg = asynqp.Message(transform.to_message(payload[1:]))
-                self.exchange.publish(msg, routing_key)
+                started_at = perf_counter()
+                message = transform.to_message(payload[1:])
+                DECODE_SECONDS.observe(perf_counter() - started_at)
+                self.retained.put(routing_key, message)
+                if self.timeseries is not None:
+                    self.timeseries.add(routing_key, message)
+                yield from self.publisher.publish(routing_key, message)
             else:
                 LOGGER.warning('Client {0} tried to publish message with unknown channel {1}'.format(
                     client_id,
@@ -127,17 +170,16 @@ class Router():
     @asyncio.coroutine
     def add_subscription_channel(self, client_id, routing_key, channel_id, transform_id):
         """Add subscription object so later messages can be routed correctly"""
-        subscription = {
-            'client_id': client_id,
-            'channel_id': channel_id,
-            'transform_id': transform_id
-        }
         if transform_id in self.transforms:
-            if routing_key in self.subscription_channels:
-                self.subscription_channels[routing_key].append(subscription)
-            else:
-                self.subscription_channels[routing_key] = [subscription]
-            yield from self.queue.bind(self.exchange, routing_key)
+            if self.routes.add_subscription(client_id, routing_key, channel_id, transform_id):
+                try:
+                    yield from self.bindings.acquire(routing_key)
+                except Exception: # pylint: disable=broad-except
+                    # the binding manager logged the failure, the next subscription to the key binds it again
+                    if self.routes.remove_subscription(client_id, routing_key, channel_id):
+                        self.bindings.release(routing_key)
+                    return
+                self.push_retained(client_id, routing_key, channel_id, transform_id)
         else:
             LOGGER.warning('Client {0} tried to register sub-channel {1} with unknown transform {2}'.format(
                 client_id,
@@ -147,22 +189,33 @@ class Router():
 
     def clear_subscription_channels(self, client_id):
         """Clear all subscriptions for a client after new registration"""
-        for routing_key in self.subscription_channels:
-            subscriptions = self.subscription_channels[routing_key]
-            self.subscription_channels[routing_key] = [s for s in subscriptions if s['client_id'] != client_id]
+        for routing_key in self.routes.clear_subscriptions(client_id):
+            self.bindings.release(routing_key)
+        self.actuators.clear(client_id)
+
+    def push_retained(self, client_id, routing_key, channel_id, transform_id):
+        """Send the most recent messages for a routing key (or pattern) to a new subscription channel"""
+        if not self.send_packet:
+            return
+        transform = self.transforms[transform_id]
+        for key, json in self.retained.match(routing_key):
+            try:
+                data = transform.to_packet(json)
+            except Exception: # pylint: disable=broad-except
+                LOGGER.exception('Transform {0} failed for message {1} {2}'.format(transform_id, key, json))
+                continue
+            self.send_to_channel(client_id, channel_id, transform, data)
+
+    def send_to_channel(self, client_id, channel_id, transform, data):
+        """Send data to a subscription channel, unless the client has it already"""
+        if self.actuators.changed(client_id, channel_id, data):
+            result = self.send_packet(client_id, PacketTypes.PUB, CHANNEL_IDS[channel_id] + data, transform.priority)
+            self.actuators.sent(client_id, channel_id, data, result)
 
     def add_publish_channel(self, client_id, routing_key, channel_id, transform_id):
         """Add a publish_channel object so later packets can be routed correctly"""
         if transform_id in self.transforms:
-            publish_channel = {
-                'routing_key': routing_key,
-                'channel_id': channel_id,
-                'transform_id': transform_id
-            }
-            if client_id in self.publish_channels:
-                self.publish_channels[client_id].append(publish_channel)
-            else:
-                self.publish_channels[client_id] = [publish_channel]
+            self.routes.add_publish_channel(client_id, routing_key, channel_id, transform_id)
         else:
             LOGGER.warning('Client {0} tried to register pub-channel {1} with unknown transform {2}'.format(
                 client_id,
@@ -172,18 +225,43 @@ class Router():
 
     def clear_publish_channels(self, client_id):
         """Clear all publish channels for a client after a new registration"""
-        if client_id in self.publish_channels:
-            self.publish_channels.pop(client_id)
+        self.routes.clear_publish_channels(client_id)
 
     def handle_message(self, message):
         """Handle message coming from rabbitmq and route them to the respective clients"""
         routing_key = message.routing_key
-        json = message.json()
+        json = decode(message.body, message.content_type)
         LOGGER.info("Receiving message %s %s", routing_key, json)
-        if routing_key in self.subscription_channels:
-            for channel in self.subscription_channels[routing_key]:
-                data = self.transforms[channel['transform_id']].to_packet(json)
-                channel_id = pack('B', channel['channel_id'])
-                payload = channel_id + data
-                if self.send_packet:
-                    self.send_packet(channel['client_id'], PacketTypes.PUB, payload)
+        MESSAGES_RECEIVED.inc()
+        if routing_key == TIMESERIES_QUERY_KEY:
+            self.answer_query(json)
+            return
+        self.retained.put(routing_key, json)
+        if not self.send_packet:
+            return
+        groups = OrderedDict()
+        for channel in self.routes.get_subscriptions(routing_key):
+            groups.setdefault(channel['transform_id'], []).append(channel)
+        for transform_id, channels in groups.items():
+            transform = self.transforms[transform_id]
+            started_at = perf_counter()
+            try:
+                data = transform.to_packet(json)
+            except Exception: # pylint: disable=broad-except
+                LOGGER.exception('Transform {0} failed for message {1} {2}'.format(transform_id, routing_key, json))
+                continue
+            ENCODE_SECONDS.observe(perf_counter() - started_at)
+            for channel in channels:
+                self.send_to_channel(channel['client_id'], channel['channel_id'], transform, data)
+
+    def answer_query(self, query):
+        """Publish the answer to a time series query to its reply_to routing key"""
+        reply_to = query.get('reply_to') if isinstance(query, dict) else None
+        if not reply_to:
+            LOGGER.warning('Time series query {0} has no reply_to routing key'.format(query))
+            return
+        if self.timeseries is None:
+            answer = {'error': 'Time series are not available'}
+        else:
+            answer = self.timeseries.query(query)
+        self.publisher.enqueue(reply_to, answer)
@@ -0,0 +1,89 @@
+"""Routing tables mapping client channels to routing keys and back"""
+
+from collections import OrderedDict
+from topics import TopicTrie
+
+
+class RoutingTable():
+    """Publish channels indexed by client and channel id, subscriptions indexed by routing key
+
+    A reverse index from client id to its (routing key, channel id) pairs allows tearing down a client without
+    looking at the subscriptions of everybody else. Routing keys without subscribers are dropped.
+
+    Subscribed routing keys may be AMQP topic patterns, the subscriptions for a message are found by matching its
+    routing key against the patterns in a topic trie.
+    """
+
+    def __init__(self):
+        self.publish_channels = {}
+        self.subscription_channels = {}
+        self.client_subscriptions = {}
+        self.topics = TopicTrie()
+
+    def add_publish_channel(self, client_id, routing_key, channel_id, transform_id):
+        """Add a publish channel, an existing channel with the same id is replaced"""
+        channels = self.publish_channels.setdefault(client_id, {})
+        channels[channel_id] = {
+            'routing_key': routing_key,
+            'channel_id': channel_id,
+            'transform_id': transform_id
+        }
+
+    def get_publish_channels(self, client_id):
+        """Get the publish channels of a client by channel id, None if it has none set up"""
+        return self.publish_channels.get(client_id)
+
+    def clear_publish_channels(self, client_id):
+        """Remove all publish channels of a client"""
+        self.publish_channels.pop(client_id, None)
+
+    def add_subscription(self, client_id, routing_key, channel_id, transform_id):
+        """Add a subscription, returns False if it only replaced an existing one of the client channel"""
+        subscriptions = self.subscription_channels.get(routing_key)
+        if subscriptions is None:
+            subscriptions = self.subscription_channels[routing_key] = OrderedDict()
+            self.topics.add(routing_key)
+        is_new = (client_id, channel_id) not in subscriptions
+        subscriptions[(client_id, channel_id)] = {
+            'client_id': client_id,
+            'channel_id': channel_id,
+            'transform_id': transform_id
+        }
+        self.client_subscriptions.setdefault(client_id, set()).add((routing_key, channel_id))
+        return is_new
+
+    def get_subscriptions(self, routing_key):
+        """Get all subscriptions matching the routing key of a message, every client channel is returned once even
+        if several of its patterns match"""
+        patterns = self.topics.match(routing_key)
+        if len(patterns) == 1:
+            return list(self.subscription_channels[patterns[0]].values())
+        subscriptions = OrderedDict()
+        for pattern in patterns:
+            subscriptions.update(self.subscription_channels[pattern])
+        return list(subscriptions.values())
+
+    def remove_subscription(self, client_id, routing_key, channel_id):
+        """Remove a single subscription, returns False if the client channel did not subscribe to the routing key"""
+        subscriptions = self.subscription_channels.get(routing_key)
+        if subscriptions is None or subscriptions.pop((client_id, channel_id), None) is None:
+            return False
+        self.client_subscriptions[client_id].discard((routing_key, channel_id))
+        if not self.client_subscriptions[client_id]:
+            del self.client_subscriptions[client_id]
+        if not subscriptions:
+            del self.subscription_channels[routing_key]
+            self.topics.remove(routing_key)
+        return True
+
+    def clear_subscriptions(self, client_id):
+        """Remove all subscriptions of a client, returns the routing key of every removed subscription"""
+        removed_keys = []
+        for routing_key, channel_id in self.client_subscriptions.pop(client_id, ()):
+            subscriptions = self.subscription_channels[routing_key]
+            del subscriptions[(client_id, channel_id)]
+            removed_keys.append(routing_key)
+            if not subscriptions:
+                del self.subscription_channels[routing_key]
+                self.topics.remove(routing_key)
+        return removed_keys
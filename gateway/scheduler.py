@@ -0,0 +1,204 @@
+"""Schedule packets that are sent to the clients, so bursts to one client can not starve the others"""
+
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from constants import PacketTypes, Priority
+from metrics import REGISTRY
+from settings import TX_AIRTIME_BUDGET, TX_AIRTIME_BURST, TX_BATCH_SIZE
+
+LOGGER = logging.getLogger(__name__)
+
+WAIT_SECONDS = REGISTRY.histogram('scheduler_wait_seconds', 'Time packets wait before they are sent')
+BATCH_SECONDS = REGISTRY.histogram('scheduler_batch_seconds', 'Time the radio needs to send a batch of packets')
+
+DATA_RATE = 250000
+# preamble, address, packet control field, payload and crc of a packet and its (empty) acknowledgement
+PACKET_AIRTIME = (1 + 5 + 2 + 32 + 2) * 8 / DATA_RATE
+ACK_AIRTIME = (1 + 5 + 2 + 2) * 8 / DATA_RATE
+# settling time of the radio when switching between rx and tx
+SETTLING_TIME = 0.00013
+ATTEMPT_AIRTIME = PACKET_AIRTIME + ACK_AIRTIME + 2 * SETTLING_TIME
+
+
+class QueuedPacket():
+    """A packet waiting to be sent, the future resolves to the success of the send"""
+    __slots__ = ('client_id', 'packet_id', 'payload', 'priority', 'future', 'queued_at')
+
+    def __init__(self, client_id, packet_id, payload, priority, future, queued_at):
+        # pylint: disable=too-many-arguments
+        self.client_id = client_id
+        self.packet_id = packet_id
+        self.payload = payload
+        self.priority = priority
+        self.future = future
+        self.queued_at = queued_at
+
+
+class AirtimeBudget():
+    """Token bucket over the airtime of the radio, refilled with budget seconds per second up to burst seconds"""
+
+    def __init__(self, loop, budget, burst):
+        self.loop = loop
+        self.budget = budget
+        self.burst = burst
+        self.airtime = burst
+        self.refilled_at = loop.time()
+
+    def delay(self):
+        """Refill the bucket, returns how long to wait until the next packet may be sent"""
+        now = self.loop.time()
+        self.airtime = min(self.burst, self.airtime + (now - self.refilled_at) * self.budget)
+        self.refilled_at = now
+        if self.airtime >= ATTEMPT_AIRTIME:
+            return 0
+        return (ATTEMPT_AIRTIME - self.airtime) / self.budget
+
+    def attempts(self, limit):
+        """How many packets may be sent right now, at most limit but at least one"""
+        return max(1, min(limit, int(self.airtime // ATTEMPT_AIRTIME)))
+
+    def charge(self, airtime):
+        """Take the airtime of sent packets out of the bucket"""
+        self.airtime -= airtime
+
+
+class TransmitStats():
+    """Queue depth and wait time metrics of the transmit scheduler"""
+
+    def __init__(self):
+        self.queued = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.conflated = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def as_dict(self):
+        """All metrics as dict"""
+        return dict(vars(self))
+
+
+class TransmitScheduler():
+    """Sits between the router and the radio and decides which packet is sent next
+
+    Every client has a queue per priority lane, the clients of a lane are served round robin and the high lane
+    always goes first. A PUB replaces a queued, unsent PUB for the same client and channel, because only the latest
+    value matters. Sending is paced by a token bucket over the estimated airtime of the packets, packets are handed to
+    the radio in batches of as many packets as the budget allows.
+    """
+
+    def __init__(self, send_packets, budget=TX_AIRTIME_BUDGET, burst=TX_AIRTIME_BURST, batch_size=TX_BATCH_SIZE):
+        self.send = send_packets
+        self.loop = asyncio.get_event_loop()
+        self.bucket = AirtimeBudget(self.loop, budget, burst)
+        self.batch_size = batch_size
+        self.lanes = {priority: OrderedDict() for priority in Priority}
+        self.conflatable = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.stats = TransmitStats()
+
+    def start(self):
+        """Start sending queued packets"""
+        self.task = asyncio.async(self.run())
+
+    def send_packet(self, client_id, packet_id, payload, priority=Priority.NORMAL):
+        """Queue a packet for a client, returns a future which resolves to the success of the send"""
+        conflation_key = (client_id, payload[0]) if packet_id == PacketTypes.PUB and payload else None
+        queued = self.conflatable.get(conflation_key)
+        if queued:
+            queued.payload = payload
+            self.stats.conflated += 1
+            return queued.future
+
+        queued = QueuedPacket(client_id, packet_id, payload, priority=priority, future=asyncio.Future(),
+                              queued_at=self.loop.time())
+        lane = self.lanes[priority]
+        if client_id not in lane:
+            lane[client_id] = deque()
+        lane[client_id].append(queued)
+        if conflation_key:
+            self.conflatable[conflation_key] = queued
+
+        self.stats.queued += 1
+        self.stats.max_depth = max(self.stats.max_depth, self.stats.queued)
+        self.wakeup.set()
+        return queued.future
+
+    def next_packet(self):
+        """Take the next packet out of the queues, None if there is nothing to send"""
+        for priority in sorted(self.lanes):
+            lane = self.lanes[priority]
+            if not lane:
+                continue
+            client_id, queue = next(iter(lane.items()))
+            queued = queue.popleft()
+            if queue:
+                lane.move_to_end(client_id)
+            else:
+                del lane[client_id]
+            if queued.packet_id == PacketTypes.PUB:
+                self.conflatable.pop((queued.client_id, queued.payload[0]), None)
+            self.stats.queued -= 1
+            return queued
+        return None
+
+    def next_batch(self):
+        """Take as many packets out of the queues as the airtime budget allows, but at least one"""
+        size = self.bucket.attempts(self.batch_size)
+        batch = []
+        while len(batch) < size:
+            queued = self.next_packet()
+            if queued is None:
+                break
+            batch.append(queued)
+        return batch
+
+    def airtime_delay(self):
+        """Refill the airtime budget, returns how long to wait until the next packet may be sent"""
+        return self.bucket.delay()
+
+    @asyncio.coroutine
+    def run(self):
+        """Send queued packets as long as the airtime budget allows it"""
+        while True:
+            if not self.stats.queued:
+                self.wakeup.clear()
+                yield from self.wakeup.wait()
+                continue
+            delay = self.airtime_delay()
+            if delay:
+                yield from asyncio.sleep(delay)
+                continue
+            yield from self.transmit(self.next_batch())
+
+    @asyncio.coroutine
+    def transmit(self, batch):
+        """Send a batch of packets and resolve their futures, retries make a send take longer than a single attempt
+        so the budget is charged with the time the radio was actually busy"""
+        started_at = self.loop.time()
+        for queued in batch:
+            wait_time = started_at - queued.queued_at
+            self.stats.wait_time_total += wait_time
+            self.stats.wait_time_max = max(self.stats.wait_time_max, wait_time)
+            WAIT_SECONDS.observe(wait_time)
+        try:
+            results = self.send([(queued.client_id, queued.packet_id, queued.payload) for queued in batch])
+            if isinstance(results, asyncio.Future) or asyncio.iscoroutine(results):
+                results = yield from results
+        except Exception: # pylint: disable=broad-except
+            LOGGER.exception("Sending {0} packets failed".format(len(batch)))
+            results = [False] * len(batch)
+
+        for queued, success in zip(batch, results):
+            if success:
+                self.stats.sent += 1
+            else:
+                self.stats.failed += 1
+            if not queued.future.cancelled():
+                queued.future.set_result(success)
+        busy_time = self.loop.time() - started_at
+        BATCH_SECONDS.observe(busy_time)
+        self.bucket.charge(max(len(batch) * ATTEMPT_AIRTIME, busy_time))
@@ -0,0 +1,127 @@
+"""Transforms described by a schema of the fields in the packet payload"""
+
+import json
+import logging
+from functools import lru_cache
+from struct import Struct
+from constants import Priority
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+LOGGER = logging.getLogger(__name__)
+
+FIELD_TYPES = {
+    'bool': '?',
+    'int8': 'b',
+    'uint8': 'B',
+    'int16': 'h',
+    'uint16': 'H',
+    'int32': 'i',
+    'uint32': 'I',
+    'float': 'f',
+    'double': 'd'
+}
+NUMPY_TYPES = {'?': 'b1', 'b': 'i1', 'B': 'u1', 'h': 'i2', 'H': 'u2', 'i': 'i4', 'I': 'u4', 'f': 'f4', 'd': 'f8'}
+BYTE_ORDERS = {'little': '<', 'big': '>'}
+
+
+@lru_cache(maxsize=None)
+def get_struct(format_string):
+    """Get the (cached) compiled struct for a format string"""
+    return Struct(format_string)
+
+
+class Field():
+    """A single value in the payload, the message contains raw * scale + offset"""
+    __slots__ = ('name', 'code', 'scale', 'offset')
+
+    def __init__(self, name, field_type, scale=1, offset=0):
+        if field_type not in FIELD_TYPES:
+            raise ValueError('Unknown field type {0} of field {1}'.format(field_type, name))
+        self.name = name
+        self.code = FIELD_TYPES[field_type]
+        self.scale = scale
+        self.offset = offset
+
+    @property
+    def scaled(self):
+        """If the raw value is scaled"""
+        return self.scale != 1 or self.offset != 0
+
+    def to_raw(self, value):
+        """Undo the scaling of a value"""
+        raw = (value - self.offset) / self.scale
+        return int(round(raw)) if self.code not in 'fd' else raw
+
+
+class SchemaTransform():
+    """Transform between packet payloads and dicts, compiled from a schema
+
+    The schema lists the fields of the payload in order, with name, type and optionally a scale and offset for
+    fixed point values, all fields share one byte order.
+    """
+
+    def __init__(self, schema):
+        self.name = schema.get('name')
+        self.priority = Priority[schema.get('priority', 'normal').upper()]
+        self.fields = [
+            Field(field['name'], field['type'], field.get('scale', 1), field.get('offset', 0))
+            for field in schema['fields']
+        ]
+        byte_order = schema.get('byte_order', 'little')
+        if byte_order not in BYTE_ORDERS:
+            raise ValueError('Unknown byte order {0}'.format(byte_order))
+        self.byte_order = BYTE_ORDERS[byte_order]
+        self.struct = get_struct(self.byte_order + ''.join(field.code for field in self.fields))
+        self.names = [field.name for field in self.fields]
+        self.scaled_fields = [field for field in self.fields if field.scaled]
+        self.dtype = None
+
+    def __repr__(self):
+        return 'SchemaTransform({0}, {1})'.format(self.name, self.struct.format)
+
+    def to_message(self, payload):
+        """Decode a packet payload to a dict"""
+        message = dict(zip(self.names, self.struct.unpack_from(payload)))
+        for field in self.scaled_fields:
+            message[field.name] = message[field.name] * field.scale + field.offset
+        return message
+
+    def to_packet(self, obj):
+        """Encode a dict to a packet payload"""
+        return self.struct.pack(*[
+            field.to_raw(obj[field.name]) if field.scaled else obj[field.name] for field in self.fields
+        ])
+
+    def to_messages(self, payloads):
+        """Decode many payloads at once with numpy, returns a dict of arrays with the values of every field"""
+        if numpy is None:
+            raise RuntimeError('Decoding payloads in batches needs numpy')
+        if self.dtype is None:
+            self.dtype = numpy.dtype([
+                (field.name, self.byte_order + NUMPY_TYPES[field.code]) for field in self.fields
+            ])
+        size = self.struct.size
+        if any(len(payload) < size for payload in payloads):
+            raise ValueError('All payloads need at least {0} bytes'.format(size))
+        records = numpy.frombuffer(b''.join(bytes(payload[:size]) for payload in payloads), dtype=self.dtype)
+        columns = {}
+        for field in self.fields:
+            column = records[field.name]
+            columns[field.name] = column * field.scale + field.offset if field.scaled else column
+        return columns
+
+
+def load_schemas(path):
+    """Load the schemas from a json file, returns the compiled transforms by transform id"""
+    if not path:
+        return {}
+    with open(path) as schema_file:
+        schemas = json.load(schema_file)
+    transforms = {}
+    for schema in schemas:
+        transform = transforms[int(schema['id'])] = SchemaTransform(schema)
+        LOGGER.info('Loaded transform {0} {1}'.format(schema['id'], transform))
+    return transforms
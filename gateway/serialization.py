@@ -0,0 +1,149 @@
+"""Encode and decode message bodies for the message queue"""
+
+import json
+import logging
+from math import isfinite
+from settings import MESSAGE_CONTENT_TYPES
+from topics import TopicTrie
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+LOGGER = logging.getLogger(__name__)
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+CBOR = 'application/cbor'
+
+
+def encode_float(value):
+    """Encode a float like the json module does"""
+    return repr(value) if isfinite(value) else json.dumps(value)
+
+
+VALUE_ENCODERS = {
+    bool: lambda value: 'true' if value else 'false',
+    int: int.__repr__,
+    float: encode_float,
+    str: json.dumps,
+    type(None): lambda value: 'null'
+}
+
+
+class JsonCodec():
+    """JSON with a fast path for flat objects, the keys of an object are encoded once per key layout"""
+    content_type = JSON
+
+    def __init__(self):
+        self.layouts = {}
+
+    def encode(self, obj):
+        """Encode an object, produces the same output as json.dumps"""
+        if not isinstance(obj, dict):
+            return json.dumps(obj).encode()
+        keys = tuple(obj)
+        layout = self.layouts.get(keys)
+        if layout is None:
+            if not all(isinstance(key, str) for key in keys):
+                # json.dumps turns other keys into strings, 1 becomes "1" and True becomes "true"
+                return json.dumps(obj).encode()
+            layout = self.layouts[keys] = [json.dumps(key) + ': ' for key in keys]
+        parts = []
+        for prefix, value in zip(layout, obj.values()):
+            encoder = VALUE_ENCODERS.get(type(value))
+            if encoder is None:
+                return json.dumps(obj).encode()
+            parts.append(prefix + encoder(value))
+        return ('{' + ', '.join(parts) + '}').encode()
+
+    @staticmethod
+    def decode(body):
+        """Decode a message body"""
+        return json.loads(body.decode())
+
+
+class MsgpackCodec():
+    """MessagePack, needs the msgpack package"""
+    content_type = MSGPACK
+
+    @staticmethod
+    def encode(obj):
+        """Encode an object"""
+        return msgpack.packb(obj, use_bin_type=True)
+
+    @staticmethod
+    def decode(body):
+        """Decode a message body"""
+        return msgpack.unpackb(body, raw=False)
+
+
+class CborCodec():
+    """CBOR, needs the cbor2 package"""
+    content_type = CBOR
+
+    @staticmethod
+    def encode(obj):
+        """Encode an object"""
+        return cbor2.dumps(obj)
+
+    @staticmethod
+    def decode(body):
+        """Decode a message body"""
+        return cbor2.loads(body)
+
+
+CODECS = {JSON: JsonCodec()}
+if msgpack:
+    CODECS[MSGPACK] = CODECS['application/x-msgpack'] = MsgpackCodec()
+if cbor2:
+    CODECS[CBOR] = CborCodec()
+
+
+def decode(body, content_type):
+    """Decode a message body by its content type, bodies without a (known) content type are assumed to be JSON"""
+    codec = CODECS.get(content_type)
+    if codec is None:
+        if content_type:
+            LOGGER.warning('Unknown content type {0}, decoding as JSON'.format(content_type))
+        codec = CODECS[JSON]
+    return codec.decode(body)
+
+
+def specificity(pattern):
+    """Sort key of topic patterns, the pattern with the fewest wildcards wins"""
+    words = pattern.split('.')
+    return words.count('#'), words.count('*'), -len(words)
+
+
+class MessageEncoder():
+    """Encodes message bodies with the content type configured for their routing key"""
+
+    def __init__(self, content_types=None):
+        self.content_types = {}
+        self.topics = TopicTrie()
+        self.cache = {}
+        for pattern, content_type in (MESSAGE_CONTENT_TYPES if content_types is None else content_types).items():
+            if content_type not in CODECS:
+                LOGGER.warning('Content type {0} for {1} is not available, using JSON'.format(content_type, pattern))
+                content_type = JSON
+            self.content_types[pattern] = content_type
+            self.topics.add(pattern)
+
+    def get_codec(self, routing_key):
+        """Get the codec for a routing key"""
+        codec = self.cache.get(routing_key)
+        if codec is None:
+            patterns = self.topics.match(routing_key)
+            content_type = self.content_types[min(patterns, key=specificity)] if patterns else JSON
+            codec = self.cache[routing_key] = CODECS[content_type]
+        return codec
+
+    def encode(self, routing_key, obj):
+        """Encode a message body for a routing key, returns the body and its content type"""
+        codec = self.get_codec(routing_key)
+        return codec.encode(obj), codec.content_type
@@ -10,9 +10,121 @@ PRESHARED_KEY = bytes([25, 123, 90, 174, 198, 145, 40, 33, 98, 90, 90, 111, 78,
 SERVER_ADDRESS = [0xf0, 0xf0, 0xf0, 0xf0, 0xe1]
 SERVER_ID = [random.randint(0, 255) for dummy in range(7)]
 
+RADIO_CE_PIN = 25
+RADIO_IRQ_PIN = 24
+# rf channel of the first radio, clients register on it
+RADIO_CHANNEL = 0x4c
+# The nrf24 modules of the gateway, each on its own spi device (csn), pins and rf channel. Clients are spread over
+# the radios when they register and follow the channel sent with the registration ack.
+RADIOS = [
+    {'spi_device': 0, 'ce_pin': RADIO_CE_PIN, 'irq_pin': RADIO_IRQ_PIN, 'channel': RADIO_CHANNEL},
+]
+# Seconds after which the packets of a client count half for the load of its radio
+CLIENT_LOAD_HALF_LIFE = 10 * 60
+# Seconds between two measurements of the airtime utilization of the radios
+RADIO_UTILIZATION_INTERVAL = 10
+# 'poll' to poll the radio on a timer, 'irq' to wait for the interrupt pin of the nrf24 module
+RADIO_RECEIVE_MODE = 'poll'
+# Run all radio io on a dedicated thread instead of the event loop
+RADIO_WORKER_THREAD = False
+
+# Number of counters behind the highest received one that are still accepted (out of order packets)
+REPLAY_WINDOW_SIZE = 64
+# Maximum number of counters a client may skip (lost packets) before it needs to register again
+REPLAY_MAX_JUMP = 1024
+
+# Share of the airtime the gateway may use for sending, the rest is left for receiving
+TX_AIRTIME_BUDGET = 0.5
+# Seconds of airtime that can be used for sending in a single burst
+TX_AIRTIME_BURST = 0.05
+# Maximum number of packets sent without switching the radio back to rx mode
+TX_BATCH_SIZE = 8
+
+# Seconds bind requests for routing keys are collected before they are sent to the broker together
+BINDING_WINDOW = 0.01
+# Seconds a routing key stays bound after its last subscriber left (clients re-subscribe when they register again)
+UNBIND_GRACE_PERIOD = 30
+
+# Maximum number of routing keys whose most recent message is kept and sent to clients when they subscribe
+RETAINED_CACHE_SIZE = 1024
+# Seconds the most recent message of a routing key is kept
+RETAINED_MAX_AGE = 24 * 60 * 60
+
+# Maximum number of messages waiting to be published
+PUBLISH_QUEUE_SIZE = 1024
+# What happens to a message when the publish queue is full: 'drop' it, 'conflate' it with a waiting message for the
+# same routing key (the oldest message is dropped if there is none) or 'block' until there is room, which stops
+# reading from the radio
+PUBLISH_POLICY = 'conflate'
+# Seconds to wait before publishing again after the exchange refused a message
+PUBLISH_RETRY_INTERVAL = 1.0
+# Bytes handed to the connection but not yet written to the broker above which publishing pauses, so a slow broker
+# fills the publish queue and the policy applies instead of the write buffer growing without limit
+PUBLISH_WRITE_BUFFER_LIMIT = 64 * 1024
+# Seconds between checks of the write buffer while publishing is paused
+PUBLISH_DRAIN_INTERVAL = 0.01
+# Content type of the messages published for a routing key (topic patterns allowed), all others are published as
+# 'application/json'. 'application/msgpack' and 'application/cbor' need the msgpack or cbor2 package.
+MESSAGE_CONTENT_TYPES = {}
+
+# Directory of the journal messages are written to while the message bus is unavailable or the publish queue is
+# full, they are published in order once the bus is back. None keeps messages in memory only.
+OUTBOX_DIRECTORY = None
+# Bytes of a single journal segment file
+OUTBOX_SEGMENT_SIZE = 1024 * 1024
+# Maximum bytes of all journal segments, the oldest segment is dropped when the journal grows beyond
+OUTBOX_MAX_SIZE = 64 * 1024 * 1024
+# Seconds messages are kept in the journal, older messages are dropped instead of published
+OUTBOX_MAX_AGE = 24 * 60 * 60
+
+# Json file with the schemas of additional transforms, a list of objects like
+# {"id": 2, "name": "light", "priority": "normal", "byte_order": "little",
+#  "fields": [{"name": "lux", "type": "uint16", "scale": 0.1}]}
+TRANSFORM_SCHEMAS_FILE = None
+
+# Directory for the memory mapped time series of the published messages, None keeps them in memory only. Keeping
+# time series needs numpy.
+TIMESERIES_DIRECTORY = None
+# Number of points kept per routing key by resolution in seconds, 0 are the raw readings and the others averages
+TIMESERIES_CAPACITIES = {0: 4096, 60: 24 * 60, 3600: 366 * 24}
+# Maximum number of routing keys with a time series
+TIMESERIES_MAX_SERIES = 256
+# Seconds between writing the memory mapped time series to disk, at most this much is lost on a power loss
+TIMESERIES_FLUSH_INTERVAL = 60
+# Routing key the gateway answers time series queries on, the answer is published to the reply_to key of the query
+TIMESERIES_QUERY_KEY = 'gateway.timeseries.query'
+
+# Port of the http endpoint serving the metrics of the gateway in the Prometheus text format, None to disable it
+# Listen on all interfaces with '0.0.0.0' to let a Prometheus server on another host scrape it
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+# Seconds between status messages with all metrics, None to not publish them
+METRICS_STATUS_INTERVAL = None
+METRICS_STATUS_KEY = 'gateway.status'
+
+# Seconds between the heartbeats measuring how late the event loop runs callbacks
+LOOP_LAG_INTERVAL = 0.1
+# Seconds the event loop may be blocked before the stack it is stuck in is logged
+LOOP_BLOCKED_THRESHOLD = 0.1
+# Stack samples per second of the profiler, which is started by SIGUSR1 or GET /profile?seconds=N on the metrics port
+PROFILER_RATE = 100
+# Serve GET /profile on the metrics port, anyone who can reach the port can keep the gateway busy with profiles
+PROFILER_ENDPOINT = False
+# Seconds a profile takes by default and at most
+PROFILER_DURATION = 10
+PROFILER_MAX_DURATION = 60
+# Directory profiles started by SIGUSR1 are written to, in the collapsed format of flamegraph.pl
+PROFILER_DIRECTORY = '/tmp'
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s;%(name)s;%(levelname)s;%(message)s')
 # logging.basicConfig(filename='/var/log/home-automation.log', level=logging.INFO)
 
+# 'amqp' to exchange messages through RabbitMQ, 'local' for a topic exchange within the gateway process
+MESSAGE_BUS = 'amqp'
+# Seconds to wait before connecting to the message bus again, doubled after every failed attempt up to the maximum
+RECONNECT_INTERVAL = 1.0
+RECONNECT_INTERVAL_MAX = 60.0
+
 RABBITMQ_HOST = 'localhost'
 RABBITMQ_PORT = 5672
 RABBITMQ_USERNAME = 'gateway'
@@ -0,0 +1,491 @@
+"""Simulated nrf24 modules and a fleet of virtual clients to load test the gateway without any hardware
+
+Run `python simulation.py --help` to drive a number of virtual clients against a gateway with a simulated radio and
+get a report about throughput, drops and end-to-end latency.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from struct import pack
+from constants import PacketTypes, RegisterFlags
+from crypto import CryptoEngine, xor_checksum
+from serialization import decode
+from settings import PRESHARED_KEY, SERVER_ADDRESS, RADIOS, RADIO_CHANNEL
+
+LOGGER = logging.getLogger(__name__)
+
+MAX_PAYLOAD_SIZE = 27
+RX_FIFO_DEPTH = 3
+# HomeAutomation::sendPacket calls write up to 10 times, the radio retransmits each write 10 times
+CLIENT_WRITE_ATTEMPTS = 10
+HARDWARE_RETRIES = 10
+REGISTRATION_TIMEOUT = 0.5
+TEMPERATURE_TRANSFORM = 1
+
+
+class MediumStats():
+    """What happened to the packets sent over the virtual medium"""
+
+    def __init__(self):
+        self.attempts = 0
+        self.delivered = 0
+        self.lost = 0
+        self.overflowed = 0
+
+    def as_dict(self):
+        """All counters as dict"""
+        return dict(vars(self))
+
+
+class Endpoint():
+    """Receiving side of a simulated radio: the channel it listens on, packets in flight, the rx fifo and the ack
+    payload"""
+
+    def __init__(self, channel=RADIO_CHANNEL):
+        self.channel = channel
+        self.in_flight = deque()
+        self.fifo = deque()
+        self.listening = True
+        self.ack_payload = None
+
+    def settle(self, now):
+        """Move all packets that arrived until now into the fifo"""
+        while self.in_flight and self.in_flight[0][0] <= now:
+            self.fifo.append(self.in_flight.popleft()[1])
+
+    def occupancy(self):
+        """Number of fifo slots that are taken or will be taken by packets in flight"""
+        return len(self.fifo) + len(self.in_flight)
+
+    def take_ack_payload(self):
+        """The ack payload is sent with the next acknowledgement only"""
+        ack_payload, self.ack_payload = self.ack_payload, None
+        return ack_payload
+
+
+class VirtualMedium():
+    """The air between simulated radios
+
+    Every transmission is lost with a probability (as is its acknowledgement), arrives after a latency and is not
+    acknowledged when the rx fifo of the receiver is full, like with auto-ack on the real modules. Only endpoints
+    listening on the channel of a transmission receive it, the channels do not interfere.
+    """
+
+    def __init__(self, loss=0.0, latency=0.0, fifo_depth=RX_FIFO_DEPTH, rng=None, clock=time.monotonic):
+        # pylint: disable=too-many-arguments
+        self.loss = loss
+        self.latency = latency
+        self.fifo_depth = fifo_depth
+        self.rng = rng or random.Random()
+        self.clock = clock
+        self.endpoints = {}
+        self.stats = MediumStats()
+
+    def attach(self, address, endpoint):
+        """Receive everything sent to an address on the channel of an endpoint"""
+        self.endpoints[(endpoint.channel, tuple(address))] = endpoint
+
+    def detach(self, address, endpoint):
+        """Stop receiving on the channel of an endpoint"""
+        if self.endpoints.get((endpoint.channel, tuple(address))) is endpoint:
+            del self.endpoints[(endpoint.channel, tuple(address))]
+
+    def transmit(self, address, data, attempts, channel=RADIO_CHANNEL):
+        """Send a packet with auto-ack, returns whether it was acknowledged and the ack payload that came with it"""
+        endpoint = self.endpoints.get((channel, tuple(address)))
+        delivered = False
+        for dummy in range(attempts):
+            self.stats.attempts += 1
+            if endpoint is None or not endpoint.listening:
+                continue
+            if self.rng.random() < self.loss:
+                self.stats.lost += 1
+                continue
+            if not delivered:
+                now = self.clock()
+                endpoint.settle(now)
+                if endpoint.occupancy() >= self.fifo_depth:
+                    self.stats.overflowed += 1
+                    continue
+                endpoint.in_flight.append((now + self.latency, bytes(data)))
+                self.stats.delivered += 1
+                delivered = True
+            if self.rng.random() < self.loss:
+                self.stats.lost += 1
+                continue
+            return True, endpoint.take_ack_payload()
+        return False, None
+
+
+class SimulatedNRF24():
+    """Stands in for nrf24.NRF24 on the gateway side and talks to a virtual medium instead of spi"""
+    BR_250KBPS = 2
+    PA_HIGH = 2
+    CRC_16 = 2
+
+    def __init__(self, medium):
+        self.medium = medium
+        self.endpoint = Endpoint()
+        self.writing_address = None
+        self.retries = 0
+
+    def begin(self, dummy_major, dummy_minor, dummy_ce_pin, dummy_irq_pin):
+        """Nothing to set up"""
+
+    def setRetries(self, dummy_delay, count): # pylint: disable=invalid-name
+        """Retransmissions per write"""
+        self.retries = count
+
+    def setPayloadSize(self, dummy_size): # pylint: disable=invalid-name
+        """Always 32 bytes"""
+
+    def setChannel(self, channel): # pylint: disable=invalid-name
+        """Listen and send on a channel, has to be called before the reading pipe is opened"""
+        self.endpoint.channel = channel
+
+    def setDataRate(self, dummy_rate): # pylint: disable=invalid-name
+        """The medium has no data rate"""
+
+    def setPALevel(self, dummy_level): # pylint: disable=invalid-name
+        """The medium has no range"""
+
+    def setCRCLength(self, dummy_length): # pylint: disable=invalid-name
+        """The medium does not corrupt packets"""
+
+    def setAutoAck(self, dummy_enable): # pylint: disable=invalid-name
+        """The medium always acknowledges"""
+
+    def enableAckPayload(self): # pylint: disable=invalid-name
+        """The medium always carries ack payloads"""
+
+    def printDetails(self): # pylint: disable=invalid-name
+        """Log the simulated setup"""
+        LOGGER.info("Simulated nrf24 with loss %s, latency %s and fifo depth %s",
+                    self.medium.loss, self.medium.latency, self.medium.fifo_depth)
+
+    def openReadingPipe(self, dummy_pipe, address): # pylint: disable=invalid-name
+        """Receive packets sent to an address"""
+        self.medium.attach(address, self.endpoint)
+
+    def openWritingPipe(self, address): # pylint: disable=invalid-name
+        """Send packets to an address"""
+        self.writing_address = address
+
+    def startListening(self): # pylint: disable=invalid-name
+        """Enter rx mode"""
+        self.endpoint.listening = True
+
+    def stopListening(self): # pylint: disable=invalid-name
+        """Leave rx mode, the real module flushes the ack payload from its tx fifo"""
+        self.endpoint.listening = False
+        self.endpoint.ack_payload = None
+
+    def writeAckPayload(self, dummy_pipe, data, length): # pylint: disable=invalid-name
+        """Load the payload for the next acknowledgement"""
+        self.endpoint.ack_payload = bytes(data[:length])
+
+    def available(self):
+        """Is a packet waiting in the rx fifo"""
+        self.endpoint.settle(self.medium.clock())
+        return bool(self.endpoint.fifo)
+
+    def read(self, buffer, length):
+        """Read the next packet from the rx fifo into buffer"""
+        buffer.extend(self.endpoint.fifo.popleft()[:length])
+
+    def write(self, data):
+        """Send a packet to the writing pipe"""
+        return self.medium.transmit(self.writing_address, data, self.retries + 1, self.endpoint.channel)[0]
+
+
+class Session():
+    """What a virtual client knows about its registration with the gateway, starts over with every registration"""
+
+    def __init__(self, counter=0):
+        self.client_id = 0
+        self.counter = counter
+        self.server_counter = 0
+        self.server_id = None
+        self.registered = False
+        self.publish_channels = 0
+        self.subscription_handlers = []
+
+
+class VirtualClient():
+    """A client that speaks the same protocol as arduino/HomeAutomation"""
+
+    def __init__(self, medium, address, key=PRESHARED_KEY, rng=None):
+        self.medium = medium
+        self.address = address
+        self.engine = CryptoEngine(key)
+        self.rng = rng or random.Random()
+        self.endpoint = Endpoint()
+        self.medium.attach(address, self.endpoint)
+        self.session = Session()
+
+    def send_packet(self, packet_type, payload):
+        """Encrypt and send a packet to the gateway, returns if it was acknowledged"""
+        session = self.session
+        padding = bytes(self.rng.randint(0, 255) for dummy in range(MAX_PAYLOAD_SIZE - len(payload)))
+        packet = pack('BBBB', session.counter >> 8, session.client_id, packet_type, len(payload)) + \
+            bytes(payload) + padding + pack('B', session.counter & 0xFF)
+        success, ack_payload = self.medium.transmit(SERVER_ADDRESS, self.engine.encrypt_packet(packet),
+                                                    CLIENT_WRITE_ATTEMPTS * (HARDWARE_RETRIES + 1),
+                                                    self.endpoint.channel)
+        if success and ack_payload and packet_type != PacketTypes.REGISTER:
+            self.check_server_id(ack_payload)
+        if success:
+            session.counter = (session.counter + 1) & 0xFFFF
+        return success
+
+    def check_server_id(self, ack_payload):
+        """Register again when the gateway restarted and has a new server id"""
+        server_id, checksum = ack_payload[:7], ack_payload[7]
+        if server_id != self.session.server_id and checksum == xor_checksum(server_id):
+            self.session.registered = False
+
+    def read_packet(self):
+        """Read and validate the next packet from the gateway, None if there is none"""
+        self.endpoint.settle(self.medium.clock())
+        if not self.endpoint.fifo:
+            return None
+        data = self.engine.decrypt_packet(self.endpoint.fifo.popleft())
+        received_counter = (data[0] << 8) | data[31]
+        client_id, packet_type, payload_size = data[1], data[2], min(data[3], MAX_PAYLOAD_SIZE)
+        if client_id != 0:
+            return None
+        if packet_type != PacketTypes.REGISTER_SERVER_ACK and \
+                not 0 < (received_counter - self.session.server_counter) & 0xFFFF <= 11:
+            return None
+        self.session.server_counter = received_counter
+        return packet_type, data[4:4 + payload_size]
+
+    def poll(self):
+        """Handle all packets the gateway sent"""
+        packet = self.read_packet()
+        while packet:
+            packet_type, payload = packet
+            handlers = self.session.subscription_handlers
+            if packet_type == PacketTypes.REGISTER_SERVER_ACK:
+                self.session.client_id = payload[0]
+                self.session.server_id = bytes(payload[1:8])
+                if len(payload) > 9:
+                    self.switch_channel(payload[9])
+                self.session.registered = True
+            elif packet_type == PacketTypes.PUB and payload and payload[0] < len(handlers):
+                handlers[payload[0]](payload[1:])
+            packet = self.read_packet()
+
+    def switch_channel(self, channel):
+        """Move to the channel of the radio the gateway assigned the client to"""
+        self.medium.detach(self.address, self.endpoint)
+        self.endpoint.channel = channel
+        self.medium.attach(self.address, self.endpoint)
+
+    def start_registration(self):
+        """Send the registration packet on the channel of the first radio, the gateway answers with the client id"""
+        self.switch_channel(RADIO_CHANNEL)
+        self.session = Session(self.rng.randint(0, 65535))
+        return self.send_packet(PacketTypes.REGISTER,
+                                bytes(self.address[::-1]) + bytes(2) + bytes([RegisterFlags.SWITCHES_CHANNEL]))
+
+    @asyncio.coroutine
+    def register(self, timeout=REGISTRATION_TIMEOUT):
+        """Register with the gateway and wait for the acknowledgement"""
+        if not self.start_registration():
+            return False
+        waited = 0
+        while not self.session.registered and waited < timeout:
+            yield from asyncio.sleep(0.005)
+            waited += 0.005
+            self.poll()
+        return self.session.registered
+
+    def publish_channel(self, routing_key, transform_id):
+        """Announce a channel the client publishes to, returns the channel id"""
+        channel_id = self.session.publish_channels
+        if self.send_packet(PacketTypes.PUB_CHANNEL, pack('BB', channel_id, transform_id) + routing_key.encode()):
+            self.session.publish_channels += 1
+        return channel_id
+
+    def subscribe_channel(self, routing_key, transform_id, handler):
+        """Subscribe to a routing key, the handler is called with the payload of every PUB for it"""
+        handlers = self.session.subscription_handlers
+        channel_id = len(handlers)
+        if self.send_packet(PacketTypes.SUB_CHANNEL, pack('BB', channel_id, transform_id) + routing_key.encode()):
+            handlers.append(handler)
+        return channel_id
+
+    def publish(self, channel_id, data):
+        """Publish data on a channel"""
+        return self.send_packet(PacketTypes.PUB, pack('B', channel_id) + bytes(data))
+
+
+class FleetStats():
+    """Throughput, drops and end-to-end latency of a simulation run"""
+
+    def __init__(self):
+        self.registrations = 0
+        self.registration_failures = 0
+        self.published = 0
+        self.send_failures = 0
+        self.sent_at = {}
+        self.latencies = []
+
+    def report(self, duration, medium_stats):
+        """Summary of the run"""
+        latencies = sorted(self.latencies)
+        def percentile(fraction):
+            """Latency percentile in milliseconds"""
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000 if latencies else 0
+        report = {
+            'registrations': self.registrations,
+            'registration_failures': self.registration_failures,
+            'published': self.published,
+            'received': len(latencies),
+            'send_failures': self.send_failures,
+            'dropped': self.published - len(latencies),
+            'throughput': len(latencies) / duration,
+            'latency_p50_ms': percentile(0.5),
+            'latency_p95_ms': percentile(0.95),
+            'latency_max_ms': latencies[-1] * 1000 if latencies else 0,
+        }
+        report.update(('medium_' + key, value) for key, value in medium_stats.as_dict().items())
+        return report
+
+
+class Recorder():
+    """Consumes the readings of the virtual clients from the bus and measures when they arrive"""
+
+    def __init__(self, stats, clock=time.monotonic):
+        self.stats = stats
+        self.clock = clock
+
+    def handle_message(self, message):
+        """Match the message to the reading that was sent"""
+        sequence = int(decode(message.body, message.content_type)['humidity'])
+        sent_at = self.stats.sent_at.pop((message.routing_key, sequence), None)
+        if sent_at is not None:
+            self.stats.latencies.append(self.clock() - sent_at)
+
+
+@asyncio.coroutine
+def run_client(client, stats, routing_key, rate, until):
+    """Register a virtual client and publish readings at a rate until the simulation ends"""
+    sequence = 0
+    channel_id = None
+    while time.monotonic() < until:
+        if not client.session.registered:
+            if (yield from client.register()):
+                stats.registrations += 1
+                channel_id = None
+            else:
+                stats.registration_failures += 1
+                yield from asyncio.sleep(client.rng.uniform(0, 1 / rate))
+            continue
+        if channel_id is None or client.session.publish_channels <= channel_id:
+            # the channel announcement got lost, like the arduino library it is simply sent again
+            channel_id = client.publish_channel(routing_key, TEMPERATURE_TRANSFORM)
+            if client.session.publish_channels <= channel_id:
+                yield from asyncio.sleep(client.rng.expovariate(rate))
+                continue
+
+        sequence += 1
+        stats.published += 1
+        stats.sent_at[(routing_key, sequence)] = time.monotonic()
+        if not client.publish(channel_id, pack('ff', 20.0, sequence)):
+            stats.send_failures += 1
+        client.poll()
+        yield from asyncio.sleep(client.rng.expovariate(rate))
+
+
+def start_gateway(loop, medium, radios, handle_reading):
+    """Run a gateway with simulated radios on the medium and a consumer of the published readings on the local bus,
+    returns the radio pool"""
+    os.environ.setdefault('SIMULATION', '1')
+    # pylint: disable=import-error
+    import gateway
+    from radio_pool import create_radio_pool
+    from router import Router
+    from bus import LocalBus
+
+    # every radio on its own channel, with a free channel between them
+    configs = [dict(RADIOS[0], spi_device=index, channel=RADIO_CHANNEL + 2 * index) for index in range(radios)]
+    pool = create_radio_pool(configs, [SimulatedNRF24(medium) for dummy in configs])
+    router = Router(LocalBus())
+    recorder = LocalBus(router.bus.exchange)
+    loop.run_until_complete(router.connect_to_message_queue())
+    loop.run_until_complete(recorder.connect())
+    loop.run_until_complete(recorder.consume(handle_reading))
+    loop.run_until_complete(recorder.bind('simulation.#'))
+    pool.start([radio.send_packets for radio in pool.radios])
+    router.set_send_packet(pool.send_packet)
+    gateway.poll(loop, pool, router)
+    return pool
+
+
+def run_fleet(loop, medium, options, rng, stats):
+    """Run the virtual clients until the duration is over"""
+    until = time.monotonic() + options.duration
+    fleet = [
+        VirtualClient(medium, [0xc0, 0x00, 0x00, index >> 8, index & 0xFF], rng=random.Random(rng.random()))
+        for index in range(options.clients)
+    ]
+    tasks = [
+        asyncio.async(run_client(client, stats, 'simulation.{0}.temperature'.format(index), options.rate, until))
+        for index, client in enumerate(fleet)
+    ]
+    loop.run_until_complete(asyncio.wait(tasks))
+
+
+def run_simulation(options):
+    """Run a gateway with simulated radios against a fleet of virtual clients, returns the report
+
+    The options are the ones of the command line, parse_args returns them with the defaults filled in.
+    """
+    loop = asyncio.get_event_loop()
+    rng = random.Random(options.seed)
+    medium = VirtualMedium(options.loss, options.latency, options.fifo_depth, rng)
+    stats = FleetStats()
+    pool = start_gateway(loop, medium, options.radios, Recorder(stats).handle_message)
+
+    run_fleet(loop, medium, options, rng, stats)
+    loop.run_until_complete(asyncio.sleep(0.1))
+
+    report = stats.report(options.duration, medium.stats)
+    pool.stop()
+    report['rx_fifo_overflows'] = sum(radio.rx_fifo_overflows for radio in pool.radios)
+    report['radio_clients'] = [count for dummy, count in pool.clients.loads(time.monotonic())]
+    report['radio_utilization'] = [round(radio.airtime() / options.duration, 3) for radio in pool.radios]
+    return report
+
+
+def parse_args(args=None):
+    """Options of the simulation, the ones that are not given have their defaults"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=10, help='number of virtual clients')
+    parser.add_argument('--rate', type=float, default=1.0, help='readings per second and client')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to run')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability that a transmission is lost')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds until a transmission arrives')
+    parser.add_argument('--fifo-depth', type=int, default=RX_FIFO_DEPTH, help='rx fifo depth of the gateway')
+    parser.add_argument('--seed', type=int, default=None, help='seed for reproducible runs')
+    parser.add_argument('--radios', type=int, default=1, help='number of radios of the gateway')
+    return parser.parse_args(args)
+
+
+def main():
+    """Command line interface of the simulation"""
+    options = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    report = run_simulation(options)
+    for key in sorted(report):
+        print('{0:24} {1}'.format(key, report[key]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""Keep the recent values of the published messages per routing key and answer queries about them"""
+
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+from urllib.parse import quote, unquote
+from settings import TIMESERIES_DIRECTORY, TIMESERIES_CAPACITIES, TIMESERIES_MAX_SERIES, TIMESERIES_FLUSH_INTERVAL
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+LOGGER = logging.getLogger(__name__)
+
+RAW = 0
+FIELDS_SUFFIX = '.json'
+# readings buffered per series before they are written to the rings, a query or flush writes them earlier
+FOLD_SIZE = 256
+
+
+def raw_dtype(size):
+    """Record of a single reading"""
+    return numpy.dtype([('time', 'f8'), ('value', 'f8', (size,))])
+
+
+def bucket_dtype(size):
+    """Record of all readings within a bucket of a downsampled resolution"""
+    return numpy.dtype([
+        ('time', 'f8'),
+        ('count', 'u4', (size,)),
+        ('sum', 'f8', (size,)),
+        ('min', 'f8', (size,)),
+        ('max', 'f8', (size,))
+    ])
+
+
+class Ring():
+    """Preallocated ring buffer of records ordered by time, optionally a memory mapped file
+
+    Rows that were never written have a time of NaN, so the position of the newest row can be recovered when the
+    file is opened again.
+    """
+
+    def __init__(self, dtype, capacity, path=None):
+        self.capacity = capacity
+        if path is None:
+            self.rows = numpy.zeros(capacity, dtype=dtype)
+            self.rows['time'] = numpy.nan
+        elif os.path.exists(path) and os.path.getsize(path) == dtype.itemsize * capacity:
+            self.rows = numpy.memmap(path, dtype=dtype, mode='r+', shape=(capacity,))
+        else:
+            self.rows = numpy.memmap(path, dtype=dtype, mode='w+', shape=(capacity,))
+            self.rows['time'] = numpy.nan
+        times = self.rows['time']
+        self.size = int(numpy.count_nonzero(~numpy.isnan(times)))
+        self.head = (int(numpy.nanargmax(times)) + 1) % capacity if self.size else 0
+
+    @property
+    def last(self):
+        """Index of the newest row, None if the ring is empty"""
+        return (self.head - 1) % self.capacity if self.size else None
+
+    @property
+    def oldest(self):
+        """Time of the oldest row"""
+        if not self.size:
+            return math.inf
+        return float(self.rows['time'][self.head % self.capacity if self.size == self.capacity else 0])
+
+    def extend(self, records):
+        """Append records, overwriting the oldest rows when the ring is full"""
+        records = records[-self.capacity:]
+        self.rows[(self.head + numpy.arange(len(records))) % self.capacity] = records
+        self.head = (self.head + len(records)) % self.capacity
+        self.size = min(self.size + len(records), self.capacity)
+
+    def select(self, start, end):
+        """Copy of the rows with start <= time < end, oldest first"""
+        if self.size == self.capacity:
+            rows = numpy.concatenate((self.rows[self.head:], self.rows[:self.head]))
+        else:
+            rows = self.rows[:self.size]
+        times = rows['time']
+        return numpy.array(rows[numpy.searchsorted(times, start):numpy.searchsorted(times, end)])
+
+    def flush(self):
+        """Write the changes of a memory mapped ring to disk"""
+        if isinstance(self.rows, numpy.memmap):
+            self.rows.flush()
+
+
+def fold_buckets(ring, buckets, values):
+    """Add readings to the buckets of a downsampled ring, buckets holds the start of the bucket of every reading in
+    ascending order"""
+    starts = numpy.flatnonzero(numpy.concatenate(([True], buckets[1:] != buckets[:-1])))
+    present = ~numpy.isnan(values)
+    records = numpy.zeros(len(starts), dtype=ring.rows.dtype)
+    records['time'] = buckets[starts]
+    records['count'] = numpy.add.reduceat(present.astype('u4'), starts)
+    records['sum'] = numpy.add.reduceat(numpy.where(present, values, 0.0), starts)
+    records['min'] = numpy.fmin.reduceat(values, starts)
+    records['max'] = numpy.fmax.reduceat(values, starts)
+    last = ring.last
+    if last is not None and ring.rows['time'][last] == records['time'][0]:
+        row = ring.rows[last]
+        row['count'] += records['count'][0]
+        row['sum'] += records['sum'][0]
+        row['min'] = numpy.fmin(row['min'], records['min'][0])
+        row['max'] = numpy.fmax(row['max'], records['max'][0])
+        records = records[1:]
+    ring.extend(records)
+
+
+def to_list(values):
+    """Convert an array to a list, NaN becomes None"""
+    return [None if math.isnan(value) else value for value in values.tolist()]
+
+
+class TimeSeries():
+    """Readings of a routing key at the raw resolution and downsampled to buckets of the other resolutions
+
+    Adding a reading only appends it to a list, the router adds one for every PUB packet. The readings are written to
+    the rings in batches, once FOLD_SIZE of them are buffered or before the rings are read or flushed.
+    """
+
+    def __init__(self, fields, capacities, path=None):
+        self.fields = fields
+        self.pending = []
+        self.rings = {}
+        for resolution, capacity in sorted(capacities.items()):
+            dtype = raw_dtype(len(fields)) if resolution == RAW else bucket_dtype(len(fields))
+            ring_path = '{0}.{1}'.format(path, resolution) if path else None
+            self.rings[resolution] = Ring(dtype, capacity, ring_path)
+
+    def add(self, timestamp, message):
+        """Add the values of a message"""
+        self.pending.append((timestamp, [message.get(field) for field in self.fields]))
+        if len(self.pending) >= FOLD_SIZE:
+            self.fold()
+
+    def fold(self):
+        """Write the buffered readings to the rings"""
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        times = numpy.array([timestamp for timestamp, dummy in pending], dtype='f8')
+        values = numpy.array([
+            [float(value) if isinstance(value, (int, float)) else numpy.nan for value in readings]
+            for dummy, readings in pending
+        ], dtype='f8').reshape(len(pending), len(self.fields))
+        for resolution, ring in self.rings.items():
+            # the clock went back, keep the rows ordered
+            ring_times = numpy.maximum.accumulate(times)
+            if ring.last is not None:
+                ring_times = numpy.maximum(ring_times, ring.rows['time'][ring.last])
+            if resolution == RAW:
+                records = numpy.zeros(len(pending), dtype=ring.rows.dtype)
+                records['time'] = ring_times
+                records['value'] = values
+                ring.extend(records)
+            else:
+                fold_buckets(ring, ring_times - ring_times % resolution, values)
+
+    def resolution_for(self, start):
+        """The finest resolution which still has the readings since start"""
+        for resolution, ring in self.rings.items():
+            if ring.size < ring.capacity or ring.oldest <= start:
+                return resolution
+        return max(self.rings)
+
+    def range(self, start, end, resolution=None):
+        """Readings (or bucket averages) between start and end"""
+        self.fold()
+        resolution = self.resolution_for(start) if resolution is None else resolution
+        rows = self.rings[resolution].select(start, end)
+        if resolution == RAW:
+            values = rows['value']
+        else:
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                values = rows['sum'] / rows['count']
+        return {
+            'resolution': resolution,
+            'time': rows['time'].tolist(),
+            'values': {field: to_list(values[:, index]) for index, field in enumerate(self.fields)}
+        }
+
+    def aggregate(self, start, end, resolution=None):
+        """Count, minimum, maximum and mean of every field between start and end"""
+        self.fold()
+        resolution = self.resolution_for(start) if resolution is None else resolution
+        rows = self.rings[resolution].select(start, end)
+        if resolution == RAW:
+            values = rows['value']
+            present = ~numpy.isnan(values)
+            count = present.sum(axis=0)
+            total = numpy.where(present, values, 0.0).sum(axis=0)
+            minimum, maximum = values, values
+        else:
+            count, total = rows['count'].sum(axis=0), rows['sum'].sum(axis=0)
+            minimum, maximum = rows['min'], rows['max']
+        aggregates = {}
+        for index, field in enumerate(self.fields):
+            field_count = int(count[index]) if len(rows) else 0
+            aggregates[field] = {
+                'count': field_count,
+                'min': float(numpy.nanmin(minimum[:, index])) if field_count else None,
+                'max': float(numpy.nanmax(maximum[:, index])) if field_count else None,
+                'mean': float(total[index]) / field_count if field_count else None
+            }
+        return {'resolution': resolution, 'aggregates': aggregates}
+
+    def flush(self):
+        """Write the buffered readings to the rings and the memory mapped rings to disk"""
+        self.fold()
+        for ring in self.rings.values():
+            ring.flush()
+
+
+class TimeSeriesStore():
+    """Time series of the numeric fields of the messages per routing key
+
+    With a directory, the rings are memory mapped files that survive restarts of the gateway, the fields of every
+    routing key are kept next to them. The fields of a routing key are the numeric ones of its first message.
+    """
+
+    def __init__(self, directory=TIMESERIES_DIRECTORY, capacities=None, max_series=TIMESERIES_MAX_SERIES):
+        self.directory = directory
+        self.capacities = TIMESERIES_CAPACITIES if capacities is None else capacities
+        self.max_series = max_series
+        self.series = {}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.load()
+
+    def __len__(self):
+        return len(self.series)
+
+    def path(self, routing_key):
+        """Path prefix of the files of a routing key"""
+        return os.path.join(self.directory, quote(routing_key, safe=''))
+
+    def load(self):
+        """Open the time series of an earlier run"""
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(FIELDS_SUFFIX) and len(self.series) < self.max_series:
+                routing_key = unquote(name[:-len(FIELDS_SUFFIX)])
+                with open(os.path.join(self.directory, name)) as fields_file:
+                    fields = json.load(fields_file)
+                self.series[routing_key] = TimeSeries(fields, self.capacities, self.path(routing_key))
+
+    def create(self, routing_key, message):
+        """Create the time series of a routing key, None if there are too many or the message has no numbers"""
+        if len(self.series) >= self.max_series:
+            return None
+        fields = sorted(key for key, value in message.items() if isinstance(value, (int, float)))
+        if not fields:
+            return None
+        path = None
+        if self.directory:
+            path = self.path(routing_key)
+            with open(path + FIELDS_SUFFIX, 'w') as fields_file:
+                json.dump(fields, fields_file)
+        series = self.series[routing_key] = TimeSeries(fields, self.capacities, path)
+        return series
+
+    def add(self, routing_key, message, timestamp=None):
+        """Add a message to the time series of its routing key"""
+        if not isinstance(message, dict):
+            return
+        series = self.series.get(routing_key)
+        if series is None:
+            series = self.create(routing_key, message)
+            if series is None:
+                return
+        series.add(time.time() if timestamp is None else timestamp, message)
+
+    def query(self, request):
+        """Answer a query like {"routing_key": "house.kitchen.temperature", "start": 1500000000, "end": 1500003600,
+        "resolution": 60, "aggregate": true}, start and end default to the last hour and now, the resolution to the
+        finest one that has all readings"""
+        routing_key = request.get('routing_key')
+        series = self.series.get(routing_key) if isinstance(routing_key, str) else None
+        if series is None:
+            return {'error': 'Unknown routing key {0}'.format(routing_key)}
+        resolution = request.get('resolution')
+        if resolution is not None and (not isinstance(resolution, (int, float)) or resolution not in series.rings):
+            return {'error': 'Unknown resolution {0}'.format(resolution)}
+        try:
+            end = float(request.get('end', time.time()))
+            start = float(request.get('start', end - 3600))
+        except (TypeError, ValueError):
+            return {'error': 'Start and end have to be timestamps'}
+        if request.get('aggregate'):
+            return series.aggregate(start, end, resolution)
+        return series.range(start, end, resolution)
+
+    def flush(self):
+        """Write the memory mapped time series to disk"""
+        for series in self.series.values():
+            series.flush()
+
+
+@asyncio.coroutine
+def flush_periodically(store, interval=TIMESERIES_FLUSH_INTERVAL):
+    """Write the memory mapped time series to disk every interval seconds, the kernel might not until shutdown"""
+    while True:
+        yield from asyncio.sleep(interval)
+        store.flush()
+
+
+def create_timeseries():
+    """Create the time series store, None without numpy"""
+    if numpy is None:
+        LOGGER.info('Not keeping time series, they need numpy')
+        return None
+    return TimeSeriesStore()
@@ -0,0 +1,105 @@
+"""Match routing keys against AMQP topic patterns"""
+
+MATCH_CACHE_SIZE = 4096
+
+
+class TopicNode():
+    """Node of the topic trie, one per word of a pattern"""
+    __slots__ = ('children', 'pattern', 'is_hash')
+
+    def __init__(self, is_hash=False):
+        self.children = {}
+        self.pattern = None
+        self.is_hash = is_hash
+
+
+class TopicTrie():
+    """Trie of topic patterns, where * matches exactly one word and # matches zero or more words
+
+    All patterns are matched in one pass over the words of a routing key. The result for a routing key is memoized
+    until the set of patterns changes.
+    """
+
+    def __init__(self, cache_size=MATCH_CACHE_SIZE):
+        self.root = TopicNode()
+        self.patterns = set()
+        self.cache = {}
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, pattern):
+        return pattern in self.patterns
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def add(self, pattern):
+        """Add a pattern to the trie"""
+        if pattern in self.patterns:
+            return
+        node = self.root
+        for word in pattern.split('.'):
+            child = node.children.get(word)
+            if child is None:
+                child = node.children[word] = TopicNode(word == '#')
+            node = child
+        node.pattern = pattern
+        self.patterns.add(pattern)
+        self.cache.clear()
+
+    def remove(self, pattern):
+        """Remove a pattern from the trie and prune the nodes nobody needs anymore"""
+        if pattern not in self.patterns:
+            return
+        path = [self.root]
+        words = pattern.split('.')
+        for word in words:
+            path.append(path[-1].children[word])
+        path[-1].pattern = None
+        for word, parent, node in zip(reversed(words), reversed(path[:-1]), reversed(path)):
+            if node.children or node.pattern is not None:
+                break
+            del parent.children[word]
+        self.patterns.discard(pattern)
+        self.cache.clear()
+
+    def match(self, routing_key):
+        """Get all patterns matching a routing key"""
+        matches = self.cache.get(routing_key)
+        if matches is not None:
+            self.hits += 1
+            return matches
+        self.misses += 1
+
+        nodes = self.expand({self.root})
+        for word in routing_key.split('.'):
+            if not nodes:
+                break
+            next_nodes = set()
+            for node in nodes:
+                if node.is_hash:
+                    next_nodes.add(node)
+                for key in (word, '*'):
+                    child = node.children.get(key)
+                    if child is not None:
+                        next_nodes.add(child)
+            nodes = self.expand(next_nodes)
+
+        matches = tuple(sorted(node.pattern for node in nodes if node.pattern is not None))
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[routing_key] = matches
+        return matches
+
+    @staticmethod
+    def expand(nodes):
+        """Add the # children of the nodes, as they also match zero words"""
+        expanded = set()
+        while nodes:
+            node = nodes.pop()
+            expanded.add(node)
+            child = node.children.get('#')
+            if child is not None and child not in expanded:
+                nodes.add(child)
+        return expanded
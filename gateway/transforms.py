@@ -1,36 +1,27 @@
-# pylint: disable=no-init
-
 """All transforms from packets to dict and vice versa"""
 
-from struct import pack, unpack
-
-class SwitchTransform:
-    """Transform for a switch type client which just has a on/off state"""
-    @staticmethod
-    def to_message(payload):
-        """Use first byte of payload as boolean"""
-        status = unpack('?', payload[:1])[0]
-        return {
-            'status': status
-        }
+from schemas import SchemaTransform
 
-    @staticmethod
-    def to_packet(obj):
-        """Use first byte of payload as the status"""
-        return pack('?', obj['status'])
+# Switch type client which just has a on/off state
+SwitchTransform = SchemaTransform({ # pylint: disable=invalid-name
+    'name': 'switch',
+    'priority': 'high',
+    'fields': [
+        {'name': 'status', 'type': 'bool'}
+    ]
+})
 
-class TemperatureTransform:
-    """Transform for a temperature type client which has temperature, humidity and dewpoint"""
-    @staticmethod
-    def to_message(payload):
-        """Use first byte of payload as boolean"""
-        temperature, humidity = unpack('ff', payload[:8])
-        return {
-            'temperature': temperature,
-            'humidity': humidity
-        }
+# Temperature type client which has temperature and humidity
+TemperatureTransform = SchemaTransform({ # pylint: disable=invalid-name
+    'name': 'temperature',
+    'priority': 'normal',
+    'fields': [
+        {'name': 'temperature', 'type': 'float'},
+        {'name': 'humidity', 'type': 'float'}
+    ]
+})
 
-    @staticmethod
-    def to_packet(obj):
-        """Use first byte of payload as the status"""
-        return pack('ff', obj['temperature'], obj['humidity'])
+BUILTIN_TRANSFORMS = {
+    0: SwitchTransform,
+    1: TemperatureTransform
+}
@@ -6,3 +6,7 @@ pylint --rcfile=.pylintrc gateway/*.py
 pylint --rcfile=test/.pylintrc test/gateway/*.py
 TEST_ENV=1 coverage run -m unittest discover -s test/gateway -p 'test_*.py'
 coverage report --fail-under 95
+# compare the hot paths with the baseline taken on this machine by test/benchmark/benchmark_hot_paths.py --save
+if [ -n "$BENCHMARK" ]; then
+    python test/benchmark/benchmark_hot_paths.py
+fi
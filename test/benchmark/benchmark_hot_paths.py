@@ -0,0 +1,281 @@
+"""Benchmark the hot paths of the gateway at realistic scales and compare them with a stored baseline
+
+Covers decrypting packets, reading packets from the radio, routing PUB packets to the message bus (with and without
+keeping their time series) and fanning out messages from the bus to subscribed clients. Everything runs offline with
+the simulated radio and the local bus.
+
+Run with: python test/benchmark/benchmark_hot_paths.py [--save] [--threshold 0.2]
+
+Without --save the results are compared with the baseline and the exit status is 1 if any benchmark got slower by
+more than the threshold, or if there is no baseline for it. Baselines only compare well on the machine they were taken
+on, so they are not committed: take one there with --save before changing the code, test.sh then compares with it
+when it runs with BENCHMARK=1.
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+from collections import OrderedDict
+from functools import partial
+from os import path
+from struct import pack
+
+sys.path.append(path.realpath(path.join(path.dirname(__file__), '../../gateway/')))
+os.environ.setdefault('TEST_ENV', '1')
+
+# pylint: disable=import-error,wrong-import-position
+from bus import LocalBus, LocalMessage
+from constants import PacketTypes
+from crypto import CryptoEngine, decrypt_packet
+from radio import Radio
+from router import Router
+from serialization import MessageEncoder
+from settings import PRESHARED_KEY
+from simulation import SimulatedNRF24, VirtualMedium
+from timeseries import TimeSeriesStore, numpy
+
+BASELINE = path.join(path.dirname(path.realpath(__file__)), 'baseline.json')
+CLIENTS = 254
+ROUTING_KEYS = 5000
+CHANNELS_PER_CLIENT = 8
+BURST = 1000
+TEMPERATURE_TRANSFORM = 1
+MAX_PAYLOAD_SIZE = 27
+
+
+def routing_key(index):
+    """Routing key of a sensor"""
+    return 'house.room{0}.sensor{1}.temperature'.format(index // 16, index % 16)
+
+
+def encrypted_pub_packets(rng, number, clients=CLIENTS):
+    """A burst of encrypted PUB packets from all clients, their counters count up from 1"""
+    engine = CryptoEngine(PRESHARED_KEY)
+    counters = [0] * (clients + 1)
+    packets = []
+    for dummy in range(number):
+        client_id = rng.randint(1, clients)
+        counters[client_id] += 1
+        counter = counters[client_id]
+        payload = pack('<Bff', rng.randrange(CHANNELS_PER_CLIENT), rng.uniform(15, 25), rng.uniform(30, 60))
+        packet = pack('BBBB', counter >> 8, client_id, PacketTypes.PUB, len(payload)) + payload + \
+            bytes(MAX_PAYLOAD_SIZE - len(payload)) + pack('B', counter & 0xFF)
+        packets.append(engine.encrypt_packet(packet))
+    return packets
+
+
+def setup_decrypt_packet(rng):
+    """Decrypt a burst of packets as read from the radio"""
+    packets = [list(packet) for packet in encrypted_pub_packets(rng, BURST)]
+    def run():
+        """Decrypt all packets"""
+        for packet in packets:
+            decrypt_packet(packet)
+    return BURST, run
+
+
+def setup_radio_get_packet(rng):
+    """Read a burst of packets of all clients from the rx fifo of the simulated radio"""
+    radio = Radio(SimulatedNRF24(VirtualMedium(rng=rng)))
+    for client_id in range(1, CLIENTS + 1):
+        radio.clients.register(client_id, [0xc0, 0, 0, 0, client_id], 0, 0)
+    radio.nrf24.endpoint.fifo.extend(encrypted_pub_packets(rng, BURST))
+    def run():
+        """Read packets until the fifo is empty"""
+        while radio.get_packet():
+            pass
+    return BURST, run
+
+
+def create_router(loop, timeseries=None):
+    """A router on the local bus that hands packets for the radio to a list, time series are only kept in a store
+    passed in"""
+    router = Router(LocalBus())
+    router.timeseries = timeseries
+    sent = []
+    router.set_send_packet(lambda *packet: sent.append(packet))
+    loop.run_until_complete(router.connect_to_message_queue())
+    return router
+
+
+@asyncio.coroutine
+def drain(router):
+    """Run the event loop until the publisher handed all messages to the bus"""
+    while router.publisher.pending:
+        yield from asyncio.sleep(0)
+
+
+def setup_router_handle_pub_packet(rng, timeseries=False):
+    """Route a burst of PUB packets of all clients to the bus, including publishing them and optionally keeping their
+    time series in memory, a first burst warms up the caches and creates the time series like on a gateway that has
+    been running for a while"""
+    loop = asyncio.get_event_loop()
+    router = create_router(loop, TimeSeriesStore(directory=None) if timeseries else None)
+    for client_id in range(1, CLIENTS + 1):
+        for channel_id in range(CHANNELS_PER_CLIENT):
+            router.add_publish_channel(client_id, routing_key(rng.randrange(ROUTING_KEYS)), channel_id,
+                                       TEMPERATURE_TRANSFORM)
+    packets = [
+        (rng.randint(1, CLIENTS), pack('<Bff', rng.randrange(CHANNELS_PER_CLIENT), rng.uniform(15, 25), 50.0))
+        for dummy in range(BURST)
+    ]
+    @asyncio.coroutine
+    def burst():
+        """Handle all packets"""
+        for client_id, payload in packets:
+            yield from router.handle_pub_packet(client_id, payload)
+        yield from drain(router)
+    loop.run_until_complete(burst())
+    return BURST, lambda: loop.run_until_complete(burst())
+
+
+def subscribe(loop, router, subscriptions):
+    """Set up subscription channels for (client id, channel id, routing key), concurrently like the clients do"""
+    loop.run_until_complete(asyncio.gather(*(
+        router.add_subscription_channel(client_id, key, channel_id, TEMPERATURE_TRANSFORM)
+        for client_id, channel_id, key in subscriptions
+    )))
+
+
+def temperature_messages(rng, keys):
+    """Encoded messages for the routing keys, all with different values so none is suppressed"""
+    encoder = MessageEncoder()
+    messages = []
+    for key in keys:
+        body, content_type = encoder.encode(key, {'temperature': rng.uniform(15, 25), 'humidity': 50.0})
+        messages.append(LocalMessage(key, body, content_type))
+    return messages
+
+
+def setup_router_handle_message(rng):
+    """Route a burst of messages for thousands of routing keys to the subscribed clients"""
+    loop = asyncio.get_event_loop()
+    router = create_router(loop)
+    subscribe(loop, router, [
+        (client_id, channel_id, routing_key(rng.randrange(ROUTING_KEYS)))
+        for client_id in range(1, CLIENTS + 1) for channel_id in range(CHANNELS_PER_CLIENT)
+    ])
+    messages = temperature_messages(rng, [routing_key(rng.randrange(ROUTING_KEYS)) for dummy in range(BURST)])
+    def run():
+        """Handle all messages"""
+        for message in messages:
+            router.handle_message(message)
+    return BURST, run
+
+
+def setup_router_fan_out(rng):
+    """Route messages for a routing key every client subscribed to, per message"""
+    loop = asyncio.get_event_loop()
+    router = create_router(loop)
+    subscribe(loop, router, [(client_id, 0, 'house.alarm') for client_id in range(1, CLIENTS + 1)])
+    messages = temperature_messages(rng, ['house.alarm'] * (BURST // 4))
+    def run():
+        """Handle all messages"""
+        for message in messages:
+            router.handle_message(message)
+    return len(messages), run
+
+
+BENCHMARKS = OrderedDict([
+    ('decrypt_packet', setup_decrypt_packet),
+    ('radio_get_packet', setup_radio_get_packet),
+    ('router_handle_pub_packet', setup_router_handle_pub_packet),
+    ('router_handle_message', setup_router_handle_message),
+    ('router_fan_out_{0}_clients'.format(CLIENTS), setup_router_fan_out),
+])
+if numpy is not None:
+    BENCHMARKS['router_handle_pub_packet_timeseries'] = partial(setup_router_handle_pub_packet, timeseries=True)
+
+
+def measure(setup, repeat):
+    """Best time of repeat runs in microseconds per operation, every run gets a fresh setup
+
+    Like timeit, the garbage collector is off while a run is timed.
+    """
+    best = float('inf')
+    for index in range(repeat):
+        number, run = setup(random.Random(index))
+        gc.collect()
+        gc.disable()
+        try:
+            started_at = time.perf_counter()
+            run()
+            best = min(best, (time.perf_counter() - started_at) / number * 1e6)
+        finally:
+            gc.enable()
+    return best
+
+
+def compare(results, baseline, threshold):
+    """Print the results next to the baseline, returns the names of the benchmarks that regressed or have no
+    baseline"""
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            print('{0:36} {1:10.3f}us  (no baseline)'.format(name, result))
+            regressions.append(name)
+            continue
+        change = result / reference - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print('{0:36} {1:10.3f}us  baseline {2:10.3f}us  {3:+7.1%}{4}'.format(
+            name, result, reference, change, '  REGRESSION' if regressed else ''
+        ))
+    return regressions
+
+
+def main():
+    """Run the benchmarks, save them as baseline or compare them with it"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--baseline', default=BASELINE, help='json file with the baseline results')
+    parser.add_argument('--save', action='store_true', help='store the results as new baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown, 0.2 fails at 20%% slower')
+    parser.add_argument('--repeat', type=int, default=10, help='runs per benchmark, the best one counts')
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run, all by default')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks {0}, choose from {1}'.format(
+            ', '.join(sorted(unknown)), ', '.join(BENCHMARKS)
+        ))
+
+    if not args.save and not path.exists(args.baseline):
+        print('There is no baseline at {0}, take one with --save'.format(args.baseline))
+        return 1
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = OrderedDict(
+        (name, measure(setup, args.repeat)) for name, setup in BENCHMARKS.items()
+        if not args.benchmarks or name in args.benchmarks
+    )
+
+    if args.save:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': results},
+                      baseline_file, indent=2)
+        for name, result in results.items():
+            print('{0:36} {1:10.3f}us'.format(name, result))
+        print('Saved baseline to {0}'.format(args.baseline))
+        return 0
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)['results']
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print('{0} benchmarks are more than {1:.0%} slower than the baseline or have none'.format(
+            len(regressions), args.threshold
+        ))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""Compare the indexed routing tables with the previous list based ones
+
+Run with: TEST_ENV=1 python test/benchmark/benchmark_routing.py [clients] [routing_keys]
+"""
+
+import sys
+import random
+import timeit
+from os import path
+
+sys.path.append(path.realpath(path.join(path.dirname(__file__), '../../gateway/')))
+
+from routing import RoutingTable # pylint: disable=import-error,wrong-import-position
+
+CHANNELS_PER_CLIENT = 8
+
+
+class ListRoutingTable():
+    """The routing tables as lists of dicts, like the router kept them before"""
+
+    def __init__(self):
+        self.publish_channels = {}
+        self.subscription_channels = {}
+
+    def add_publish_channel(self, client_id, routing_key, channel_id, transform_id):
+        channel = {'routing_key': routing_key, 'channel_id': channel_id, 'transform_id': transform_id}
+        self.publish_channels.setdefault(client_id, []).append(channel)
+
+    def get_publish_channel(self, client_id, channel_id):
+        return next((c for c in self.publish_channels[client_id] if c['channel_id'] == channel_id), None)
+
+    def add_subscription(self, client_id, routing_key, channel_id, transform_id):
+        subscription = {'client_id': client_id, 'channel_id': channel_id, 'transform_id': transform_id}
+        self.subscription_channels.setdefault(routing_key, []).append(subscription)
+
+    def clear_subscriptions(self, client_id):
+        for routing_key in self.subscription_channels:
+            subscriptions = self.subscription_channels[routing_key]
+            self.subscription_channels[routing_key] = [s for s in subscriptions if s['client_id'] != client_id]
+
+
+def get_publish_channel(table, client_id, channel_id):
+    """Look up a publish channel in the indexed table"""
+    return table.get_publish_channels(client_id).get(channel_id)
+
+
+def fill(table, clients, routing_keys, rng):
+    """Set up the same channels and subscriptions in a table"""
+    keys = ['sensor.{0}.value'.format(index) for index in range(routing_keys)]
+    for client_id in range(clients):
+        for channel_id in range(CHANNELS_PER_CLIENT):
+            table.add_publish_channel(client_id, rng.choice(keys), channel_id, 1)
+            table.add_subscription(client_id, rng.choice(keys), channel_id, 1)
+
+
+def benchmark(table_class, lookup, clients, routing_keys, number):
+    """Time publish channel lookups and the teardown of clients, returns microseconds per operation"""
+    rng = random.Random(1)
+    table = table_class()
+    fill(table, clients, routing_keys, rng)
+    client_ids = [rng.randrange(clients) for _ in range(number)]
+
+    lookup_time = timeit.timeit(
+        lambda: [lookup(table, client_id, CHANNELS_PER_CLIENT - 1) for client_id in client_ids], number=1
+    )
+    # distinct clients, tearing down a client twice would time an empty lookup
+    torn_down = rng.sample(range(clients), min(clients, 100))
+    teardown_time = timeit.timeit(lambda: [table.clear_subscriptions(client_id) for client_id in torn_down], number=1)
+    return lookup_time / number * 1e6, teardown_time / len(torn_down) * 1e6
+
+
+def main():
+    """Print the results for both implementations"""
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 250
+    routing_keys = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    number = 10000
+    print('{0} clients, {1} routing keys, {2} channels per client'.format(clients, routing_keys, CHANNELS_PER_CLIENT))
+    for name, table_class, lookup in (('lists', ListRoutingTable, ListRoutingTable.get_publish_channel),
+                                      ('indexed', RoutingTable, get_publish_channel)):
+        lookup_us, teardown_us = benchmark(table_class, lookup, clients, routing_keys, number)
+        print('{0:8} pub lookup {1:8.3f}us  client teardown {2:10.3f}us'.format(name, lookup_us, teardown_us))
+
+if __name__ == "__main__":
+    main()
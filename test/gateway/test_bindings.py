@@ -0,0 +1,111 @@
+import setup_test
+
+setup_test.setup()
+
+import asyncio
+import unittest
+import bindings
+
+
+class FakeBus():
+    def __init__(self, fail_keys=()):
+        self.connected = True
+        self.bound = []
+        self.unbound = []
+        self.fail_keys = fail_keys
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @asyncio.coroutine
+    def bind(self, routing_key):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        yield from asyncio.sleep(0)
+        self.in_flight -= 1
+        if routing_key in self.fail_keys:
+            raise ValueError('bind failed')
+        self.bound.append(routing_key)
+
+    @asyncio.coroutine
+    def unbind(self, routing_key):
+        self.unbound.append(routing_key)
+
+
+class TestBindingManager(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.bus = FakeBus(fail_keys=('broken.key',))
+        self.manager = bindings.BindingManager(window=0.001, grace_period=0.01)
+        self.manager.attach(self.bus)
+
+    def run_coroutines(self, *coroutines):
+        return self.loop.run_until_complete(asyncio.gather(*coroutines, return_exceptions=True))
+
+    def test_binds_keys_once_and_concurrently(self):
+        self.run_coroutines(*[self.manager.acquire(key) for key in ['a', 'b', 'c', 'a']])
+        self.run_coroutines(self.manager.acquire('b'))
+
+        self.assertEqual(sorted(self.bus.bound), ['a', 'b', 'c'])
+        self.assertEqual(self.bus.max_in_flight, 3)
+        self.assertEqual(self.manager.refcounts, {'a': 2, 'b': 2, 'c': 1})
+
+    def test_unbinds_after_the_grace_period(self):
+        self.run_coroutines(self.manager.acquire('a'), self.manager.acquire('a'))
+
+        self.manager.release('a')
+        self.run_coroutines(asyncio.sleep(0.02))
+        self.assertEqual(self.bus.unbound, [])
+
+        self.manager.release('a')
+        self.manager.release('unknown')
+        self.run_coroutines(asyncio.sleep(0.02))
+        self.assertEqual(self.bus.unbound, ['a'])
+        self.assertEqual(self.manager.bound, set())
+
+    def test_acquire_during_the_grace_period_keeps_the_binding(self):
+        self.run_coroutines(self.manager.acquire('a'))
+        self.manager.release('a')
+        self.run_coroutines(self.manager.acquire('a'), asyncio.sleep(0.02))
+
+        self.assertEqual(len(self.bus.bound), 1)
+        self.assertEqual(self.bus.unbound, [])
+
+    def test_release_while_the_bind_is_in_flight(self):
+        @asyncio.coroutine
+        def release_soon():
+            self.manager.release('a')
+
+        self.manager.grace_period = 0
+        self.run_coroutines(self.manager.acquire('a'), release_soon())
+        self.run_coroutines(asyncio.sleep(0.01))
+
+        self.assertEqual(self.bus.unbound, ['a'])
+
+    def test_failed_binds_are_retried_by_the_next_acquire(self):
+        with self.assertLogs(bindings.LOGGER):
+            results = self.run_coroutines(self.manager.acquire('broken.key'), self.manager.acquire('good.key'))
+        self.assertIsInstance(results[0], ValueError)
+        self.assertIsNone(results[1])
+
+        self.bus.fail_keys = ()
+        self.run_coroutines(self.manager.acquire('broken.key'))
+        self.assertIn('broken.key', self.manager.bound)
+
+    def test_rebind_after_reconnect(self):
+        self.run_coroutines(self.manager.acquire('a'), self.manager.acquire('b'))
+        self.manager.release('b')
+        self.bus.bound = []
+
+        self.run_coroutines(self.manager.rebind())
+        self.assertEqual(sorted(self.bus.bound), ['a', 'b'])
+        self.assertEqual(self.manager.bound, {'a', 'b'})
+
+    def test_keys_acquired_while_disconnected_are_bound_on_rebind(self):
+        self.bus.connected = False
+        self.run_coroutines(self.manager.acquire('a'))
+        self.assertEqual(self.bus.bound, [])
+        self.assertEqual(self.manager.refcounts, {'a': 1})
+
+        self.bus.connected = True
+        self.run_coroutines(self.manager.rebind())
+        self.assertEqual(self.bus.bound, ['a'])
@@ -0,0 +1,197 @@
+import setup_test
+
+setup_test.setup()
+
+import asyncio
+import tempfile
+import unittest
+import bus
+import outbox
+import router
+from asyncio import Future
+from unittest.mock import MagicMock as Mock
+from unittest.mock import patch
+
+
+def create_future_with_result(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class TestAmqpBus(unittest.TestCase):
+    @patch.multiple(bus, asynqp=Mock(), RABBITMQ_HOST='a', RABBITMQ_PORT=1, RABBITMQ_USERNAME='b',
+                    RABBITMQ_PASSWORD='c', RABBITMQ_VIRTUAL_HOST='d')
+    @setup_test.async_test
+    def test_connect(self):
+        bus_instance = bus.AmqpBus()
+
+        connection_stub = Mock()
+        channel_stub = Mock()
+        exchange_stub = Mock()
+        queue_stub = Mock()
+
+        bus.asynqp.connect.return_value = create_future_with_result(connection_stub)
+        connection_stub.open_channel.return_value = create_future_with_result(channel_stub)
+        channel_stub.declare_exchange.return_value = create_future_with_result(exchange_stub)
+        channel_stub.declare_queue.return_value = create_future_with_result(queue_stub)
+
+        yield from bus_instance.connect()
+
+        self.assertEqual(bus_instance.connection, connection_stub)
+        self.assertEqual(bus_instance.channel, channel_stub)
+        self.assertEqual(bus_instance.exchange, exchange_stub)
+        self.assertEqual(bus_instance.queue, queue_stub)
+        bus.asynqp.connect.assert_called_once_with('a', 1, 'b', 'c', 'd')
+        connection_stub.open_channel.assert_called_once_with()
+        channel_stub.declare_exchange.assert_called_once_with('gateway.exchange', 'topic')
+        channel_stub.declare_queue.assert_called_once_with('gateway.queue', auto_delete=True)
+        self.assertTrue(bus_instance.connected)
+        asyncio.get_event_loop().set_exception_handler(None)
+
+    @patch.multiple(bus, asynqp=Mock())
+    def test_lost_connections_are_reported(self):
+        bus.asynqp.exceptions.ConnectionLostError = ConnectionError
+        bus_instance = bus.AmqpBus()
+        bus_instance.connected = True
+        bus_instance.on_disconnect = Mock()
+        loop = Mock()
+
+        context = {'exception': KeyError()}
+        bus_instance.handle_exception(loop, context)
+        bus_instance.on_disconnect.assert_not_called()
+        loop.default_exception_handler.assert_called_once_with(context)
+
+        with self.assertLogs(bus.LOGGER):
+            bus_instance.handle_exception(loop, {'exception': ConnectionError()})
+        bus_instance.handle_exception(loop, {'exception': ConnectionError()})
+        bus_instance.on_disconnect.assert_called_once_with()
+        self.assertFalse(bus_instance.connected)
+        self.assertRaises(ConnectionError, bus_instance.publish, 'some.key', b'{}', 'application/json')
+
+    @patch.multiple(bus, asynqp=Mock())
+    def test_publish(self):
+        bus_instance = bus.AmqpBus()
+        bus_instance.exchange = Mock()
+        bus_instance.connected = True
+
+        bus_instance.publish('some.key', b'{}', 'application/json')
+
+        bus.asynqp.Message.assert_called_once_with(b'{}', content_type='application/json')
+        bus_instance.exchange.publish.assert_called_once_with(bus.asynqp.Message.return_value, 'some.key')
+
+    def test_write_buffer_size(self):
+        bus_instance = bus.AmqpBus()
+        self.assertEqual(bus_instance.write_buffer_size(), 0)
+
+        bus_instance.connection = Mock()
+        bus_instance.connection.transport.get_write_buffer_size.return_value = 512
+        bus_instance.connected = True
+        self.assertEqual(bus_instance.write_buffer_size(), 512)
+
+    @setup_test.async_test
+    def test_bind_and_unbind(self):
+        bus_instance = bus.AmqpBus()
+        bus_instance.exchange = Mock()
+        bus_instance.queue = Mock()
+        bus_instance.connected = True
+        binding = Mock()
+        binding.unbind.return_value = create_future_with_result(None)
+        bus_instance.queue.bind.return_value = create_future_with_result(binding)
+
+        yield from bus_instance.bind('some.key')
+        bus_instance.queue.bind.assert_called_once_with(bus_instance.exchange, 'some.key')
+
+        yield from bus_instance.unbind('some.key')
+        yield from bus_instance.unbind('some.key')
+        binding.unbind.assert_called_once_with()
+
+
+class TestLocalBus(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.exchange = bus.LocalExchange()
+        self.first = bus.LocalBus(self.exchange)
+        self.second = bus.LocalBus(self.exchange)
+        self.received = []
+        for bus_instance in (self.first, self.second):
+            self.loop.run_until_complete(bus_instance.connect())
+            self.loop.run_until_complete(bus_instance.consume(
+                lambda message, bus_instance=bus_instance: self.received.append((bus_instance, message))
+            ))
+
+    def test_messages_are_routed_to_bound_queues(self):
+        self.loop.run_until_complete(self.first.bind('house.*.switch'))
+        self.loop.run_until_complete(self.second.bind('house.#'))
+
+        self.first.publish('house.kitchen.switch', b'{}', 'application/json')
+        self.second.publish('house.kitchen.temperature', b'[]', 'application/json')
+        self.second.publish('garden.temperature', b'[]', 'application/json')
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertEqual([(bus_instance, message.routing_key) for bus_instance, message in self.received], [
+            (self.first, 'house.kitchen.switch'),
+            (self.second, 'house.kitchen.switch'),
+            (self.second, 'house.kitchen.temperature')
+        ])
+        self.assertEqual((self.received[0][1].body, self.received[0][1].content_type), (b'{}', 'application/json'))
+        self.assertEqual(self.exchange.unrouted, 1)
+
+    def test_unbind(self):
+        self.loop.run_until_complete(self.first.bind('a'))
+        self.loop.run_until_complete(self.first.unbind('a'))
+
+        self.first.publish('a', b'{}', 'application/json')
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.received, [])
+
+    def test_disconnect(self):
+        self.first.on_disconnect = Mock()
+        self.loop.run_until_complete(self.first.bind('a'))
+        self.first.disconnect()
+
+        self.first.on_disconnect.assert_called_once_with()
+        self.assertRaises(ConnectionError, self.first.publish, 'a', b'{}', 'application/json')
+        self.loop.run_until_complete(self.first.connect())
+        self.second.publish('a', b'{}', 'application/json')
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.received, [])
+
+    def test_create_bus(self):
+        self.assertIsInstance(bus.create_bus('local'), bus.LocalBus)
+        self.assertIsInstance(bus.create_bus('amqp'), bus.AmqpBus)
+
+    def test_router_on_the_local_bus(self):
+        router_instance = router.Router(bus.LocalBus(self.exchange))
+        router_instance.bindings.window = 0
+        router_instance.send_packet = Mock()
+        self.loop.run_until_complete(router_instance.connect_to_message_queue())
+        self.loop.run_until_complete(router_instance.add_subscription_channel(2, 'house.*.switch', 0, 0))
+        router_instance.add_publish_channel(1, 'house.kitchen.switch', 0, 0)
+
+        self.loop.run_until_complete(router_instance.handle_pub_packet(1, bytes([0, 1])))
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+        router_instance.send_packet.assert_called_once_with(2, 4, bytes([0, 1]), router_instance.transforms[0].priority)
+
+    def test_router_survives_an_outage_of_the_bus(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        router_instance = router.Router(bus.LocalBus(self.exchange), outbox.Outbox(directory.name))
+        router_instance.add_publish_channel(1, 'house.kitchen.switch', 0, 0)
+        self.loop.run_until_complete(router_instance.connect_to_message_queue())
+        self.loop.run_until_complete(self.first.bind('house.#'))
+
+        router_instance.bus.on_disconnect = Mock()
+        router_instance.bus.disconnect()
+        for state in range(3):
+            self.loop.run_until_complete(router_instance.handle_pub_packet(1, bytes([0, state % 2])))
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual((len(router_instance.publisher.outbox), self.received), (3, []))
+
+        self.loop.run_until_complete(router_instance.connect_to_message_queue())
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual([bus.decode(message.body, message.content_type) for dummy, message in self.received], [
+            {'status': False}, {'status': True}, {'status': False}
+        ])
+        self.assertEqual(router_instance.publisher.outbox.stats.replayed, 3)
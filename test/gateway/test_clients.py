@@ -0,0 +1,243 @@
+import setup_test
+
+setup_test.setup()
+
+import unittest
+import clients
+
+CLIENT_ADDRESS = [0x00, 0x00, 0x00, 0x00, 0x02]
+OTHER_CLIENT_ADDRESS = [0x00, 0x00, 0x00, 0x00, 0x03]
+
+
+class TestClientRegistry(unittest.TestCase):
+    def test_register(self):
+        registry = clients.ClientRegistry()
+
+        client = registry.register(5, CLIENT_ADDRESS, 10, 20)
+
+        self.assertIn(5, registry)
+        self.assertEqual(len(registry), 1)
+        self.assertIs(registry.get(5), client)
+        self.assertIs(registry.get_by_address(CLIENT_ADDRESS), client)
+        self.assertEqual(list(registry), [client])
+        self.assertEqual((client.client_id, client.address, client.client_counter, client.server_counter),
+                         (5, CLIENT_ADDRESS, 10, 20))
+
+    def test_clients_have_no_dict(self):
+        client = clients.Client(1, CLIENT_ADDRESS, 0, 0)
+        with self.assertRaises(AttributeError):
+            client.foo = 'bar'
+
+    def test_register_replaces_client_with_same_id(self):
+        registry = clients.ClientRegistry()
+        registry.register(5, CLIENT_ADDRESS, 10, 20)
+
+        client = registry.register(5, OTHER_CLIENT_ADDRESS, 11, 21)
+
+        self.assertEqual(len(registry), 1)
+        self.assertIs(registry.get(5), client)
+        self.assertIsNone(registry.get_by_address(CLIENT_ADDRESS))
+
+    def test_register_replaces_client_with_same_address(self):
+        registry = clients.ClientRegistry()
+        registry.register(5, CLIENT_ADDRESS, 10, 20)
+
+        registry.register(6, CLIENT_ADDRESS, 11, 21)
+
+        self.assertEqual(len(registry), 1)
+        self.assertNotIn(5, registry)
+        self.assertEqual(registry.get_by_address(CLIENT_ADDRESS).client_id, 6)
+        self.assertEqual(registry.get_client_id(OTHER_CLIENT_ADDRESS), 1)
+
+    def test_get_client_id_returns_lowest_free_id(self):
+        registry = clients.ClientRegistry()
+        for i in range(1, 10):
+            registry.register(i, [0, 0, 0, 1, i], 0, 0)
+        registry.remove(4)
+
+        self.assertEqual(registry.get_client_id(CLIENT_ADDRESS), 4)
+
+    def test_get_client_id_of_registered_address(self):
+        registry = clients.ClientRegistry()
+        registry.register(17, CLIENT_ADDRESS, 0, 0)
+
+        self.assertEqual(registry.get_client_id(CLIENT_ADDRESS), 17)
+
+    def test_get_client_id_without_free_ids(self):
+        registry = clients.ClientRegistry()
+        for i in range(1, clients.MAX_CLIENT_ID + 1):
+            registry.register(i, [0, 0, 0, 1, i], 0, 0)
+
+        self.assertEqual(registry.get_client_id(CLIENT_ADDRESS), False)
+
+        registry.remove(clients.MAX_CLIENT_ID)
+        self.assertEqual(registry.get_client_id(CLIENT_ADDRESS), clients.MAX_CLIENT_ID)
+
+    def test_remove(self):
+        registry = clients.ClientRegistry()
+        client = registry.register(5, CLIENT_ADDRESS, 10, 20)
+
+        self.assertIs(registry.remove(5), client)
+        self.assertIsNone(registry.remove(5))
+        self.assertNotIn(5, registry)
+        self.assertIsNone(registry.get_by_address(CLIENT_ADDRESS))
+        self.assertEqual(registry.free_ids, [clients.ALL_CLIENT_IDS])
+
+    def test_iterating_while_clients_register(self):
+        registry = clients.ClientRegistry()
+        registry.register(5, CLIENT_ADDRESS, 10, 20)
+
+        for client in registry:
+            registry.register(6, OTHER_CLIENT_ADDRESS, 10, 20)
+            self.assertEqual(client.client_id, 5)
+        self.assertEqual(len(registry), 2)
+
+
+class TestRadios(unittest.TestCase):
+    def test_client_ids(self):
+        client_id = clients.global_client_id(2, 17)
+
+        self.assertEqual(client_id, 529)
+        self.assertEqual(clients.radio_index(client_id), 2)
+        self.assertEqual(clients.local_client_id(client_id), 17)
+        self.assertEqual(clients.global_client_id(0, 17), 17)
+
+    def test_new_clients_are_spread_over_the_radios(self):
+        registry = clients.ClientRegistry(2)
+
+        client_ids = []
+        for index in range(4):
+            client_id = registry.get_client_id([0, 0, 0, 0, index], True)
+            registry.register(client_id, [0, 0, 0, 0, index], 0, 0)
+            client_ids.append(client_id)
+
+        self.assertEqual(client_ids, [1, 257, 2, 258])
+        self.assertEqual(registry.get(257).radio, 1)
+
+    def test_new_clients_go_to_the_radio_with_the_lowest_load(self):
+        registry = clients.ClientRegistry(2)
+        busy = registry.register(1, CLIENT_ADDRESS, 0, 0)
+        registry.register(257, OTHER_CLIENT_ADDRESS, 0, 0)
+        registry.register(258, [0, 0, 0, 0, 4], 0, 0)
+        now = clients.monotonic()
+        for dummy in range(10):
+            busy.count_packet(now)
+
+        self.assertEqual(registry.get_client_id([0, 0, 0, 0, 5], True), 259)
+        loads = registry.loads(now)
+        self.assertAlmostEqual(loads[0][0], 10, places=2)
+        self.assertEqual([count for dummy, count in loads], [1, 2])
+
+    def test_new_clients_start_with_the_average_load(self):
+        registry = clients.ClientRegistry(2)
+        busy = registry.register(1, CLIENT_ADDRESS, 0, 0)
+        busy.count_packet(clients.monotonic())
+        busy.count_packet(clients.monotonic())
+        registry.register(257, OTHER_CLIENT_ADDRESS, 0, 0)
+
+        client = registry.register(258, [0, 0, 0, 0, 4], 0, 0)
+
+        self.assertAlmostEqual(client.load_at(client.load_updated), 2, places=2)
+
+    def test_load_decays(self):
+        client = clients.Client(1, CLIENT_ADDRESS, 0, 0)
+        client.count_packet(100.0)
+        client.count_packet(100.0)
+
+        self.assertEqual(client.load_at(100.0), 2)
+        self.assertAlmostEqual(client.load_at(100.0 + clients.CLIENT_LOAD_HALF_LIFE), 1)
+
+    def test_full_radios_are_skipped(self):
+        registry = clients.ClientRegistry(2)
+        registry.free_ids[0] = 0
+
+        self.assertEqual(registry.get_client_id(CLIENT_ADDRESS, True), 257)
+
+        registry.free_ids[1] = 0
+        self.assertFalse(registry.get_client_id(CLIENT_ADDRESS, True))
+
+    def test_clients_that_do_not_switch_channels_stay_on_the_first_radio(self):
+        registry = clients.ClientRegistry(2)
+        registry.register(1, CLIENT_ADDRESS, 0, 0)
+        registry.register(257, OTHER_CLIENT_ADDRESS, 0, 0)
+
+        self.assertEqual(registry.get_client_id([0, 0, 0, 0, 4]), 2)
+        self.assertEqual(registry.get_client_id(OTHER_CLIENT_ADDRESS), 2)
+        self.assertEqual(registry.get_client_id(OTHER_CLIENT_ADDRESS, True), 257)
+
+        registry.free_ids[0] = 0
+        self.assertFalse(registry.get_client_id([0, 0, 0, 0, 4]))
+
+    def test_remove_frees_the_id_on_its_radio(self):
+        registry = clients.ClientRegistry(2)
+        registry.register(300, CLIENT_ADDRESS, 0, 0)
+
+        registry.remove(300)
+
+        self.assertEqual(registry.free_ids, [clients.ALL_CLIENT_IDS] * 2)
+
+
+class TestReplayWindow(unittest.TestCase):
+    def test_accepts_counters_ahead(self):
+        window = clients.ReplayWindow(100, 8, 20)
+
+        self.assertTrue(window.check(101))
+        self.assertTrue(window.check(105))
+        self.assertEqual(window.last, 105)
+        self.assertEqual(window.resynced, 0)
+
+    def test_rejects_duplicates(self):
+        window = clients.ReplayWindow(100, 8, 20)
+
+        self.assertTrue(window.check(101))
+        self.assertFalse(window.check(101))
+        self.assertFalse(window.check(100))
+        self.assertEqual(window.duplicates, 2)
+
+    def test_accepts_out_of_order_counters_inside_the_window_once(self):
+        window = clients.ReplayWindow(100, 8, 20)
+
+        self.assertTrue(window.check(105))
+        self.assertTrue(window.check(103))
+        self.assertTrue(window.check(98))
+        self.assertFalse(window.check(103))
+        self.assertFalse(window.check(98))
+        self.assertEqual(window.last, 105)
+        self.assertEqual(window.duplicates, 2)
+
+    def test_rejects_counters_behind_the_window(self):
+        window = clients.ReplayWindow(100, 8, 20)
+
+        self.assertFalse(window.check(92))
+        self.assertTrue(window.check(93))
+        self.assertEqual(window.rejected, 1)
+
+    def test_resyncs_after_lost_packets(self):
+        window = clients.ReplayWindow(100, 8, 20)
+
+        self.assertTrue(window.check(115))
+        self.assertEqual(window.resynced, 1)
+        self.assertEqual(window.bitmap, 1)
+        self.assertTrue(window.check(114))
+
+    def test_rejects_counters_too_far_ahead(self):
+        window = clients.ReplayWindow(100, 8, 20)
+
+        self.assertFalse(window.check(121))
+        self.assertEqual(window.rejected, 1)
+        self.assertEqual(window.last, 100)
+
+    def test_wraps_around(self):
+        window = clients.ReplayWindow(65534, 8, 20)
+
+        self.assertTrue(window.check(1))
+        self.assertTrue(window.check(65535))
+        self.assertTrue(window.check(0))
+        self.assertFalse(window.check(65534))
+        self.assertEqual(window.last, 1)
+
+    def test_negative_initial_counter_wraps(self):
+        window = clients.ReplayWindow(-1, 8, 20)
+
+        self.assertEqual(window.last, 65535)
+        self.assertTrue(window.check(0))
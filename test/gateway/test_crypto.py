@@ -52,3 +52,55 @@ class TestDecryptPacket(CryptoTestCase):
         cycled_packet = crypto.encrypt_packet(crypto.decrypt_packet(packet))
 
         self.assertEqual(packet, cycled_packet)
+
+
+class TestCryptoEngine(CryptoTestCase):
+    def test_engine_is_cached_per_key(self):
+        engine = crypto.get_engine(crypto.PRESHARED_KEY)
+
+        self.assertIs(crypto.get_engine(crypto.PRESHARED_KEY), engine)
+        self.assertIsNot(crypto.get_engine(bytes([2] * 16)), engine)
+
+    def test_engine_matches_the_module_functions(self):
+        engine = crypto.CryptoEngine(crypto.PRESHARED_KEY)
+        packet = bytes([random.randint(0, 255) for dummy in range(32)])
+
+        self.assertEqual(engine.encrypt_packet(packet), crypto.encrypt_packet(packet))
+        self.assertEqual(engine.decrypt_packet(packet), crypto.decrypt_packet(packet))
+
+    def test_engine_accepts_lists_of_ints(self):
+        engine = crypto.CryptoEngine(crypto.PRESHARED_KEY)
+        packet = [random.randint(0, 255) for dummy in range(32)]
+
+        self.assertEqual(engine.decrypt_packet(engine.encrypt_packet(packet)), bytes(packet))
+
+    def test_batch_encrypt_matches_single_packets(self):
+        engine = crypto.CryptoEngine(crypto.PRESHARED_KEY)
+        packets = [bytes([random.randint(0, 255) for dummy in range(32)]) for dummy in range(10)]
+
+        self.assertEqual(engine.encrypt_packets(packets), [engine.encrypt_packet(p) for p in packets])
+
+    def test_batch_decrypt_matches_single_packets(self):
+        engine = crypto.CryptoEngine(crypto.PRESHARED_KEY)
+        packets = [bytes([random.randint(0, 255) for dummy in range(32)]) for dummy in range(10)]
+
+        self.assertEqual(engine.decrypt_packets(packets), [engine.decrypt_packet(p) for p in packets])
+
+    def test_batch_with_no_packets(self):
+        engine = crypto.CryptoEngine(crypto.PRESHARED_KEY)
+
+        self.assertEqual(engine.encrypt_packets([]), [])
+        self.assertEqual(engine.decrypt_packets([]), [])
+
+
+class TestXorChecksum(unittest.TestCase):
+    def test_xor_checksum(self):
+        self.assertEqual(crypto.xor_checksum([1, 2, 3, 4, 5, 6, 7]), 121)
+
+    def test_xor_checksum_ignores_bytes_that_are_shifted_out(self):
+        data = [random.randint(0, 255) for dummy in range(8)]
+
+        self.assertEqual(crypto.xor_checksum(data + [1, 2, 3]), crypto.xor_checksum(data))
+
+    def test_xor_checksum_of_empty_array(self):
+        self.assertEqual(crypto.xor_checksum([]), 0)
@@ -0,0 +1,103 @@
+import setup_test
+
+setup_test.setup()
+
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+import diagnostics
+
+
+def block_the_loop():
+    time.sleep(0.1)
+
+
+class TestLoopMonitor(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.monitor = diagnostics.LoopMonitor(self.loop, interval=0.01, threshold=0.03)
+
+    def tearDown(self):
+        self.monitor.stop()
+        self.monitor.watchdog.join()
+
+    def test_lag_is_measured(self):
+        self.monitor.start()
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+        self.assertGreater(self.monitor.stats.beats, 1)
+        self.assertGreaterEqual(self.monitor.stats.lag_total, 0)
+
+    def test_blocking_callbacks_are_logged_with_their_stack(self):
+        self.monitor.start()
+        self.loop.call_soon(block_the_loop)
+
+        with self.assertLogs(diagnostics.LOGGER) as logs:
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+
+        self.assertEqual(self.monitor.stats.blocked, 1)
+        self.assertIn('block_the_loop', logs.output[0])
+        self.assertGreaterEqual(self.monitor.stats.lag_max, 0.05)
+
+
+class TestSamplingProfiler(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.directory = tempfile.TemporaryDirectory()
+        self.profiler = diagnostics.SamplingProfiler(rate=1000, directory=self.directory.name, max_duration=0.05)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_profile(self):
+        done = threading.Event()
+        worker = threading.Thread(target=keep_busy, args=(done,), name='worker')
+        worker.start()
+        try:
+            stacks = self.loop.run_until_complete(self.profiler.profile(10))
+        finally:
+            done.set()
+            worker.join()
+
+        self.assertGreater(sum(stacks.values()), 0)
+        self.assertTrue(any(stack.startswith('worker;') and stack.endswith(':block_the_loop_briefly')
+                            for stack in stacks))
+        self.assertFalse(self.profiler.running)
+
+    def test_only_one_profile_at_a_time(self):
+        first, second = self.loop.run_until_complete(asyncio.gather(
+            self.profiler.profile(0.01),
+            self.profiler.handle_request({'seconds': ['0.01']})
+        ))
+
+        self.assertIsNotNone(first)
+        self.assertEqual(second[0], '409 Conflict')
+
+    def test_handle_request(self):
+        status, content_type, body = self.loop.run_until_complete(self.profiler.handle_request({'seconds': ['0.01']}))
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(content_type, 'text/plain; charset=utf-8')
+        self.assertRegex(body.decode().splitlines()[0], r' \d+$')
+
+        status, dummy, dummy = self.loop.run_until_complete(self.profiler.handle_request({'seconds': ['ten']}))
+        self.assertEqual(status, '400 Bad Request')
+
+    def test_dump(self):
+        with self.assertLogs(diagnostics.LOGGER):
+            path = self.loop.run_until_complete(self.profiler.dump(0.01))
+
+        self.assertEqual(os.path.dirname(path), self.directory.name)
+        with open(path) as profile_file:
+            self.assertTrue(profile_file.read().endswith('\n'))
+
+
+def block_the_loop_briefly():
+    time.sleep(0.001)
+
+
+def keep_busy(done):
+    while not done.is_set():
+        block_the_loop_briefly()
@@ -3,42 +3,138 @@ import setup_test
 setup_test.setup()
 
 import unittest
+import asyncio
 import gateway
+import metrics
 import random
 from unittest.mock import MagicMock as Mock
-from unittest.mock import patch
+from unittest.mock import patch, call, ANY
+from radio import POLL_INTERVAL_MIN
 
 
 class TestGatewayMain(unittest.TestCase):
-    @patch.multiple(gateway, asyncio=Mock(), atexit=Mock(), initialize_gpio=Mock(), Radio=Mock(), Router=Mock(),
-                    poll=Mock())
+    @patch.multiple(gateway, asyncio=Mock(), atexit=Mock(), initialize_gpio=Mock(), create_radio_pool=Mock(),
+                    Router=Mock(), poll=Mock(), start_metrics_server=Mock())
     def test_main(self):
         loop_stub = Mock()
         router_stub = Mock()
+        pool_stub = Mock()
         radio_stub = Mock()
+        pool_stub.radios = [radio_stub]
 
         gateway.Router.return_value = router_stub
-        gateway.Radio.return_value = radio_stub
-        gateway.Radio.send_packet = {}
+        gateway.create_radio_pool.return_value = pool_stub
         gateway.asyncio.get_event_loop.return_value = loop_stub
         router_stub.connect_to_message_queue.return_value = 'Future'
 
         gateway.main()
 
         gateway.initialize_gpio.assert_called_once_with()
-        gateway.Radio.assert_called_once_with()
+        gateway.create_radio_pool.assert_called_once_with()
 
         gateway.Router.assert_called_once_with()
-        loop_stub.run_until_complete.assert_called_once_with('Future')
-        router_stub.set_send_packet.assert_called_once_with(radio_stub.send_packet)
+        gateway.asyncio.async.assert_any_call('Future')
+        loop_stub.run_until_complete.assert_not_called()
+        pool_stub.start.assert_called_once_with([radio_stub.send_packets])
+        router_stub.set_send_packet.assert_called_once_with(pool_stub.send_packet)
 
-        gateway.poll.assert_called_once_with(loop_stub, radio_stub, router_stub)
+        gateway.poll.assert_called_once_with(loop_stub, pool_stub, router_stub)
+        gateway.start_metrics_server.assert_called_once_with(handlers={})
 
         loop_stub.run_forever.assert_called_once_with()
+        router_stub.timeseries.flush.assert_called_once_with()
+        pool_stub.stop.assert_called_once_with()
         loop_stub.close.assert_called_once_with()
 
+    @patch.multiple(gateway, asyncio=Mock(), atexit=Mock(), initialize_gpio=Mock(), create_radio_pool=Mock(),
+                    Router=Mock(), poll=Mock(), fallback_poll=Mock(), initialize_irq=Mock(), partial=Mock(),
+                    RADIO_RECEIVE_MODE='irq', RADIOS=[{'irq_pin': 24}, {'irq_pin': 23}])
+    def test_main_in_irq_mode(self):
+        loop_stub = Mock()
+        router_stub = Mock()
+        pool_stub = Mock()
+
+        gateway.Router.return_value = router_stub
+        gateway.create_radio_pool.return_value = pool_stub
+        gateway.asyncio.get_event_loop.return_value = loop_stub
+
+        gateway.main()
+
+        gateway.initialize_irq.assert_has_calls([call(gateway.partial.return_value, 24),
+                                                 call(gateway.partial.return_value, 23)])
+        gateway.partial.assert_called_with(gateway.on_radio_interrupt, loop_stub, pool_stub, router_stub)
+        gateway.fallback_poll.assert_called_once_with(loop_stub, pool_stub, router_stub)
+        self.assertFalse(gateway.poll.called)
+
+    @patch.multiple(gateway, asyncio=Mock(), atexit=Mock(), initialize_gpio=Mock(), create_radio_pool=Mock(),
+                    Router=Mock(), poll=Mock(), start_radio_worker=Mock(), RADIO_WORKER_THREAD=True,
+                    RADIOS=[{'irq_pin': 24}, {'irq_pin': 23}])
+    def test_main_with_radio_worker_threads(self):
+        loop_stub = Mock()
+        router_stub = Mock()
+        pool_stub = Mock()
+        radio_stubs = [Mock(), Mock()]
+        worker_stubs = [Mock(), Mock()]
+        pool_stub.radios = radio_stubs
+
+        gateway.Router.return_value = router_stub
+        gateway.create_radio_pool.return_value = pool_stub
+        gateway.asyncio.get_event_loop.return_value = loop_stub
+        gateway.start_radio_worker.side_effect = worker_stubs
+
+        gateway.main()
+
+        gateway.start_radio_worker.assert_has_calls([call(loop_stub, radio_stubs[0], router_stub, 24),
+                                                     call(loop_stub, radio_stubs[1], router_stub, 23)])
+        pool_stub.start.assert_called_once_with([worker.send_packets for worker in worker_stubs])
+        self.assertFalse(gateway.poll.called)
+        for worker_stub in worker_stubs:
+            worker_stub.stop.assert_called_once_with()
+        loop_stub.close.assert_called_once_with()
+
+    @patch.multiple(gateway, asyncio=Mock(), atexit=Mock(), initialize_gpio=Mock(), create_radio_pool=Mock(),
+                    Router=Mock(), poll=Mock(), start_metrics_server=Mock(), SamplingProfiler=Mock(),
+                    PROFILER_ENDPOINT=True)
+    def test_main_with_the_profiler_endpoint(self):
+        gateway.asyncio.get_event_loop.return_value = Mock()
+
+        gateway.main()
+
+        gateway.start_metrics_server.assert_called_once_with(
+            handlers={'/profile': gateway.SamplingProfiler.return_value.handle_request})
+
 
 class TestGateway(unittest.TestCase):
+    @patch.multiple(gateway, REGISTRY=metrics.Registry())
+    def test_register_metrics(self):
+        pool = Mock()
+        pool.radios = [Mock(), Mock()]
+        for index, radio in enumerate(pool.radios):
+            radio.spi_stats.totals = {'read': 5 + index}
+            radio.rx_fifo_overflows = 2
+            radio.tx_stats.as_dict.return_value = {'batches': 1 + index}
+        pool.schedulers = [Mock(), Mock()]
+        pool.utilization = [0.25, 0.5]
+        pool.clients = [Mock(client_id=1), Mock(client_id=2), Mock(client_id=257)]
+        router = Mock()
+        router.publisher.outbox = None
+        router.routes.topics.hits = 3
+        router.routes.topics.misses = 1
+        stats_stubs = [scheduler.stats for scheduler in pool.schedulers]
+        stats_stubs += [router.publisher.stats, router.retained.stats]
+        for stats in stats_stubs:
+            stats.as_dict.return_value = {}
+
+        gateway.register_metrics(pool, router)
+        rendered = gateway.REGISTRY.render()
+
+        self.assertIn('radio_tx_batches{radio="0"} 1\nradio_tx_batches{radio="1"} 2\n', rendered)
+        self.assertIn('radio_spi_transactions{radio="1",type="read"} 6\n', rendered)
+        self.assertIn('radio_rx_fifo_overflows{radio="0"} 2\n', rendered)
+        self.assertIn('radio_utilization{radio="1"} 0.5\n', rendered)
+        self.assertIn('radio_clients{radio="0"} 2\nradio_clients{radio="1"} 1\n', rendered)
+        self.assertIn('routing_topic_cache{result="hit"} 3\n', rendered)
+
     @patch.multiple(gateway, GPIO=Mock(), atexit=Mock())
     def test_initialize_gpio(self):
         gateway.initialize_gpio()
@@ -57,16 +153,34 @@ class TestGateway(unittest.TestCase):
 
         gateway.partial.return_value = 'PartiallyAppliedFn'
         router.handle_packet.return_value = 'Future'
-        radio.get_packet.return_value = (expected_client_id, expected_message_id, expected_payload)
+        radio.get_packets.return_value = ([(expected_client_id, expected_message_id, expected_payload)], 1)
 
         gateway.poll(loop, radio, router)
 
+        radio.get_packets.assert_called_once_with(gateway.MAX_PACKETS_PER_DRAIN)
         router.handle_packet.assert_called_once_with(
             expected_client_id,
             expected_message_id,
             expected_payload)
         gateway.asyncio.async.assert_called_once_with('Future')
-        loop.call_later.assert_called_once_with(0.04, 'PartiallyAppliedFn')
+        gateway.partial.assert_called_once_with(gateway.poll, loop, radio, router, POLL_INTERVAL_MIN)
+        loop.call_later.assert_called_once_with(POLL_INTERVAL_MIN, 'PartiallyAppliedFn')
+
+    @patch.multiple(gateway, partial=Mock(), asyncio=Mock())
+    def test_poll_with_multiple_packets_available(self):
+        loop = Mock()
+        radio = Mock()
+        router = Mock()
+
+        radio.get_packets.return_value = ([(1, 4, bytes([1])), (2, 4, bytes([2])), (3, 4, bytes([3]))], 4)
+
+        gateway.poll(loop, radio, router)
+
+        self.assertEqual(router.handle_packet.call_count, 3)
+        router.handle_packet.assert_any_call(1, 4, bytes([1]))
+        router.handle_packet.assert_any_call(2, 4, bytes([2]))
+        router.handle_packet.assert_any_call(3, 4, bytes([3]))
+        self.assertEqual(gateway.asyncio.async.call_count, 3)
 
     @patch.multiple(gateway, partial=Mock(), asyncio=Mock())
     def test_poll_without_packet_available(self):
@@ -74,11 +188,138 @@ class TestGateway(unittest.TestCase):
         radio = Mock()
         router = Mock()
 
-        radio.get_packet.return_value = False
+        radio.get_packets.return_value = ([], 0)
         gateway.partial.return_value = 'PartiallyAppliedFn'
 
         gateway.poll(loop, radio, router)
 
         self.assertEqual(router.handle_packet.call_count, 0)
-        loop.call_later.assert_called_once_with(0.04, 'PartiallyAppliedFn')
+        loop.call_later.assert_called_once_with(gateway.POLL_INTERVAL_MAX, 'PartiallyAppliedFn')
+
+    @patch.multiple(gateway, partial=Mock(), asyncio=Mock())
+    def test_poll_while_router_applies_backpressure(self):
+        loop = Mock()
+        radio = Mock()
+        router = Mock()
+        router.accepting_packets.return_value = False
+        gateway.partial.return_value = 'PartiallyAppliedFn'
+
+        gateway.poll(loop, radio, router)
+
+        radio.get_packets.assert_not_called()
+        loop.call_later.assert_called_once_with(gateway.POLL_INTERVAL_MAX, 'PartiallyAppliedFn')
+
+    @patch.multiple(gateway, partial=Mock(), asyncio=Mock())
+    def test_fallback_poll(self):
+        loop = Mock()
+        radio = Mock()
+        router = Mock()
+
+        radio.get_packets.return_value = ([(1, 4, bytes([1]))], 1)
+        gateway.partial.return_value = 'PartiallyAppliedFn'
+
+        gateway.fallback_poll(loop, radio, router)
+
+        router.handle_packet.assert_called_once_with(1, 4, bytes([1]))
+        gateway.partial.assert_called_once_with(gateway.fallback_poll, loop, radio, router)
+        loop.call_later.assert_called_once_with(gateway.IRQ_FALLBACK_POLL_INTERVAL, 'PartiallyAppliedFn')
+
+    @patch.multiple(gateway, GPIO=Mock(), RADIO_IRQ_PIN=24)
+    def test_initialize_irq(self):
+        callback = Mock()
+
+        gateway.initialize_irq(callback)
+
+        gateway.GPIO.setup.assert_called_once_with(24, gateway.GPIO.IN, pull_up_down=gateway.GPIO.PUD_UP)
+        gateway.GPIO.add_event_detect.assert_called_once_with(24, gateway.GPIO.FALLING, callback=callback)
+
+    def test_on_radio_interrupt_hands_over_to_the_loop(self):
+        loop = Mock()
+        radio = Mock()
+        router = Mock()
+
+        gateway.on_radio_interrupt(loop, radio, router, 24)
+
+        loop.call_soon_threadsafe.assert_called_once_with(gateway.handle_radio_interrupt, loop, radio, router)
+        self.assertFalse(radio.get_packets.called)
+
+    @patch.multiple(gateway, asyncio=Mock())
+    def test_handle_radio_interrupt(self):
+        loop = Mock()
+        radio = Mock()
+        router = Mock()
+        radio.get_packets.return_value = ([(1, 4, bytes([1]))], 1)
+
+        gateway.handle_radio_interrupt(loop, radio, router)
+
+        router.handle_packet.assert_called_once_with(1, 4, bytes([1]))
+        self.assertFalse(loop.call_soon.called)
+
+    @patch.multiple(gateway, asyncio=Mock())
+    def test_handle_radio_interrupt_continues_when_limit_was_hit(self):
+        loop = Mock()
+        radio = Mock()
+        router = Mock()
+        radio.get_packets.return_value = ([], gateway.MAX_PACKETS_PER_DRAIN)
+
+        gateway.handle_radio_interrupt(loop, radio, router)
+
+        loop.call_soon.assert_called_once_with(gateway.handle_radio_interrupt, loop, radio, router)
+
+    @patch.multiple(gateway, asyncio=Mock(), RadioWorker=Mock(), initialize_irq=Mock(), RADIO_RECEIVE_MODE='poll')
+    def test_start_radio_worker(self):
+        loop = Mock()
+        radio = Mock()
+        router = Mock()
+        worker = gateway.RadioWorker.return_value
+
+        self.assertEqual(gateway.start_radio_worker(loop, radio, router), worker)
+
+        gateway.RadioWorker.assert_called_once_with(loop, radio, gateway.POLL_INTERVAL_MAX)
+        worker.start.assert_called_once_with()
+        self.assertEqual(gateway.asyncio.async.call_count, 1)
+        self.assertFalse(gateway.initialize_irq.called)
+
+    @patch.multiple(gateway, asyncio=Mock(), RadioWorker=Mock(), initialize_irq=Mock(), RADIO_RECEIVE_MODE='irq')
+    def test_start_radio_worker_in_irq_mode(self):
+        worker = gateway.RadioWorker.return_value
+
+        gateway.start_radio_worker(Mock(), Mock(), Mock())
+
+        gateway.RadioWorker.assert_called_once_with(ANY, ANY, gateway.IRQ_FALLBACK_POLL_INTERVAL)
+        gateway.initialize_irq.assert_called_once_with(worker.wake, gateway.RADIO_IRQ_PIN)
+
+    @setup_test.async_test
+    def test_dispatch_packets(self):
+        worker = Mock()
+        router = Mock()
+        worker.packets = asyncio.Queue()
+        worker.packets.put_nowait((1, 4, bytes([1])))
+        router.handle_packet.side_effect = lambda *args: asyncio.sleep(0)
+
+        task = asyncio.async(gateway.dispatch_packets(worker, router))
+        yield from asyncio.sleep(0.01)
+        task.cancel()
+
+        router.handle_packet.assert_called_once_with(1, 4, bytes([1]))
+
+    @setup_test.async_test
+    def test_dispatch_packets_pauses_the_worker_while_the_router_blocks(self):
+        worker = Mock()
+        router = Mock()
+        worker.packets = asyncio.Queue()
+        worker.packets.put_nowait((1, 4, bytes([1])))
+        router.accepting_packets.return_value = False
+        router.handle_packet.side_effect = lambda *args: asyncio.sleep(0)
+
+        task = asyncio.async(gateway.dispatch_packets(worker, router))
+        yield from asyncio.sleep(0.01)
+        worker.pause.assert_called_once_with()
+        router.handle_packet.assert_not_called()
+
+        router.accepting_packets.return_value = True
+        yield from asyncio.sleep(gateway.POLL_INTERVAL_MAX + 0.01)
+        task.cancel()
 
+        worker.resume.assert_called_once_with()
+        router.handle_packet.assert_called_once_with(1, 4, bytes([1]))
@@ -0,0 +1,132 @@
+import setup_test
+
+setup_test.setup()
+
+import asyncio
+import unittest
+import metrics
+from unittest.mock import MagicMock as Mock
+
+
+class Stats():
+    def __init__(self):
+        self.sent = 3
+        self.latency = 0.5
+        self.name = 'not a number'
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter('packets_total', 'Packets', ('result',))
+        counter.labels('accepted').inc()
+        counter.labels('accepted').inc(2)
+        counter.labels('rejected').inc()
+
+        self.assertIs(self.registry.counter('packets_total', 'Packets', ('result',)), counter)
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP packets_total Packets',
+            '# TYPE packets_total counter',
+            'packets_total{result="accepted"} 3',
+            'packets_total{result="rejected"} 1',
+            ''
+        ]))
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('read_seconds', 'Reads', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(self.registry.render().split('\n')[2:], [
+            'read_seconds_bucket{le="0.1"} 2',
+            'read_seconds_bucket{le="1"} 3',
+            'read_seconds_bucket{le="+Inf"} 4',
+            'read_seconds_sum 2.65',
+            'read_seconds_count 4',
+            ''
+        ])
+
+    def test_labeled_histogram(self):
+        histogram = self.registry.histogram('handle_seconds', 'Handling', buckets=(1,), label_names=('type',))
+        histogram.labels('PUB').observe(0.5)
+
+        self.assertIn('handle_seconds_bucket{type="PUB",le="1"} 1', self.registry.render())
+
+    def test_stats_and_collectors(self):
+        self.registry.register_stats('tx', Stats(), 'Transmit')
+        self.registry.register_collector(lambda: [('spi', 'Spi', {(('type', 'read'),): 7})])
+        self.registry.register_collector(Mock(side_effect=KeyError()))
+
+        with self.assertLogs(metrics.LOGGER):
+            rendered = self.registry.render()
+        self.assertIn('# TYPE tx_sent gauge\ntx_sent 3\n', rendered)
+        self.assertIn('tx_latency 0.5\n', rendered)
+        self.assertNotIn('tx_name', rendered)
+        self.assertIn('spi{type="read"} 7\n', rendered)
+
+    def test_snapshot(self):
+        self.registry.counter('packets_total', 'Packets').inc()
+        self.registry.histogram('read_seconds', 'Reads', buckets=(1,)).observe(0.25)
+
+        self.assertEqual(dict(self.registry.snapshot()), {
+            'packets_total': 1,
+            'read_seconds_sum': 0.25,
+            'read_seconds_count': 1
+        })
+
+
+class TestEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.registry = metrics.Registry()
+        self.registry.counter('packets_total', 'Packets').inc()
+        self.server = self.loop.run_until_complete(metrics.start_metrics_server(self.registry, '127.0.0.1', 0, {
+            '/echo': self.echo
+        }))
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+
+    @asyncio.coroutine
+    def request(self, path):
+        reader, writer = yield from asyncio.open_connection('127.0.0.1', self.port)
+        writer.write('GET {0} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(path).encode())
+        response = yield from reader.read()
+        writer.close()
+        return response
+
+    def test_metrics(self):
+        response = self.loop.run_until_complete(self.request('/metrics'))
+
+        self.assertTrue(response.startswith(b'HTTP/1.0 200 OK\r\n'))
+        self.assertIn(b'Content-Type: text/plain; version=0.0.4', response)
+        self.assertTrue(response.endswith(b'\r\n\r\n# HELP packets_total Packets\n# TYPE packets_total counter\n'
+                                          b'packets_total 1\n'))
+
+    @asyncio.coroutine
+    def echo(self, query):
+        return '200 OK', 'text/plain', repr(query).encode()
+
+    def test_handlers(self):
+        response = self.loop.run_until_complete(self.request('/echo?seconds=5'))
+        self.assertTrue(response.endswith(b"{'seconds': ['5']}"))
+
+    def test_unknown_path(self):
+        response = self.loop.run_until_complete(self.request('/'))
+        self.assertTrue(response.startswith(b'HTTP/1.0 404 Not Found\r\n'))
+
+    def test_publish_status(self):
+        publisher = Mock()
+        task = asyncio.async(metrics.publish_status(publisher, self.registry, 0.001, 'gateway.status'))
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        task.cancel()
+
+        publisher.enqueue.assert_any_call('gateway.status', self.registry.snapshot())
@@ -0,0 +1,100 @@
+import setup_test
+
+setup_test.setup()
+
+import os
+import tempfile
+import unittest
+import outbox
+from unittest.mock import patch
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create_outbox(self, **kwargs):
+        options = {'segment_size': 256, 'max_size': 1024, 'max_age': 60}
+        options.update(kwargs)
+        instance = outbox.Outbox(self.directory.name, **options)
+        self.addCleanup(instance.close)
+        return instance
+
+    def segment_files(self):
+        return sorted(name for name in os.listdir(self.directory.name) if name.endswith('.seg'))
+
+    @staticmethod
+    def messages(records):
+        return [(record.routing_key, record.body, record.content_type) for record in records]
+
+    def test_messages_are_taken_in_order(self):
+        instance = self.create_outbox()
+        instance.append('a', b'{"value": 1}', 'application/json')
+        instance.append('b', bytes([0x81]), 'application/msgpack')
+        instance.append('c', b'{}', 'application/json')
+
+        self.assertEqual(len(instance), 3)
+        self.assertEqual(self.messages(instance.take(2)), [
+            ('a', b'{"value": 1}', 'application/json'),
+            ('b', bytes([0x81]), 'application/msgpack')
+        ])
+        self.assertEqual(self.messages(instance.take(5)), [('c', b'{}', 'application/json')])
+        self.assertEqual(instance.take(5), [])
+        self.assertEqual(len(instance), 0)
+
+    def test_segments_are_rotated_and_removed_once_read(self):
+        instance = self.create_outbox(max_size=4096)
+        for dummy in range(20):
+            instance.append('some.key', bytes(20), 'application/json')
+
+        self.assertGreater(len(self.segment_files()), 1)
+        self.assertEqual(len(instance.take(100)), 20)
+        self.assertEqual(len(self.segment_files()), 1)
+
+    def test_oldest_segments_are_evicted_beyond_the_maximum_size(self):
+        instance = self.create_outbox(max_size=512)
+        for value in range(30):
+            instance.append('some.key', bytes([value]) * 20, 'application/json')
+
+        self.assertLessEqual(instance.size, 512)
+        records = instance.take(100)
+        self.assertEqual(len(records) + instance.stats.evicted, 30)
+        self.assertEqual(records[-1].body, bytes([29]) * 20)
+        self.assertEqual(records[0].body[0], instance.stats.evicted)
+
+    def test_expired_messages_are_dropped(self):
+        instance = self.create_outbox()
+        with patch.object(outbox.time, 'time', return_value=1000.0):
+            instance.append('a', b'{}', 'application/json')
+        with patch.object(outbox.time, 'time', return_value=1050.0):
+            instance.append('b', b'{}', 'application/json')
+        with patch.object(outbox.time, 'time', return_value=1070.0):
+            self.assertEqual([record.routing_key for record in instance.take(5)], ['b'])
+        self.assertEqual(instance.stats.expired, 1)
+
+    def test_messages_survive_a_restart(self):
+        instance = self.create_outbox()
+        for key in ['a', 'b', 'c']:
+            instance.append(key, b'{}', 'application/json')
+        instance.take(1)
+        instance.close()
+
+        reopened = self.create_outbox()
+        self.assertEqual(len(reopened), 2)
+        self.assertEqual([record.routing_key for record in reopened.take(5)], ['b', 'c'])
+
+    def test_broken_segments_are_dropped(self):
+        with open(os.path.join(self.directory.name, '0000000000.seg'), 'wb') as segment_file:
+            segment_file.write(b'garbage' * 10)
+
+        with self.assertLogs(outbox.LOGGER):
+            instance = self.create_outbox()
+        self.assertEqual(len(instance), 0)
+        self.assertEqual(self.segment_files(), [])
+
+    def test_messages_larger_than_a_segment_are_refused(self):
+        instance = self.create_outbox()
+        self.assertRaises(ValueError, instance.append, 'a', bytes(300), 'application/json')
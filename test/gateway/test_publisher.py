@@ -0,0 +1,200 @@
+import setup_test
+
+setup_test.setup()
+
+import asyncio
+import json
+import tempfile
+import unittest
+import outbox
+import publisher
+from unittest.mock import MagicMock as Mock
+
+
+class TestPublisher(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.bus = Mock()
+        self.bus.publish.return_value = None
+        self.bus.write_buffer_size.return_value = 0
+
+    def published(self):
+        return [(call[0][0], json.loads(call[0][1].decode())) for call in self.bus.publish.call_args_list]
+
+    def test_messages_are_published_once_per_loop_iteration(self):
+        publisher_instance = publisher.Publisher()
+        publisher_instance.attach(self.bus)
+
+        self.assertTrue(publisher_instance.enqueue('a', {'value': 1}))
+        self.assertTrue(publisher_instance.enqueue('b', {'value': 2}))
+        self.assertEqual(self.bus.publish.call_count, 0)
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertEqual(self.published(), [('a', {'value': 1}), ('b', {'value': 2})])
+        stats = publisher_instance.stats.as_dict()
+        self.assertEqual((stats['published'], stats['queued']), (2, 0))
+
+    def test_messages_wait_for_the_bus(self):
+        publisher_instance = publisher.Publisher()
+        publisher_instance.enqueue('a', {'value': 1})
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        publisher_instance.attach(self.bus)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.published(), [('a', {'value': 1})])
+
+    def test_drop_policy(self):
+        publisher_instance = publisher.Publisher(max_queued=2, policy=publisher.DROP)
+
+        publisher_instance.enqueue('a', {'value': 1})
+        publisher_instance.enqueue('b', {'value': 2})
+        self.assertFalse(publisher_instance.enqueue('a', {'value': 3}))
+
+        publisher_instance.attach(self.bus)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.published(), [('a', {'value': 1}), ('b', {'value': 2})])
+        self.assertEqual(publisher_instance.stats.dropped, 1)
+
+    def test_conflate_policy(self):
+        publisher_instance = publisher.Publisher(max_queued=2, policy=publisher.CONFLATE)
+
+        publisher_instance.enqueue('a', {'value': 1})
+        publisher_instance.enqueue('b', {'value': 2})
+        self.assertTrue(publisher_instance.enqueue('a', {'value': 3}))
+        self.assertTrue(publisher_instance.enqueue('c', {'value': 4}))
+
+        publisher_instance.attach(self.bus)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.published(), [('b', {'value': 2}), ('c', {'value': 4})])
+        self.assertEqual((publisher_instance.stats.conflated, publisher_instance.stats.dropped), (1, 1))
+
+    def test_block_policy(self):
+        publisher_instance = publisher.Publisher(max_queued=1, policy=publisher.BLOCK)
+        self.loop.run_until_complete(publisher_instance.publish('a', {'value': 1}))
+        self.assertTrue(publisher_instance.blocked)
+
+        blocked = asyncio.async(publisher_instance.publish('b', {'value': 2}))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertFalse(blocked.done())
+
+        publisher_instance.attach(self.bus)
+        self.loop.run_until_complete(blocked)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.published(), [('a', {'value': 1}), ('b', {'value': 2})])
+        self.assertFalse(publisher_instance.blocked)
+
+    def test_latency_is_measured_until_the_hand_over_to_the_bus(self):
+        publisher_instance = publisher.Publisher()
+        publisher_instance.enqueue('a', {'value': 1})
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+        publisher_instance.attach(self.bus)
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        stats = publisher_instance.stats
+        self.assertEqual(stats.published, 1)
+        self.assertGreater(stats.latency_max, 0)
+        self.assertEqual(stats.latency_total, stats.latency_max)
+
+    def test_publishing_pauses_while_the_write_buffer_is_full(self):
+        self.bus.write_buffer_size.return_value = 200
+        publisher_instance = publisher.Publisher(max_queued=2, policy=publisher.DROP, write_buffer_limit=100)
+        publisher_instance.attach(self.bus)
+        publisher_instance.enqueue('a', {'value': 1})
+        publisher_instance.enqueue('b', {'value': 2})
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertEqual(self.published(), [])
+        self.assertFalse(publisher_instance.enqueue('c', {'value': 3}))
+        self.assertEqual(publisher_instance.stats.in_flight, 200)
+
+        self.bus.write_buffer_size.return_value = 0
+        self.loop.run_until_complete(asyncio.sleep(publisher.PUBLISH_DRAIN_INTERVAL * 2))
+        self.assertEqual(self.published(), [('a', {'value': 1}), ('b', {'value': 2})])
+        self.assertEqual((publisher_instance.stats.in_flight, publisher_instance.stats.max_in_flight), (0, 200))
+
+    def test_failed_publishes_are_retried(self):
+        self.bus.publish.side_effect = [ConnectionError(), None]
+        publisher_instance = publisher.Publisher()
+        publisher_instance.attach(self.bus)
+        publisher_instance.enqueue('a', {'value': 1})
+
+        with self.assertLogs(publisher.LOGGER):
+            self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(publisher_instance.stats.queued, 1)
+
+        publisher_instance.flush_handle.cancel()
+        publisher_instance.flush()
+        self.assertEqual(publisher_instance.stats.as_dict()['queued'], 0)
+        self.assertEqual(publisher_instance.stats.failed, 1)
+
+    def test_bodies_are_encoded_with_the_content_type_of_the_routing_key(self):
+        encoder = Mock()
+        encoder.encode.return_value = (bytes([0x81, 0xa1, 0x61, 0x01]), 'application/msgpack')
+        publisher_instance = publisher.Publisher(encoder=encoder)
+        publisher_instance.attach(self.bus)
+
+        publisher_instance.enqueue('a', {'a': 1})
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        encoder.encode.assert_called_once_with('a', {'a': 1})
+        self.bus.publish.assert_called_once_with('a', bytes([0x81, 0xa1, 0x61, 0x01]), 'application/msgpack')
+
+    def test_messages_that_can_not_be_encoded_are_dropped(self):
+        publisher_instance = publisher.Publisher()
+        publisher_instance.attach(self.bus)
+
+        publisher_instance.enqueue('a', {'a': object()})
+        publisher_instance.enqueue('b', {'b': 1})
+        with self.assertLogs(publisher.LOGGER):
+            self.loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertEqual(self.published(), [('b', {'b': 1})])
+        self.assertEqual(publisher_instance.stats.failed, 1)
+
+
+class TestPublisherWithOutbox(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.directory = tempfile.TemporaryDirectory()
+        self.outbox = outbox.Outbox(self.directory.name, segment_size=4096, max_size=65536, max_age=60)
+        self.bus = Mock()
+        self.bus.publish.return_value = None
+        self.bus.write_buffer_size.return_value = 0
+        self.bus.connected = True
+
+    def tearDown(self):
+        self.outbox.close()
+        self.directory.cleanup()
+
+    def published(self):
+        return [(call[0][0], json.loads(call[0][1].decode())) for call in self.bus.publish.call_args_list]
+
+    def test_messages_are_written_to_the_outbox_while_disconnected(self):
+        publisher_instance = publisher.Publisher(outbox=self.outbox)
+        publisher_instance.enqueue('a', {'value': 1})
+        self.bus.connected = False
+        publisher_instance.attach(self.bus)
+        publisher_instance.enqueue('b', {'value': 2})
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertEqual(len(self.outbox), 2)
+        self.assertEqual(self.bus.publish.call_count, 0)
+
+        self.bus.connected = True
+        publisher_instance.schedule_flush()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.published(), [('a', {'value': 1}), ('b', {'value': 2})])
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_messages_are_written_to_the_outbox_when_the_queue_is_full(self):
+        publisher_instance = publisher.Publisher(max_queued=2, policy=publisher.BLOCK, outbox=self.outbox)
+        publisher_instance.attach(self.bus)
+        for value in range(5):
+            self.assertTrue(publisher_instance.enqueue('a', {'value': value}))
+        self.assertFalse(publisher_instance.blocked)
+        self.assertEqual(len(self.outbox), 3)
+
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual(self.published(), [('a', {'value': value}) for value in range(5)])
+        self.assertEqual(self.outbox.stats.replayed, 3)
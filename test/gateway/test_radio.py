@@ -6,7 +6,7 @@ import radio
 import random
 import logging
 from unittest.mock import MagicMock as Mock
-from unittest.mock import patch
+from unittest.mock import patch, call
 
 
 class MockNRF24():
@@ -81,11 +81,7 @@ class TestRadio(unittest.TestCase):
         expected_packet = bytes(expected_packet)
         encrypted_packet = bytes([8] * 32)
         radio_instance = radio.Radio()
-        radio_instance.clients = [{
-            'client_id': 1,
-            'address': MOCK_CLIENT_ADDRESS,
-            'server_counter': 10000
-        }]
+        radio_instance.clients.register(1, MOCK_CLIENT_ADDRESS, 0, 10000)
         radio_instance.nrf24.openReadingPipe.reset_mock()
         radio_instance.nrf24.openWritingPipe.reset_mock()
         radio_instance.nrf24.startListening.reset_mock()
@@ -107,11 +103,7 @@ class TestRadio(unittest.TestCase):
     @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS)
     def test_send_packet_with_error(self):
         radio_instance = radio.Radio()
-        radio_instance.clients = [{
-            'client_id': 1,
-            'address': MOCK_CLIENT_ADDRESS,
-            'server_counter': 10000
-        }]
+        radio_instance.clients.register(1, MOCK_CLIENT_ADDRESS, 0, 10000)
         radio_instance.nrf24.write.return_value = False
 
         success = radio_instance.send_packet(1, 5, bytes([1, 2, 3, 4]))
@@ -119,11 +111,69 @@ class TestRadio(unittest.TestCase):
         self.assertEqual(success, False)
         self.assertEqual(radio_instance.nrf24.write.call_count, 10)
 
+    @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS)
+    @patch.object(radio, 'encrypt_packet')
+    def test_send_packets_switches_modes_once_and_groups_by_address(self, encrypt_mock):
+        radio_instance = radio.Radio()
+        radio_instance.clients.register(1, MOCK_CLIENT_ADDRESS, 0, 100)
+        radio_instance.clients.register(2, OTHER_MOCK_CLIENT_ADDRESS, 0, 200)
+        radio_instance.nrf24.openWritingPipe.reset_mock()
+        radio_instance.nrf24.startListening.reset_mock()
+        radio_instance.nrf24.write.side_effect = [True, True] + [False] * 10
+        encrypt_mock.side_effect = lambda packet: packet
+
+        results = radio_instance.send_packets([
+            (1, 4, bytes([1])),
+            (2, 4, bytes([2])),
+            (1, 4, bytes([3])),
+            (3, 4, bytes([4])),
+        ])
+
+        self.assertEqual(results, [True, False, True, False])
+        radio_instance.nrf24.stopListening.assert_called_once_with()
+        radio_instance.nrf24.startListening.assert_called_once_with()
+        self.assertEqual(radio_instance.nrf24.openWritingPipe.call_args_list,
+                         [call(MOCK_CLIENT_ADDRESS), call(OTHER_MOCK_CLIENT_ADDRESS)])
+        written_payloads = [c[0][0][4] for c in radio_instance.nrf24.write.call_args_list]
+        self.assertEqual(written_payloads[:3], [1, 3, 2])
+        self.assertEqual(radio_instance.clients.get(1).server_counter, 102)
+        self.assertEqual(radio_instance.clients.get(2).server_counter, 200)
+        self.assertEqual(radio_instance.tx_stats.batches, 1)
+        self.assertEqual(radio_instance.tx_stats.packets, 2)
+        self.assertGreaterEqual(radio_instance.tx_stats.deaf_time_max, radio_instance.tx_stats.deaf_time_last)
+
+    @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS)
+    def test_send_packets_without_known_clients_stays_in_rx_mode(self):
+        radio_instance = radio.Radio()
+
+        with self.assertLogs(radio.LOGGER):
+            self.assertEqual(radio_instance.send_packets([(1, 4, bytes([1]))]), [False])
+
+        self.assertFalse(radio_instance.nrf24.stopListening.called)
+        self.assertEqual(radio_instance.tx_stats.batches, 0)
+
+    @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS)
+    @patch.object(radio, 'encrypt_packet')
+    def test_send_packets_returns_to_rx_mode_when_a_write_fails(self, encrypt_mock):
+        radio_instance = radio.Radio()
+        radio_instance.clients.register(1, MOCK_CLIENT_ADDRESS, 0, 100)
+        radio_instance.nrf24.startListening.reset_mock()
+        radio_instance.nrf24.write.side_effect = OSError('SPI transfer failed')
+        encrypt_mock.side_effect = lambda packet: packet
+
+        with self.assertRaises(OSError):
+            radio_instance.send_packets([(1, 4, bytes([1]))])
+
+        radio_instance.nrf24.startListening.assert_called_once_with()
+        self.assertFalse(radio_instance.ack_payload_loaded)
+        self.assertEqual(radio_instance.tx_stats.batches, 1)
+        self.assertEqual(radio_instance.tx_stats.packets, 0)
+
     def setup_for_test_get_packet(self):
         radio_instance = radio.Radio()
         radio_instance.nrf24.available.return_value = True
         radio_instance.has_client_id = Mock(return_value=True)
-        radio_instance.is_counter_is_in_expected_range = Mock(return_value=True)
+        radio_instance.accept_counter = Mock(return_value=True)
         client_id = 100
         message_id = 101
         payload = [1, 2, 3, 4]
@@ -138,17 +188,16 @@ class TestRadio(unittest.TestCase):
     @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS, decrypt_packet=Mock())
     def test_get_packet_with_a_packet_available(self):
         radio_instance = self.setup_for_test_get_packet()
-        radio_instance.clients.append({'client_id': 100, 'client_counter': 9999})
+        radio_instance.clients.register(100, MOCK_CLIENT_ADDRESS, 9999, 0)
 
         client_id, message_id, payload = radio_instance.get_packet()
 
         self.assertEqual(client_id, 100)
         self.assertEqual(message_id, 101)
         self.assertEqual(payload, bytes([1, 2, 3, 4]))
-        self.assertEqual(radio_instance.clients[0]['client_counter'], 10000)
         radio.decrypt_packet.assert_called_once_with([])
         radio_instance.has_client_id.assert_called_once_with(100)
-        radio_instance.is_counter_is_in_expected_range.assert_called_once_with(100, 10000)
+        radio_instance.accept_counter.assert_called_once_with(100, 10000)
 
     @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS, decrypt_packet=Mock())
     def test_get_packet_with_a_packet_that_has_a_unknown_client_id(self):
@@ -160,7 +209,7 @@ class TestRadio(unittest.TestCase):
     @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS, decrypt_packet=Mock())
     def test_get_packet_with_a_packet_that_has_a_counter_that_is_not_in_the_expected_range(self):
         radio_instance = self.setup_for_test_get_packet()
-        radio_instance.is_counter_is_in_expected_range.return_value = False
+        radio_instance.accept_counter.return_value = False
 
         self.assertEqual(radio_instance.get_packet(), False)
 
@@ -174,6 +223,87 @@ class TestRadio(unittest.TestCase):
         self.assertEqual(radio_instance.get_packet(), False)
         radio_instance.nrf24.writeAckPayload.assert_called_once_with(1, expected_ack_payload, 8)
 
+    @patch.multiple(radio, NRF24=MockNRF24, SERVER_ID=MOCK_SERVER_ID, SERVER_ADDRESS=MOCK_SERVER_ADDRESS,
+                    decrypt_packet=Mock())
+    def test_get_packets_drains_the_fifo(self):
+        expected_ack_payload = bytes(MOCK_SERVER_ID) + bytes([MOCK_SERVER_CHECKSUM])
+        radio_instance = self.setup_for_test_get_packet()
+        radio_instance.nrf24.available.side_effect = [True, True, False]
+        radio_instance.read_packet = Mock(side_effect=[(1, 4, bytes([1])), False])
+
+        packets, read = radio_instance.get_packets()
+
+        self.assertEqual(packets, [(1, 4, bytes([1]))])
+        self.assertEqual(read, 2)
+        self.assertEqual(radio_instance.read_packet.call_count, 2)
+        self.assertEqual(radio_instance.rx_fifo_overflows, 0)
+        radio_instance.nrf24.writeAckPayload.assert_called_once_with(1, expected_ack_payload, 8)
+
+    @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS, decrypt_packet=Mock())
+    def test_get_packets_counts_a_full_fifo(self):
+        radio_instance = self.setup_for_test_get_packet()
+        radio_instance.nrf24.available.side_effect = [True, True, True, False]
+        radio_instance.read_packet = Mock(return_value=(1, 4, bytes([1])))
+
+        with self.assertLogs(radio.LOGGER):
+            packets, read = radio_instance.get_packets()
+
+        self.assertEqual(len(packets), 3)
+        self.assertEqual(read, 3)
+        self.assertEqual(radio_instance.rx_fifo_overflows, 1)
+
+    @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS, decrypt_packet=Mock())
+    def test_get_packets_stops_at_limit(self):
+        radio_instance = self.setup_for_test_get_packet()
+        radio_instance.read_packet = Mock(return_value=(1, 4, bytes([1])))
+
+        packets, read = radio_instance.get_packets(2)
+
+        self.assertEqual(len(packets), 2)
+        self.assertEqual(read, 2)
+        self.assertFalse(radio_instance.nrf24.writeAckPayload.called)
+
+    @patch.multiple(radio, NRF24=MockNRF24, SERVER_ID=MOCK_SERVER_ID, SERVER_ADDRESS=MOCK_SERVER_ADDRESS,
+                    decrypt_packet=Mock())
+    def test_ack_payload_is_only_written_again_after_it_was_consumed(self):
+        radio_instance = self.setup_for_test_get_packet()
+        radio_instance.nrf24.available.return_value = False
+
+        radio_instance.get_packet()
+        radio_instance.get_packet()
+        self.assertEqual(radio_instance.nrf24.writeAckPayload.call_count, 1)
+
+        radio_instance.nrf24.available.return_value = True
+        radio_instance.get_packet()
+        radio_instance.nrf24.available.return_value = False
+        radio_instance.get_packet()
+        self.assertEqual(radio_instance.nrf24.writeAckPayload.call_count, 2)
+
+    @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS)
+    def test_sending_flushes_the_ack_payload(self):
+        radio_instance = radio.Radio()
+        radio_instance.clients.register(1, MOCK_CLIENT_ADDRESS, 0, 0)
+        radio_instance.nrf24.available.return_value = False
+        radio_instance.nrf24.write.return_value = True
+
+        radio_instance.get_packet()
+        radio_instance.send_packet(1, 4, bytes([1]))
+        radio_instance.get_packet()
+
+        self.assertEqual(radio_instance.nrf24.writeAckPayload.call_count, 2)
+
+    @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS, decrypt_packet=Mock())
+    def test_spi_transactions_are_counted_by_type(self):
+        radio_instance = self.setup_for_test_get_packet()
+        radio_instance.nrf24.available.side_effect = [True, False]
+        radio_instance.get_packets()
+
+        rates = radio_instance.spi_stats.rates()
+
+        self.assertEqual(set(rates), {'available', 'read', 'ack_payload'})
+        self.assertGreater(rates['available'], rates['read'])
+        self.assertEqual(radio_instance.spi_stats.rates(), {})
+
     @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS, decrypt_packet=Mock())
     def test_get_packet_with_registration_message(self):
         address = MOCK_CLIENT_ADDRESS
@@ -191,60 +321,73 @@ class TestRadio(unittest.TestCase):
         self.assertEqual(client_id, expected_client_id)
         self.assertEqual(message_id, registration_message_id)
         self.assertEqual(payload, bytes(address[::-1]))
-        self.assertEqual(radio_instance.clients[0]['client_id'], expected_client_id)
-        self.assertEqual(radio_instance.clients[0]['client_counter'], 10000)
+        self.assertEqual(radio_instance.clients.get(expected_client_id).address, address)
+        self.assertEqual(radio_instance.clients.get(expected_client_id).client_counter, 9999)
+        radio_instance.accept_counter.assert_called_once_with(expected_client_id, 10000)
 
     @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS)
-    def test_is_counter_in_expected_range(self):
+    def test_accept_counter(self):
         client_id = 100
         current_client_counter = 65533
         test_cases = [
-            (100, False),
             (65533, False),
             (65534, True),
             (65535, True),
             (0, True),
             (7, True),
-            (8, False),
-            (10, False),
+            (100, True),
+            (2000, False),
+            (65000, False),
         ]
 
-        radio_instance = radio.Radio()
-        radio_instance.clients.append({'client_id': client_id, 'client_counter': current_client_counter})
         for counter, expected in test_cases:
             with self.subTest(counter=counter, expected=expected):
-                self.assertEqual(radio_instance.is_counter_is_in_expected_range(client_id, counter), expected)
+                radio_instance = radio.Radio()
+                radio_instance.clients.register(client_id, MOCK_CLIENT_ADDRESS, current_client_counter, 0)
+                self.assertEqual(radio_instance.accept_counter(client_id, counter), expected)
+
+    @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS)
+    def test_accept_counter_rejects_replayed_packets(self):
+        radio_instance = radio.Radio()
+        radio_instance.clients.register(100, MOCK_CLIENT_ADDRESS, 10, 0)
+
+        self.assertEqual(radio_instance.accept_counter(100, 12), True)
+        self.assertEqual(radio_instance.accept_counter(100, 11), True)
+        with self.assertLogs(radio.LOGGER):
+            self.assertEqual(radio_instance.accept_counter(100, 12), False)
+        self.assertEqual(radio_instance.clients.get(100).client_counter, 12)
 
     @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS)
     def test_has_client_id(self):
         client_id = 100
         test_cases = [
-            ([{'client_id': 100}], True),
-            ([{'client_id': 101}], False),
+            ([100], True),
+            ([101], False),
             ([], False),
         ]
-        radio_instance = radio.Radio()
-        for clients, expected in test_cases:
-            with self.subTest(clients=clients, expected=expected):
-                radio_instance.clients = clients
+        for client_ids, expected in test_cases:
+            with self.subTest(client_ids=client_ids, expected=expected):
+                radio_instance = radio.Radio()
+                for i in client_ids:
+                    radio_instance.clients.register(i, MOCK_CLIENT_ADDRESS, 0, 0)
                 self.assertEqual(radio_instance.has_client_id(client_id), expected)
 
     @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS)
     def test_get_client_id_with_new_client_address(self):
         radio_instance = radio.Radio()
-        number_already_registered = random.randint(0, 255)
+        number_already_registered = random.randint(0, 253)
 
         for i in range(number_already_registered):
-            radio_instance.clients.append({'client_id': i+1, 'address': OTHER_MOCK_CLIENT_ADDRESS})
+            radio_instance.clients.register(i+1, [0, 0, 0, 1, i], 0, 0)
 
         self.assertEqual(radio_instance.get_client_id(MOCK_CLIENT_ADDRESS), number_already_registered+1)
 
     @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS)
     def test_get_client_id_with_existing_client_address(self):
         radio_instance = radio.Radio()
-        expected_client_id = random.randint(1, 255)
+        expected_client_id = random.randint(1, 254)
 
-        radio_instance.clients.append({'client_id': expected_client_id, 'address': MOCK_CLIENT_ADDRESS})
+        radio_instance.clients.register(expected_client_id, MOCK_CLIENT_ADDRESS, 0, 0)
 
         self.assertEqual(radio_instance.get_client_id(MOCK_CLIENT_ADDRESS), expected_client_id)
 
@@ -254,9 +397,48 @@ class TestRadio(unittest.TestCase):
         number_already_registered = 254
 
         for i in range(number_already_registered):
-            radio_instance.clients.append({'client_id': i+1, 'address': OTHER_MOCK_CLIENT_ADDRESS})
+            radio_instance.clients.register(i+1, [0, 0, 0, 1, i], 0, 0)
 
         self.assertEqual(radio_instance.get_client_id(MOCK_CLIENT_ADDRESS), False)
 
+    @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS)
+    def test_handle_registration_message_without_remaining_client_ids(self):
+        radio_instance = radio.Radio()
+        for i in range(254):
+            radio_instance.clients.register(i+1, [0, 0, 0, 1, i], 0, 0)
+
+        with self.assertLogs(radio.LOGGER):
+            client_id = radio_instance.handle_registration_message(10, bytes(MOCK_CLIENT_ADDRESS[::-1]))
 
+        self.assertEqual(client_id, False)
+        self.assertEqual(len(radio_instance.clients), 254)
+
+    @patch.multiple(radio, NRF24=MockNRF24, SERVER_ADDRESS=MOCK_SERVER_ADDRESS)
+    def test_send_packet_to_unknown_client(self):
+        radio_instance = radio.Radio()
+
+        with self.assertLogs(radio.LOGGER):
+            self.assertEqual(radio_instance.send_packet(1, 5, bytes([1, 2, 3, 4])), False)
+
+        self.assertFalse(radio_instance.nrf24.write.called)
+
+
+class TestNextPollInterval(unittest.TestCase):
+    def test_next_poll_interval(self):
+        limit = radio.MAX_PACKETS_PER_DRAIN
+        test_cases = [
+            (radio.POLL_INTERVAL_MAX, limit, 0),
+            (radio.POLL_INTERVAL_MAX, 2, radio.POLL_INTERVAL_MIN),
+            (0, 1, radio.POLL_INTERVAL_MIN),
+            (0, 0, radio.POLL_INTERVAL_MIN * 2),
+            (radio.POLL_INTERVAL_MIN, 0, radio.POLL_INTERVAL_MIN * 2),
+            (radio.POLL_INTERVAL_MIN * 4, 0, radio.POLL_INTERVAL_MIN * 8),
+            (radio.POLL_INTERVAL_MAX, 0, radio.POLL_INTERVAL_MAX),
+        ]
+        for interval, read, expected in test_cases:
+            with self.subTest(interval=interval, read=read, expected=expected):
+                self.assertEqual(radio.next_poll_interval(interval, read, limit), expected)
 
+    def test_next_poll_interval_with_custom_maximum(self):
+        self.assertEqual(radio.next_poll_interval(0.8, 0, 10, 1.0), 1.0)
+        self.assertEqual(radio.next_poll_interval(0.2, 0, 10, 1.0), 0.4)
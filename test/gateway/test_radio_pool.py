@@ -0,0 +1,120 @@
+import setup_test
+
+setup_test.setup()
+
+import unittest
+import asyncio
+import random
+import radio
+import radio_pool
+import simulation
+from constants import PacketTypes
+from struct import pack
+from unittest.mock import MagicMock as Mock, patch
+
+SERVER_ADDRESS = [0xf0, 0xf0, 0xf0, 0xf0, 0xe1]
+CLIENT_ADDRESS = [0xc0, 0x00, 0x00, 0x00, 0x01]
+OTHER_CLIENT_ADDRESS = [0xc0, 0x00, 0x00, 0x00, 0x02]
+CONFIGS = [
+    {'spi_device': 0, 'ce_pin': 25, 'irq_pin': 24, 'channel': simulation.RADIO_CHANNEL},
+    {'spi_device': 1, 'ce_pin': 23, 'irq_pin': 22, 'channel': simulation.RADIO_CHANNEL + 2},
+]
+
+
+@patch.multiple(radio, SERVER_ADDRESS=SERVER_ADDRESS)
+@patch.multiple(simulation, SERVER_ADDRESS=SERVER_ADDRESS)
+class TestRadioPool(unittest.TestCase):
+    def setUp(self):
+        self.medium = simulation.VirtualMedium(rng=random.Random(1))
+        modules = [simulation.SimulatedNRF24(self.medium) for dummy in CONFIGS]
+        self.pool = radio_pool.create_radio_pool(CONFIGS, modules)
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def register(self, address):
+        client = simulation.VirtualClient(self.medium, address, rng=random.Random(2))
+        client.start_registration()
+        packets, dummy_read = self.pool.get_packets(10)
+        client_id = packets[0][0]
+        return client, client_id
+
+    def test_radios_share_one_registry(self):
+        self.assertEqual([radio_instance.channel for radio_instance in self.pool.radios], [0x4c, 0x4e])
+        self.assertEqual([radio_instance.index for radio_instance in self.pool.radios], [0, 1])
+        self.assertIs(self.pool.radios[1].clients, self.pool.clients)
+
+    @setup_test.async_test
+    def test_clients_move_to_the_radio_they_were_assigned_to(self):
+        self.pool.start([radio_instance.send_packets for radio_instance in self.pool.radios])
+        self.register(CLIENT_ADDRESS)
+        client, client_id = self.register(OTHER_CLIENT_ADDRESS)
+        self.assertEqual(client_id, 257)
+        self.assertEqual(self.pool.clients.get(client_id).radio, 0)
+
+        success = yield from self.pool.send_packet(
+            client_id, PacketTypes.REGISTER_SERVER_ACK,
+            pack('B7sB', 1, bytes(radio.SERVER_ID), self.pool.radios[0].server_id_checksum)
+        )
+        self.assertTrue(success)
+        client.poll()
+        self.assertTrue(client.session.registered)
+        self.assertEqual(client.session.client_id, 1)
+        self.assertEqual(client.endpoint.channel, CONFIGS[1]['channel'])
+
+        self.assertTrue(client.publish(3, bytes([1, 2])))
+        self.assertEqual(self.pool.radios[0].get_packets(10), ([], 0))
+        packets, dummy_read = self.pool.radios[1].get_packets(10)
+        self.assertEqual(packets, [(257, PacketTypes.PUB, bytes([3, 1, 2]))])
+        self.assertEqual(self.pool.clients.get(client_id).radio, 1)
+
+    @setup_test.async_test
+    def test_packets_are_sent_by_the_radio_the_client_was_heard_on(self):
+        send_functions = [Mock(side_effect=lambda packets: [True] * len(packets)) for dummy in CONFIGS]
+        self.pool.start(send_functions)
+        self.pool.clients.register(1, CLIENT_ADDRESS, 0, 0)
+        self.pool.clients.register(257, OTHER_CLIENT_ADDRESS, 0, 0)
+
+        yield from asyncio.gather(
+            self.pool.send_packet(1, PacketTypes.PUB, bytes([0, 1])),
+            self.pool.send_packet(257, PacketTypes.PUB, bytes([0, 2])),
+            self.pool.send_packet(258, PacketTypes.PUB, bytes([0, 3]))
+        )
+
+        send_functions[0].assert_called_once_with([(1, PacketTypes.PUB, bytes([0, 1]))])
+        send_functions[1].assert_called_once_with([(257, PacketTypes.PUB, bytes([0, 2])),
+                                                   (258, PacketTypes.PUB, bytes([0, 3]))])
+
+    def test_clients_without_the_register_flag_stay_on_the_first_radio(self):
+        self.register(CLIENT_ADDRESS)
+        client = simulation.VirtualClient(self.medium, OTHER_CLIENT_ADDRESS, rng=random.Random(3))
+
+        client.send_packet(PacketTypes.REGISTER, bytes(OTHER_CLIENT_ADDRESS[::-1]) + bytes(3))
+        packets, dummy_read = self.pool.get_packets(10)
+
+        self.assertEqual(packets[0][0], 2)
+
+    def test_get_packets_reads_all_radios(self):
+        first = simulation.VirtualClient(self.medium, CLIENT_ADDRESS, rng=random.Random(3))
+        first.start_registration()
+        second = simulation.VirtualClient(self.medium, OTHER_CLIENT_ADDRESS, rng=random.Random(4))
+        second.switch_channel(CONFIGS[1]['channel'])
+        second.switch_channel(CONFIGS[1]['channel'])
+        second.send_packet(PacketTypes.REGISTER, bytes(OTHER_CLIENT_ADDRESS[::-1]) + bytes(3))
+        second.send_packet(PacketTypes.REGISTER, bytes(OTHER_CLIENT_ADDRESS[::-1]) + bytes(3))
+
+        packets, most_read = self.pool.get_packets(10)
+
+        self.assertEqual(len(packets), 3)
+        self.assertEqual(most_read, 2)
+
+    def test_measure_utilization(self):
+        self.pool.radios[1].airtime = Mock(return_value=5.0)
+        self.pool.airtime = [0.0, 4.0]
+        self.pool.measured_at -= 10
+
+        self.pool.measure()
+
+        self.assertEqual(self.pool.utilization[0], 0.0)
+        self.assertAlmostEqual(self.pool.utilization[1], 0.1, places=2)
+        self.assertIsNotNone(self.pool.measure_handle)
@@ -0,0 +1,105 @@
+import setup_test
+
+setup_test.setup()
+
+import unittest
+import asyncio
+import threading
+import radio_worker
+from unittest.mock import MagicMock as Mock
+
+
+class TestRadioWorker(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.radio = Mock()
+        self.radio.get_packets.return_value = ([], 0)
+        self.worker = radio_worker.RadioWorker(self.loop, self.radio, 0.01)
+
+    def tearDown(self):
+        self.worker.stop()
+
+    @setup_test.async_test
+    def test_send_packet_resolves_with_the_result_of_the_radio(self):
+        self.radio.send_packet.return_value = True
+        self.worker.start()
+
+        result = yield from asyncio.wait_for(self.worker.send_packet(1, 4, bytes([1, 2])), 1)
+
+        self.assertEqual(result, True)
+        self.radio.send_packet.assert_called_once_with(1, 4, bytes([1, 2]))
+
+    @setup_test.async_test
+    def test_send_packets_resolves_with_the_results_of_the_radio(self):
+        self.radio.send_packets.return_value = [True, False]
+        self.worker.start()
+        packets = [(1, 4, bytes([1])), (2, 4, bytes([2]))]
+
+        result = yield from asyncio.wait_for(self.worker.send_packets(packets), 1)
+
+        self.assertEqual(result, [True, False])
+        self.radio.send_packets.assert_called_once_with(packets)
+
+    @setup_test.async_test
+    def test_send_packet_resolves_with_the_error_of_the_radio(self):
+        self.radio.send_packet.side_effect = IOError('spi')
+        self.worker.start()
+
+        with self.assertLogs(radio_worker.LOGGER):
+            with self.assertRaises(IOError):
+                yield from asyncio.wait_for(self.worker.send_packet(1, 4, bytes([1, 2])), 1)
+
+    @setup_test.async_test
+    def test_received_packets_are_put_into_the_queue(self):
+        packets = [([(1, 4, bytes([1])), (2, 4, bytes([2]))], 2)]
+        self.radio.get_packets.side_effect = lambda limit: packets.pop() if packets else ([], 0)
+        self.worker.start()
+
+        first = yield from asyncio.wait_for(self.worker.packets.get(), 1)
+        second = yield from asyncio.wait_for(self.worker.packets.get(), 1)
+
+        self.assertEqual(first, (1, 4, bytes([1])))
+        self.assertEqual(second, (2, 4, bytes([2])))
+        self.radio.get_packets.assert_any_call(radio_worker.MAX_PACKETS_PER_DRAIN)
+
+    def test_wake_makes_the_worker_drain_the_radio(self):
+        drained = threading.Event()
+        self.radio.get_packets.side_effect = lambda limit: drained.set() or ([], 0)
+        self.worker = radio_worker.RadioWorker(self.loop, self.radio, 60)
+        self.worker.start()
+
+        self.worker.wake(24)
+
+        self.assertTrue(drained.wait(1))
+        self.radio.get_packets.assert_called_once_with(radio_worker.MAX_PACKETS_PER_DRAIN)
+
+    def test_paused_worker_does_not_drain_the_radio(self):
+        drained = threading.Event()
+        self.radio.get_packets.side_effect = lambda limit: drained.set() or ([], 0)
+        self.radio.send_packet.return_value = True
+        self.worker.pause()
+        self.worker.start()
+
+        result = self.loop.run_until_complete(asyncio.wait_for(self.worker.send_packet(1, 4, bytes([1])), 1))
+        self.assertTrue(result)
+        self.assertFalse(drained.wait(0.05))
+
+        self.worker.resume()
+        self.assertTrue(drained.wait(1))
+
+    def test_stop_ends_the_thread(self):
+        self.worker.start()
+        thread = self.worker.thread
+
+        self.worker.stop()
+
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(self.worker.thread)
+
+    def test_resolve_future_ignores_cancelled_futures(self):
+        future = asyncio.Future(loop=self.loop)
+        future.cancel()
+
+        radio_worker.resolve_future(future, True)
+
+        self.assertTrue(future.cancelled())
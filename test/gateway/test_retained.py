@@ -0,0 +1,106 @@
+import setup_test
+
+setup_test.setup()
+
+import asyncio
+import unittest
+import retained
+from unittest.mock import MagicMock as Mock
+
+
+class TestRetainedCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = retained.RetainedCache(max_size=3, max_age=10)
+        self.cache.loop = Mock()
+        self.cache.loop.time.return_value = 100.0
+
+    def test_get(self):
+        self.cache.put('a', {'value': 1})
+        self.cache.put('a', {'value': 2})
+
+        self.assertEqual(self.cache.get('a'), {'value': 2})
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual((self.cache.stats.hits, self.cache.stats.misses), (1, 1))
+
+    def test_least_recently_used_keys_are_evicted(self):
+        for key in ['a', 'b', 'c']:
+            self.cache.put(key, {})
+        self.cache.get('a')
+        self.cache.put('d', {})
+
+        self.assertEqual(list(self.cache.messages), ['c', 'a', 'd'])
+        self.assertEqual(self.cache.stats.evicted, 1)
+
+    def test_old_messages_expire(self):
+        self.cache.put('a', {})
+        self.cache.loop.time.return_value = 111.0
+
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.stats.expired, 1)
+
+    def test_match(self):
+        self.cache.put('house.kitchen.switch', {'value': 1})
+        self.cache.loop.time.return_value = 101.0
+        self.cache.put('house.garden.temperature', {'value': 2})
+        self.cache.loop.time.return_value = 102.0
+        self.cache.put('house.hall.switch', {'value': 3})
+        self.cache.get('house.kitchen.switch')
+
+        self.assertEqual(self.cache.match('house.*.switch'), [
+            ('house.kitchen.switch', {'value': 1}),
+            ('house.hall.switch', {'value': 3})
+        ])
+        self.assertEqual(self.cache.match('house.garden.temperature'), [('house.garden.temperature', {'value': 2})])
+        self.assertEqual(self.cache.match('garden.#'), [])
+        self.assertEqual((self.cache.stats.hits, self.cache.stats.misses), (3, 1))
+
+
+class TestActuatorStates(unittest.TestCase):
+    def setUp(self):
+        self.states = retained.ActuatorStates(retained.RetainedStats())
+
+    def test_unchanged_payloads_are_suppressed(self):
+        self.assertTrue(self.states.changed(1, 2, b'\x01'))
+        self.states.sent(1, 2, b'\x01', None)
+
+        self.assertFalse(self.states.changed(1, 2, b'\x01'))
+        self.assertTrue(self.states.changed(1, 2, b'\x00'))
+        self.assertTrue(self.states.changed(1, 3, b'\x01'))
+        self.assertEqual(self.states.stats.suppressed, 1)
+
+        self.states.clear(1)
+        self.assertTrue(self.states.changed(1, 2, b'\x01'))
+
+    def test_payloads_that_were_not_acknowledged_are_sent_again(self):
+        loop = asyncio.get_event_loop()
+        failed, succeeded = asyncio.Future(), asyncio.Future()
+        self.states.sent(1, 2, b'\x01', failed)
+        self.states.sent(1, 3, b'\x01', succeeded)
+        failed.set_result(False)
+        succeeded.set_result(True)
+        loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertTrue(self.states.changed(1, 2, b'\x01'))
+        self.assertFalse(self.states.changed(1, 3, b'\x01'))
+
+    def test_payloads_still_being_sent_are_not_suppressed(self):
+        loop = asyncio.get_event_loop()
+        pending = asyncio.Future()
+        self.states.sent(1, 2, b'\x01', pending)
+
+        self.assertTrue(self.states.changed(1, 2, b'\x01'))
+        pending.set_result(True)
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertFalse(self.states.changed(1, 2, b'\x01'))
+        self.assertEqual(self.states.in_flight, {})
+
+    def test_acknowledgements_from_before_a_new_registration_are_ignored(self):
+        loop = asyncio.get_event_loop()
+        pending = asyncio.Future()
+        self.states.sent(1, 2, b'\x01', pending)
+        self.states.clear(1)
+        pending.set_result(True)
+        loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertTrue(self.states.changed(1, 2, b'\x01'))
@@ -2,11 +2,17 @@ import setup_test
 
 setup_test.setup()
 
+import asyncio
 import unittest
+import bus
 import router
 import random
+import scheduler
+import struct
+import timeseries
 import transforms
 from asyncio import Future
+from constants import Priority
 from unittest.mock import MagicMock as Mock
 from unittest.mock import patch
 
@@ -14,6 +20,12 @@ MOCK_SERVER_ID = [1, 2, 3, 4, 5, 6, 7]
 MOCK_SERVER_CHECKSUM = 121
 
 
+def create_future_with_result(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
 class TestRouter(unittest.TestCase):
     def setUp(self):
         self.send_packet_stub = Mock()
@@ -26,38 +38,53 @@ class TestRouter(unittest.TestCase):
         router_instance = router.Router()
         self.assertEqual(router_instance.transforms, expected_transforms)
 
-    @patch.multiple(router, asynqp=Mock(), RABBITMQ_HOST='a', RABBITMQ_PORT=1, RABBITMQ_USERNAME='b',
-                    RABBITMQ_PASSWORD='c', RABBITMQ_VIRTUAL_HOST='d')
     @setup_test.async_test
     def test_connect_to_message_queue(self):
-        def create_future_with_result(result):
-            future = Future()
-            future.set_result(result)
-            return future
+        bus_stub = Mock()
+        bus_stub.connect.return_value = create_future_with_result(None)
+        bus_stub.consume.return_value = create_future_with_result(None)
+        bus_stub.bind.return_value = create_future_with_result(None)
+        router_instance = router.Router(bus_stub)
 
-        router_instance = router.Router()
+        yield from router_instance.connect_to_message_queue()
 
-        connection_stub = Mock()
-        channel_stub = Mock()
-        exchange_stub = Mock()
-        queue_stub = Mock()
+        bus_stub.connect.assert_called_once_with()
+        bus_stub.consume.assert_called_once_with(router_instance.handle_message)
+        self.assertIs(router_instance.bindings.bus, bus_stub)
+        self.assertIs(router_instance.publisher.bus, bus_stub)
 
-        router.asynqp.connect.return_value = create_future_with_result(connection_stub)
-        connection_stub.open_channel.return_value = create_future_with_result(channel_stub)
-        channel_stub.declare_exchange.return_value = create_future_with_result(exchange_stub)
-        channel_stub.declare_queue.return_value = create_future_with_result(queue_stub)
+    @patch.multiple(router, RECONNECT_INTERVAL=0.001, RECONNECT_INTERVAL_MAX=0.002)
+    @setup_test.async_test
+    def test_connecting_is_retried(self):
+        bus_stub = Mock()
+        bus_stub.connect.side_effect = [ConnectionError(), ConnectionError(), create_future_with_result(None)]
+        bus_stub.consume.return_value = create_future_with_result(None)
+        bus_stub.bind.return_value = create_future_with_result(None)
+        router_instance = router.Router(bus_stub)
 
-        yield from router_instance.connect_to_message_queue()
+        with self.assertLogs(router.LOGGER) as logs:
+            yield from router_instance.connect_to_message_queue()
 
-        self.assertEqual(router_instance.connection, connection_stub)
-        self.assertEqual(router_instance.channel, channel_stub)
-        self.assertEqual(router_instance.exchange, exchange_stub)
-        self.assertEqual(router_instance.queue, queue_stub)
-        router.asynqp.connect.assert_called_once_with('a', 1, 'b', 'c', 'd')
-        connection_stub.open_channel.assert_called_once_with()
-        channel_stub.declare_exchange.assert_called_once('gateway.exchange', 'topic')
-        channel_stub.declare_queue.assert_called_once('gateway.queue')
+        self.assertEqual(bus_stub.connect.call_count, 3)
+        self.assertEqual(len(logs.output), 2)
+        self.assertIs(router_instance.publisher.bus, bus_stub)
 
+    @setup_test.async_test
+    def test_reconnects_when_the_connection_is_lost(self):
+        bus_stub = Mock()
+        bus_stub.connect.return_value = create_future_with_result(None)
+        bus_stub.consume.return_value = create_future_with_result(None)
+        bus_stub.bind.return_value = create_future_with_result(None)
+        router.Router(bus_stub)
+
+        with self.assertLogs(router.LOGGER):
+            bus_stub.on_disconnect()
+        yield from asyncio.sleep(0)
+
+        bus_stub.connect.assert_called_once_with()
+
+    def test_message_bus_from_settings(self):
+        self.assertIsInstance(router.Router().bus, bus.AmqpBus)
 
     @patch.multiple(router, SERVER_ID=MOCK_SERVER_ID, SERVER_ID_CHECKSUM=MOCK_SERVER_CHECKSUM)
     @setup_test.async_test
@@ -76,10 +103,23 @@ class TestRouter(unittest.TestCase):
                                                  registration_packet_id,
                                                  payload)
 
-        self.send_packet_stub.assert_called_once_with(expected_client_id, expected_packet_id, expected_response)
+        self.send_packet_stub.assert_called_once_with(expected_client_id, expected_packet_id, expected_response,
+                                                      Priority.HIGH)
         router_instance.clear_subscription_channels.assert_called_once_with(expected_client_id)
         router_instance.clear_publish_channels.assert_called_once_with(expected_client_id)
 
+    @patch.multiple(router, SERVER_ID=MOCK_SERVER_ID, SERVER_ID_CHECKSUM=MOCK_SERVER_CHECKSUM)
+    @setup_test.async_test
+    def test_registration_ack_has_the_client_id_used_on_air(self):
+        router_instance = router.Router()
+        router_instance.set_send_packet(self.send_packet_stub)
+
+        yield from router_instance.handle_packet(2 << 8 | 17, 0, bytes([1, 2, 3]))
+
+        self.send_packet_stub.assert_called_once_with(
+            2 << 8 | 17, 1, bytes([17]) + bytes(MOCK_SERVER_ID) + bytes([MOCK_SERVER_CHECKSUM]), Priority.HIGH
+        )
+
     @setup_test.async_test
     def test_it_should_handle_a_subscription_channel_packet(self):
         subscription_packet_id = 3
@@ -137,25 +177,22 @@ class TestRouter(unittest.TestCase):
         transform_mock.to_message.return_value = expected_message
 
         router_instance = router.Router()
-        router_instance.exchange = Mock()
+        router_instance.bus = Mock()
+        router_instance.bus.publish.return_value = None
+        router_instance.bus.write_buffer_size.return_value = 0
+        router_instance.publisher.attach(router_instance.bus)
         router_instance.transforms[transform_id] = transform_mock
-        router_instance.publish_channels = {
-            client_id: [
-                {'channel_id': channel_id, 'transform_id': transform_id, 'routing_key': expected_routing_key}
-            ]
-        }
+        router_instance.routes.add_publish_channel(client_id, expected_routing_key, channel_id, transform_id)
 
         yield from router_instance.handle_packet(client_id,
                                                  publish_packet_id,
                                                  payload)
+        yield from asyncio.sleep(0)
 
         transform_mock.to_message.assert_called_once_with(bytes([1, 2, 3, 4]))
 
-        router_instance.exchange.publish.assert_called_once()
-        message = router_instance.exchange.publish.call_args[0][0]
-        routing_key = router_instance.exchange.publish.call_args[0][1]
-        self.assertEqual(message.json(), expected_message)
-        self.assertEqual(routing_key, expected_routing_key)
+        router_instance.bus.publish.assert_called_once_with(expected_routing_key, b'{"foo": "bar"}',
+                                                            'application/json')
 
     @setup_test.async_test
     def test_it_should_handle_a_publish_packet_with_unknown_client_id(self):
@@ -182,8 +219,8 @@ class TestRouter(unittest.TestCase):
         payload = bytes([channel_id]) + bytes([1, 2, 3, 4])
 
         router_instance = router.Router()
-        router_instance.publish_channels = {
-            client_id: []
+        router_instance.routes.publish_channels = {
+            client_id: {}
         }
 
         with self.assertLogs(router.LOGGER) as log_messages:
@@ -196,36 +233,31 @@ class TestRouter(unittest.TestCase):
 
     def test_add_publish_channel_with_new_client_id(self):
         expected_publish_channels = {
-            1: [
-                {'routing_key': 'foo.routing.key', 'channel_id': 2, 'transform_id': 3}
-            ]
+            1: {
+                2: {'routing_key': 'foo.routing.key', 'channel_id': 2, 'transform_id': 3}
+            }
         }
 
         router_instance = router.Router()
         router_instance.transforms[3] = Mock()
         router_instance.add_publish_channel(1, 'foo.routing.key', 2, 3)
 
-        self.assertEqual(router_instance.publish_channels, expected_publish_channels)
+        self.assertEqual(router_instance.routes.publish_channels, expected_publish_channels)
 
     def test_add_publish_channel_with_existing_client_id(self):
-        publish_channels_before = {
-            1: [
-                {'routing_key': 'foo.routing.key', 'channel_id': 0, 'transform_id': 0}
-            ]
-        }
         expected_publish_channels = {
-            1: [
-                {'routing_key': 'foo.routing.key', 'channel_id': 0, 'transform_id': 0},
-                {'routing_key': 'bar.routing.key', 'channel_id': 2, 'transform_id': 3}
-            ]
+            1: {
+                0: {'routing_key': 'foo.routing.key', 'channel_id': 0, 'transform_id': 0},
+                2: {'routing_key': 'bar.routing.key', 'channel_id': 2, 'transform_id': 3}
+            }
         }
 
         router_instance = router.Router()
         router_instance.transforms[3] = Mock()
-        router_instance.publish_channels = publish_channels_before
+        router_instance.add_publish_channel(1, 'foo.routing.key', 0, 0)
         router_instance.add_publish_channel(1, 'bar.routing.key', 2, 3)
 
-        self.assertEqual(router_instance.publish_channels, expected_publish_channels)
+        self.assertEqual(router_instance.routes.publish_channels, expected_publish_channels)
 
     def test_add_publish_channel_with_unknown_transform_id(self):
         client_id = 99
@@ -244,67 +276,76 @@ class TestRouter(unittest.TestCase):
         )
 
     def test_clear_publish_channels(self):
-        publish_channels_before = {
-            1: [
-                {'routing_key': 'foo.routing.key', 'channel_id': 0, 'transform_id': 0},
-                {'routing_key': 'bar.routing.key', 'channel_id': 1, 'transform_id': 1}
-            ],
-            2: [
-                {'routing_key': 'baz.routing.key', 'channel_id': 1, 'transform_id': 1}
-            ]
-        }
-        expected_subscription_channels = {
-            2: [
-                {'routing_key': 'baz.routing.key', 'channel_id': 1, 'transform_id': 1}
-            ]
+        expected_publish_channels = {
+            2: {
+                1: {'routing_key': 'baz.routing.key', 'channel_id': 1, 'transform_id': 1}
+            }
         }
 
         router_instance = router.Router()
-        router_instance.publish_channels = publish_channels_before
+        router_instance.add_publish_channel(1, 'foo.routing.key', 0, 0)
+        router_instance.add_publish_channel(1, 'bar.routing.key', 1, 1)
+        router_instance.add_publish_channel(2, 'baz.routing.key', 1, 1)
         router_instance.clear_publish_channels(1)
 
-        self.assertEqual(router_instance.publish_channels, expected_subscription_channels)
+        self.assertEqual(router_instance.routes.publish_channels, expected_publish_channels)
 
     @setup_test.async_test
     def test_add_subscription_channel_with_new_routing_key(self):
-        expected_subscription_channels = {
-            'foo.routing.key': [
-                {'client_id': 1, 'channel_id': 2, 'transform_id': 3}
-            ]
-        }
+        expected_subscriptions = [
+            {'client_id': 1, 'channel_id': 2, 'transform_id': 3}
+        ]
 
         router_instance = router.Router()
         router_instance.transforms[3] = Mock()
-        router_instance.queue = Mock()
-        router_instance.exchange = Mock()
+        router_instance.bindings = Mock()
+        router_instance.bindings.acquire.return_value = create_future_with_result(None)
         yield from router_instance.add_subscription_channel(1, 'foo.routing.key', 2, 3)
 
-        self.assertEqual(router_instance.subscription_channels, expected_subscription_channels)
-        router_instance.queue.bind.assert_called_once_with(router_instance.exchange, 'foo.routing.key')
+        self.assertEqual(router_instance.routes.get_subscriptions('foo.routing.key'), expected_subscriptions)
+        router_instance.bindings.acquire.assert_called_once_with('foo.routing.key')
 
     @setup_test.async_test
     def test_add_subscription_channel_with_existing_routing_key(self):
-        subscription_channels_before = {
-            'foo.routing.key': [
-                {'client_id': 0, 'channel_id': 0, 'transform_id': 0}
-            ]
-        }
-        expected_subscription_channels = {
-            'foo.routing.key': [
-                {'client_id': 0, 'channel_id': 0, 'transform_id': 0},
-                {'client_id': 1, 'channel_id': 2, 'transform_id': 3}
-            ]
-        }
+        expected_subscriptions = [
+            {'client_id': 0, 'channel_id': 0, 'transform_id': 0},
+            {'client_id': 1, 'channel_id': 2, 'transform_id': 3}
+        ]
+
+        router_instance = router.Router()
+        router_instance.transforms[3] = Mock()
+        router_instance.bindings = Mock()
+        router_instance.bindings.acquire.return_value = create_future_with_result(None)
+        router_instance.routes.add_subscription(0, 'foo.routing.key', 0, 0)
+        yield from router_instance.add_subscription_channel(1, 'foo.routing.key', 2, 3)
+
+        self.assertEqual(router_instance.routes.get_subscriptions('foo.routing.key'), expected_subscriptions)
+        router_instance.bindings.acquire.assert_called_once_with('foo.routing.key')
 
+    @setup_test.async_test
+    def test_add_subscription_channel_is_rolled_back_when_binding_fails(self):
         router_instance = router.Router()
         router_instance.transforms[3] = Mock()
-        router_instance.queue = Mock()
-        router_instance.exchange = Mock()
-        router_instance.subscription_channels = subscription_channels_before
+        router_instance.bindings = Mock()
+        failed = Future()
+        failed.set_exception(ValueError('bind failed'))
+        router_instance.bindings.acquire.return_value = failed
+        router_instance.routes.add_subscription(0, 'foo.routing.key', 0, 0)
         yield from router_instance.add_subscription_channel(1, 'foo.routing.key', 2, 3)
 
-        self.assertEqual(router_instance.subscription_channels, expected_subscription_channels)
-        router_instance.queue.bind.assert_called_once_with(router_instance.exchange, 'foo.routing.key')
+        self.assertEqual(router_instance.routes.get_subscriptions('foo.routing.key'),
+                         [{'client_id': 0, 'channel_id': 0, 'transform_id': 0}])
+        router_instance.bindings.release.assert_called_once_with('foo.routing.key')
+
+    @setup_test.async_test
+    def test_add_subscription_channel_again_takes_no_new_reference(self):
+        router_instance = router.Router()
+        router_instance.transforms[3] = Mock()
+        router_instance.bindings = Mock()
+        router_instance.routes.add_subscription(1, 'foo.routing.key', 2, 0)
+        yield from router_instance.add_subscription_channel(1, 'foo.routing.key', 2, 3)
+
+        router_instance.bindings.acquire.assert_not_called()
 
     @setup_test.async_test
     def test_add_subscription_channel_with_unknown_transform_id(self):
@@ -324,27 +365,20 @@ class TestRouter(unittest.TestCase):
         )
 
     def test_clear_subscription_channels(self):
-        subscription_channels_before = {
-            'foo.routing.key': [
-                {'client_id': 0, 'channel_id': 0, 'transform_id': 0},
-                {'client_id': 1, 'channel_id': 1, 'transform_id': 1}
-            ],
-            'bar.routing.key': [
-                {'client_id': 1, 'channel_id': 1, 'transform_id': 1}
-            ]
-        }
-        expected_subscription_channels = {
-            'foo.routing.key': [
-                {'client_id': 0, 'channel_id': 0, 'transform_id': 0}
-            ],
-            'bar.routing.key': []
-        }
-
         router_instance = router.Router()
-        router_instance.subscription_channels = subscription_channels_before
+        router_instance.bindings = Mock()
+        router_instance.routes.add_subscription(0, 'foo.routing.key', 0, 0)
+        router_instance.routes.add_subscription(1, 'foo.routing.key', 1, 1)
+        router_instance.routes.add_subscription(1, 'bar.routing.key', 2, 1)
         router_instance.clear_subscription_channels(1)
 
-        self.assertEqual(router_instance.subscription_channels, expected_subscription_channels)
+        self.assertEqual(router_instance.routes.get_subscriptions('foo.routing.key'), [
+            {'client_id': 0, 'channel_id': 0, 'transform_id': 0}
+        ])
+        self.assertNotIn('bar.routing.key', router_instance.routes.subscription_channels)
+        self.assertEqual(router_instance.bindings.release.call_count, 2)
+        router_instance.bindings.release.assert_any_call('foo.routing.key')
+        router_instance.bindings.release.assert_any_call('bar.routing.key')
 
     def test_handle_message(self):
         transform_id_0 = random.randint(0, 255)
@@ -353,7 +387,8 @@ class TestRouter(unittest.TestCase):
         channel_id_1 = random.randint(0, 255)
         message = Mock()
         message.routing_key = 'some.routing.key'
-        message.json.return_value = 'JSON'
+        message.body = b'"JSON"'
+        message.content_type = 'application/json'
 
         router_instance = router.Router()
         router_instance.send_packet = Mock()
@@ -361,14 +396,162 @@ class TestRouter(unittest.TestCase):
         router_instance.transforms[transform_id_0].to_packet.return_value = bytes([1, 2, 3])
         router_instance.transforms[transform_id_1] = Mock()
         router_instance.transforms[transform_id_1].to_packet.return_value = bytes([4, 5, 6])
-        router_instance.subscription_channels['some.routing.key'] = [
-            {'client_id': 0, 'channel_id': channel_id_0, 'transform_id': transform_id_0},
-            {'client_id': 1, 'channel_id': channel_id_1, 'transform_id': transform_id_1}
-        ]
+        router_instance.routes.add_subscription(0, 'some.routing.key', channel_id_0, transform_id_0)
+        router_instance.routes.add_subscription(1, 'some.routing.key', channel_id_1, transform_id_1)
 
         router_instance.handle_message(message)
         router_instance.transforms[transform_id_0].to_packet.assert_called_once_with('JSON')
         router_instance.transforms[transform_id_1].to_packet.assert_called_once_with('JSON')
         self.assertEqual(router_instance.send_packet.call_count, 2)
-        router_instance.send_packet.assert_any_call(0, 4, bytes([channel_id_0, 1, 2, 3]))
-        router_instance.send_packet.assert_any_call(1, 4, bytes([channel_id_1, 4, 5, 6]))
+        router_instance.send_packet.assert_any_call(0, 4, bytes([channel_id_0, 1, 2, 3]),
+                                                    router_instance.transforms[transform_id_0].priority)
+        router_instance.send_packet.assert_any_call(1, 4, bytes([channel_id_1, 4, 5, 6]),
+                                                    router_instance.transforms[transform_id_1].priority)
+
+    def test_handle_message_for_wildcard_subscription(self):
+        message = Mock()
+        message.routing_key = 'livingroom.lamp.switch'
+        message.body = b'"JSON"'
+        message.content_type = 'application/json'
+
+        router_instance = router.Router()
+        router_instance.send_packet = Mock()
+        router_instance.transforms[7] = Mock()
+        router_instance.transforms[7].to_packet.return_value = bytes([1])
+        router_instance.routes.add_subscription(3, 'livingroom.*.switch', 2, 7)
+        router_instance.routes.add_subscription(4, 'house.#', 1, 7)
+
+        router_instance.handle_message(message)
+        router_instance.send_packet.assert_called_once_with(3, 4, bytes([2, 1]),
+                                                            router_instance.transforms[7].priority)
+
+    def test_accepting_packets(self):
+        router_instance = router.Router()
+        self.assertTrue(router_instance.accepting_packets())
+
+        router_instance.publisher = Mock()
+        router_instance.publisher.blocked = True
+        self.assertFalse(router_instance.accepting_packets())
+
+    def test_handle_message_encodes_once_per_transform(self):
+        message = Mock()
+        message.routing_key = 'house.alloff'
+        message.body = b'{"status": false}'
+        message.content_type = 'application/json'
+
+        router_instance = router.Router()
+        router_instance.send_packet = Mock()
+        router_instance.transforms[7] = Mock()
+        router_instance.transforms[7].to_packet.return_value = bytes([0])
+        router_instance.transforms[8] = Mock()
+        router_instance.transforms[8].to_packet.side_effect = KeyError('temperature')
+        for client_id in range(30):
+            router_instance.routes.add_subscription(client_id, 'house.alloff', client_id % 3, 7)
+        router_instance.routes.add_subscription(30, 'house.alloff', 0, 8)
+
+        with self.assertLogs(router.LOGGER) as log_messages:
+            router_instance.handle_message(message)
+
+        router_instance.transforms[7].to_packet.assert_called_once_with({'status': False})
+        self.assertEqual(router_instance.send_packet.call_count, 30)
+        router_instance.send_packet.assert_any_call(29, 4, bytes([2, 0]), router_instance.transforms[7].priority)
+        self.assertTrue(any(line.startswith('ERROR:router:Transform 8 failed') for line in log_messages.output))
+
+    @setup_test.async_test
+    def test_retained_message_is_sent_to_new_subscriptions(self):
+        message = Mock()
+        message.routing_key = 'livingroom.lamp.switch'
+        message.body = b'{"status": true}'
+        message.content_type = 'application/json'
+
+        router_instance = router.Router()
+        router_instance.bindings = Mock()
+        router_instance.bindings.acquire.side_effect = lambda routing_key: create_future_with_result(None)
+        router_instance.handle_message(message)
+        router_instance.set_send_packet(self.send_packet_stub)
+
+        yield from router_instance.add_subscription_channel(3, 'livingroom.lamp.switch', 2, 0)
+        yield from router_instance.add_subscription_channel(4, 'livingroom.*.switch', 1, 0)
+        yield from router_instance.add_subscription_channel(5, 'kitchen.lamp.switch', 1, 0)
+
+        self.assertEqual(self.send_packet_stub.call_count, 2)
+        self.send_packet_stub.assert_any_call(3, 4, bytes([2, 1]), Priority.HIGH)
+        self.send_packet_stub.assert_any_call(4, 4, bytes([1, 1]), Priority.HIGH)
+        self.assertEqual((router_instance.retained.stats.hits, router_instance.retained.stats.misses), (2, 1))
+
+    def test_messages_the_client_has_already_are_not_sent_again(self):
+        message = Mock()
+        message.routing_key = 'livingroom.lamp.switch'
+        message.content_type = 'application/json'
+        router_instance = router.Router()
+        router_instance.send_packet = Mock()
+        router_instance.routes.add_subscription(3, 'livingroom.lamp.switch', 2, 0)
+
+        for body in [b'{"status": true}', b'{"status": true}', b'{"status": false}']:
+            message.body = body
+            router_instance.handle_message(message)
+        self.assertEqual(router_instance.send_packet.call_count, 2)
+        self.assertEqual(router_instance.retained.stats.suppressed, 1)
+
+        router_instance.bindings = Mock()
+        router_instance.clear_subscription_channels(3)
+        router_instance.routes.add_subscription(3, 'livingroom.lamp.switch', 2, 0)
+        router_instance.handle_message(message)
+        self.assertEqual(router_instance.send_packet.call_count, 3)
+
+    @setup_test.async_test
+    def test_a_command_behind_a_queued_one_is_not_suppressed(self):
+        on_air = []
+        message = Mock()
+        message.routing_key = 'livingroom.lamp.switch'
+        message.content_type = 'application/json'
+        transmit = scheduler.TransmitScheduler(lambda packets: on_air.extend(packets) or [True] * len(packets))
+        transmit.start()
+        self.addCleanup(transmit.task.cancel)
+        router_instance = router.Router()
+        router_instance.set_send_packet(transmit.send_packet)
+        router_instance.routes.add_subscription(3, 'livingroom.lamp.switch', 2, 0)
+
+        message.body = b'{"status": true}'
+        router_instance.handle_message(message)
+        yield from asyncio.sleep(0.01)
+        for body in [b'{"status": false}', b'{"status": true}']:
+            message.body = body
+            router_instance.handle_message(message)
+        yield from asyncio.sleep(0.01)
+
+        self.assertEqual(len(on_air), 2)
+        self.assertEqual(on_air[1], on_air[0])
+        self.assertEqual(router_instance.retained.stats.suppressed, 0)
+
+    @unittest.skipUnless(timeseries.numpy, 'numpy is not installed')
+    @setup_test.async_test
+    def test_readings_are_kept_and_queries_answered(self):
+        router_instance = router.Router()
+        router_instance.publisher = Mock()
+        router_instance.publisher.publish.return_value = create_future_with_result(True)
+        router_instance.add_publish_channel(1, 'house.kitchen.temperature', 0, 1)
+
+        yield from router_instance.handle_pub_packet(1, bytes([0]) + struct.pack('<ff', 21.5, 40.0))
+
+        query = Mock()
+        query.routing_key = 'gateway.timeseries.query'
+        query.body = b'{"routing_key": "house.kitchen.temperature", "aggregate": true, "reply_to": "dashboard.1"}'
+        query.content_type = 'application/json'
+        router_instance.handle_message(query)
+
+        reply_to, answer = router_instance.publisher.enqueue.call_args[0]
+        self.assertEqual(reply_to, 'dashboard.1')
+        self.assertEqual(answer['aggregates']['temperature'], {'count': 1, 'min': 21.5, 'max': 21.5, 'mean': 21.5})
+
+    def test_queries_without_reply_to_are_ignored(self):
+        router_instance = router.Router()
+        router_instance.publisher = Mock()
+        query = Mock()
+        query.routing_key = 'gateway.timeseries.query'
+        query.body = b'{"routing_key": "house.kitchen.temperature"}'
+        query.content_type = 'application/json'
+
+        with self.assertLogs(router.LOGGER):
+            router_instance.handle_message(query)
+        router_instance.publisher.enqueue.assert_not_called()
@@ -0,0 +1,85 @@
+import setup_test
+
+setup_test.setup()
+
+import unittest
+import routing
+
+
+class TestRoutingTable(unittest.TestCase):
+    def test_publish_channels_are_indexed_by_channel_id(self):
+        table = routing.RoutingTable()
+
+        table.add_publish_channel(1, 'foo.key', 0, 1)
+        table.add_publish_channel(1, 'bar.key', 3, 0)
+        table.add_publish_channel(1, 'baz.key', 3, 1)
+
+        self.assertEqual(table.get_publish_channels(1), {
+            0: {'routing_key': 'foo.key', 'channel_id': 0, 'transform_id': 1},
+            3: {'routing_key': 'baz.key', 'channel_id': 3, 'transform_id': 1}
+        })
+        self.assertIsNone(table.get_publish_channels(2))
+
+        table.clear_publish_channels(1)
+        table.clear_publish_channels(2)
+        self.assertIsNone(table.get_publish_channels(1))
+
+    def test_add_subscription_reports_new_subscriptions(self):
+        table = routing.RoutingTable()
+
+        self.assertTrue(table.add_subscription(1, 'foo.key', 0, 1))
+        self.assertTrue(table.add_subscription(2, 'foo.key', 0, 0))
+        self.assertFalse(table.add_subscription(2, 'foo.key', 0, 1))
+        self.assertEqual(table.get_subscriptions('foo.key'), [
+            {'client_id': 1, 'channel_id': 0, 'transform_id': 1},
+            {'client_id': 2, 'channel_id': 0, 'transform_id': 1}
+        ])
+        self.assertEqual(table.get_subscriptions('bar.key'), [])
+
+    def test_clear_subscriptions_only_touches_the_client_and_drops_empty_keys(self):
+        table = routing.RoutingTable()
+        table.add_subscription(1, 'foo.key', 0, 1)
+        table.add_subscription(1, 'foo.key', 1, 0)
+        table.add_subscription(1, 'bar.key', 2, 1)
+        table.add_subscription(2, 'foo.key', 0, 1)
+
+        self.assertEqual(sorted(table.clear_subscriptions(1)), ['bar.key', 'foo.key', 'foo.key'])
+
+        self.assertEqual(table.subscription_channels, {
+            'foo.key': {(2, 0): {'client_id': 2, 'channel_id': 0, 'transform_id': 1}}
+        })
+        self.assertEqual(table.client_subscriptions, {2: {('foo.key', 0)}})
+        self.assertEqual(table.clear_subscriptions(1), [])
+        self.assertEqual(table.clear_subscriptions(2), ['foo.key'])
+        self.assertEqual(table.subscription_channels, {})
+
+    def test_remove_subscription(self):
+        table = routing.RoutingTable()
+        table.add_subscription(1, 'foo.key', 0, 1)
+        table.add_subscription(1, 'bar.key', 2, 1)
+
+        self.assertTrue(table.remove_subscription(1, 'foo.key', 0))
+        self.assertFalse(table.remove_subscription(1, 'foo.key', 0))
+        self.assertEqual(table.get_subscriptions('foo.key'), [])
+        self.assertEqual(table.client_subscriptions, {1: {('bar.key', 2)}})
+        self.assertTrue(table.remove_subscription(1, 'bar.key', 2))
+        self.assertEqual((table.subscription_channels, table.client_subscriptions), ({}, {}))
+
+    def test_get_subscriptions_matches_topic_patterns(self):
+        table = routing.RoutingTable()
+        table.add_subscription(1, 'livingroom.*.switch', 0, 0)
+        table.add_subscription(2, 'house.#', 0, 0)
+        table.add_subscription(1, 'livingroom.lamp.switch', 0, 0)
+        table.add_subscription(3, 'kitchen.lamp.switch', 0, 0)
+
+        self.assertEqual(table.get_subscriptions('livingroom.lamp.switch'), [
+            {'client_id': 1, 'channel_id': 0, 'transform_id': 0}
+        ])
+        self.assertEqual(table.get_subscriptions('house.kitchen.temperature'), [
+            {'client_id': 2, 'channel_id': 0, 'transform_id': 0}
+        ])
+        self.assertEqual(table.get_subscriptions('garden.lamp.switch'), [])
+
+        table.clear_subscriptions(1)
+        self.assertNotIn('livingroom.*.switch', table.topics)
+        self.assertEqual(table.get_subscriptions('livingroom.lamp.switch'), [])
@@ -0,0 +1,137 @@
+import setup_test
+
+setup_test.setup()
+
+import unittest
+import asyncio
+import scheduler
+from constants import PacketTypes, Priority
+from unittest.mock import MagicMock as Mock
+
+
+class TestTransmitScheduler(unittest.TestCase):
+    def setUp(self):
+        self.send_packets = Mock(side_effect=lambda packets: [True] * len(packets))
+        self.scheduler = scheduler.TransmitScheduler(self.send_packets, 1.0, 1.0, 4)
+
+    def sent(self):
+        return [call[0][0] for call in self.send_packets.call_args_list]
+
+    def test_send_packet_queues_the_packet(self):
+        future = self.scheduler.send_packet(1, PacketTypes.PUB, bytes([0, 1]))
+
+        self.assertIsInstance(future, asyncio.Future)
+        self.assertEqual(self.scheduler.stats.queued, 1)
+        self.assertEqual(self.scheduler.stats.max_depth, 1)
+        self.assertFalse(self.send_packets.called)
+
+    def test_high_priority_packets_go_first(self):
+        self.scheduler.send_packet(1, PacketTypes.PUB, bytes([0, 1]))
+        self.scheduler.send_packet(2, PacketTypes.PUB, bytes([0, 1]), Priority.HIGH)
+        self.scheduler.send_packet(3, PacketTypes.REGISTER_SERVER_ACK, bytes([3]), Priority.HIGH)
+
+        order = [self.scheduler.next_packet().client_id for dummy in range(3)]
+
+        self.assertEqual(order, [2, 3, 1])
+        self.assertIsNone(self.scheduler.next_packet())
+        self.assertEqual(self.scheduler.stats.queued, 0)
+
+    def test_clients_are_served_round_robin(self):
+        for channel_id in range(3):
+            self.scheduler.send_packet(1, PacketTypes.PUB, bytes([channel_id, 1]))
+        self.scheduler.send_packet(2, PacketTypes.PUB, bytes([0, 1]))
+
+        order = [self.scheduler.next_packet().client_id for dummy in range(4)]
+
+        self.assertEqual(order, [1, 2, 1, 1])
+
+    def test_newer_pub_replaces_queued_pub_for_the_same_channel(self):
+        first = self.scheduler.send_packet(1, PacketTypes.PUB, bytes([5, 0]))
+        second = self.scheduler.send_packet(1, PacketTypes.PUB, bytes([5, 1]))
+        other_channel = self.scheduler.send_packet(1, PacketTypes.PUB, bytes([6, 1]))
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, other_channel)
+        self.assertEqual(self.scheduler.stats.conflated, 1)
+        self.assertEqual(self.scheduler.stats.queued, 2)
+        self.assertEqual(self.scheduler.next_packet().payload, bytes([5, 1]))
+
+    def test_sent_pubs_are_not_replaced(self):
+        self.scheduler.send_packet(1, PacketTypes.PUB, bytes([5, 0]))
+        self.scheduler.next_packet()
+
+        self.scheduler.send_packet(1, PacketTypes.PUB, bytes([5, 1]))
+
+        self.assertEqual(self.scheduler.stats.conflated, 0)
+        self.assertEqual(self.scheduler.stats.queued, 1)
+
+    def test_airtime_delay(self):
+        self.scheduler.bucket.airtime = 0
+        self.scheduler.bucket.refilled_at = self.scheduler.loop.time()
+
+        delay = self.scheduler.airtime_delay()
+
+        self.assertGreater(delay, 0)
+        self.assertLessEqual(delay, scheduler.ATTEMPT_AIRTIME)
+
+        self.scheduler.bucket.airtime = 1.0
+        self.assertEqual(self.scheduler.airtime_delay(), 0)
+
+    def test_next_batch_is_limited_by_batch_size(self):
+        for client_id in range(6):
+            self.scheduler.send_packet(client_id, PacketTypes.PUB, bytes([0, 1]))
+
+        self.assertEqual(len(self.scheduler.next_batch()), 4)
+        self.assertEqual(len(self.scheduler.next_batch()), 2)
+        self.assertEqual(self.scheduler.next_batch(), [])
+
+    def test_next_batch_is_limited_by_airtime(self):
+        for client_id in range(6):
+            self.scheduler.send_packet(client_id, PacketTypes.PUB, bytes([0, 1]))
+
+        self.scheduler.bucket.airtime = scheduler.ATTEMPT_AIRTIME * 2.5
+        self.assertEqual(len(self.scheduler.next_batch()), 2)
+        self.scheduler.bucket.airtime = 0
+        self.assertEqual(len(self.scheduler.next_batch()), 1)
+
+    @setup_test.async_test
+    def test_run_sends_queued_packets(self):
+        self.scheduler.start()
+        first = self.scheduler.send_packet(1, PacketTypes.PUB, bytes([0, 1]))
+        second = self.scheduler.send_packet(2, PacketTypes.REGISTER_SERVER_ACK, bytes([3]), Priority.HIGH)
+
+        results = yield from asyncio.wait_for(asyncio.gather(first, second), 1)
+        self.scheduler.task.cancel()
+
+        self.assertEqual(results, [True, True])
+        self.assertEqual(self.sent(), [[(2, PacketTypes.REGISTER_SERVER_ACK, bytes([3])),
+                                        (1, PacketTypes.PUB, bytes([0, 1]))]])
+        self.assertEqual(self.scheduler.stats.sent, 2)
+        self.assertLess(self.scheduler.bucket.airtime, 1.0)
+
+    @setup_test.async_test
+    def test_transmit_waits_for_future_results(self):
+        result = asyncio.Future()
+        result.set_result([False, True])
+        self.send_packets.side_effect = None
+        self.send_packets.return_value = result
+
+        first = self.scheduler.send_packet(1, PacketTypes.PUB, bytes([0, 1]))
+        second = self.scheduler.send_packet(2, PacketTypes.PUB, bytes([0, 1]))
+        yield from self.scheduler.transmit(self.scheduler.next_batch())
+
+        self.assertEqual(first.result(), False)
+        self.assertEqual(second.result(), True)
+        self.assertEqual(self.scheduler.stats.failed, 1)
+        self.assertEqual(self.scheduler.stats.sent, 1)
+
+    @setup_test.async_test
+    def test_transmit_with_failing_send(self):
+        self.send_packets.side_effect = IOError('spi')
+
+        future = self.scheduler.send_packet(1, PacketTypes.PUB, bytes([0, 1]))
+        with self.assertLogs(scheduler.LOGGER):
+            yield from self.scheduler.transmit(self.scheduler.next_batch())
+
+        self.assertEqual(future.result(), False)
+        self.assertEqual(self.scheduler.stats.failed, 1)
@@ -0,0 +1,79 @@
+import setup_test
+
+setup_test.setup()
+
+import json
+import os
+import tempfile
+import unittest
+import schemas
+from constants import Priority
+from struct import pack
+
+LIGHT_SCHEMA = {
+    'id': 2,
+    'name': 'light',
+    'priority': 'high',
+    'byte_order': 'big',
+    'fields': [
+        {'name': 'lux', 'type': 'uint16', 'scale': 0.5},
+        {'name': 'temperature', 'type': 'int16', 'scale': 0.1, 'offset': -40},
+        {'name': 'on', 'type': 'bool'}
+    ]
+}
+
+
+class TestSchemaTransform(unittest.TestCase):
+    def setUp(self):
+        self.transform = schemas.SchemaTransform(LIGHT_SCHEMA)
+
+    def test_compiles_to_a_struct(self):
+        self.assertEqual(self.transform.struct.size, 5)
+        self.assertEqual(self.transform.priority, Priority.HIGH)
+        self.assertIs(self.transform.struct, schemas.SchemaTransform(LIGHT_SCHEMA).struct)
+
+    def test_to_message(self):
+        message = self.transform.to_message(pack('>Hh?', 301, 615, True) + bytes([9, 9]))
+
+        self.assertEqual(message['lux'], 150.5)
+        self.assertAlmostEqual(message['temperature'], 21.5)
+        self.assertIs(message['on'], True)
+
+    def test_to_packet(self):
+        payload = self.transform.to_packet({'lux': 150.5, 'temperature': 21.5, 'on': False})
+
+        self.assertEqual(payload, pack('>Hh?', 301, 615, False))
+
+    def test_unknown_types_and_byte_orders(self):
+        with self.assertRaises(ValueError):
+            schemas.SchemaTransform({'fields': [{'name': 'a', 'type': 'int128'}]})
+        with self.assertRaises(ValueError):
+            schemas.SchemaTransform({'byte_order': 'middle', 'fields': [{'name': 'a', 'type': 'int8'}]})
+
+    @unittest.skipUnless(schemas.numpy, 'numpy is not installed')
+    def test_to_messages(self):
+        payloads = [pack('>Hh?', 301, 615, True), pack('>Hh?', 2, 400, False) + bytes([1])]
+
+        columns = self.transform.to_messages(payloads)
+
+        self.assertEqual(list(columns['lux']), [150.5, 1.0])
+        self.assertEqual([round(value, 3) for value in columns['temperature']], [21.5, 0.0])
+        self.assertEqual(list(columns['on']), [True, False])
+        with self.assertRaises(ValueError):
+            self.transform.to_messages([bytes([1])])
+
+
+class TestLoadSchemas(unittest.TestCase):
+    def test_load_schemas(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as schema_file:
+            json.dump([LIGHT_SCHEMA], schema_file)
+        try:
+            transforms = schemas.load_schemas(schema_file.name)
+        finally:
+            os.remove(schema_file.name)
+
+        self.assertEqual(list(transforms), [2])
+        self.assertEqual(transforms[2].name, 'light')
+
+    def test_without_schema_file(self):
+        self.assertEqual(schemas.load_schemas(None), {})
@@ -0,0 +1,71 @@
+import setup_test
+
+setup_test.setup()
+
+import json
+import unittest
+import serialization
+from unittest.mock import patch
+
+
+class TestJsonCodec(unittest.TestCase):
+    def test_encode_matches_json_dumps(self):
+        codec = serialization.JsonCodec()
+        for obj in [
+                {'temperature': 21.5, 'humidity': 40.25},
+                {'status': True, 'count': 3, 'name': 'küche "1"', 'nothing': None},
+                {'value': float('nan')},
+                {'nested': {'a': [1, 2]}},
+                {1: 'on', 2.5: 'off', None: 0.5},
+                {False: 1},
+                [1, 2, 3]
+        ]:
+            self.assertEqual(codec.encode(obj), json.dumps(obj).encode())
+
+    def test_key_layouts_are_cached(self):
+        codec = serialization.JsonCodec()
+        codec.encode({'temperature': 1.0, 'humidity': 2.0})
+        codec.encode({'temperature': 3.0, 'humidity': 4.0})
+
+        self.assertEqual(list(codec.layouts), [('temperature', 'humidity')])
+
+    def test_decode(self):
+        self.assertEqual(serialization.JsonCodec.decode(b'{"status": false}'), {'status': False})
+
+
+class TestDecode(unittest.TestCase):
+    def test_decode_by_content_type(self):
+        self.assertEqual(serialization.decode(b'{"status": true}', 'application/json'), {'status': True})
+        self.assertEqual(serialization.decode(b'{"status": true}', None), {'status': True})
+
+    def test_unknown_content_types_are_decoded_as_json(self):
+        with self.assertLogs(serialization.LOGGER):
+            self.assertEqual(serialization.decode(b'[1]', 'text/unknown'), [1])
+
+    @unittest.skipUnless(serialization.msgpack, 'msgpack is not installed')
+    def test_msgpack(self):
+        obj = {'temperature': 21.5, 'status': True}
+        body = serialization.CODECS[serialization.MSGPACK].encode(obj)
+
+        self.assertEqual(serialization.decode(body, serialization.MSGPACK), obj)
+        self.assertEqual(serialization.decode(body, 'application/x-msgpack'), obj)
+
+
+class TestMessageEncoder(unittest.TestCase):
+    @patch.dict(serialization.CODECS, {'application/test': serialization.JsonCodec()})
+    def test_content_type_per_routing_key(self):
+        serialization.CODECS['application/test'].content_type = 'application/test'
+        encoder = serialization.MessageEncoder({
+            'sensors.#': 'application/test',
+            'sensors.kitchen.*': serialization.JSON,
+        })
+
+        self.assertEqual(encoder.encode('sensors.garden.temperature', {'a': 1}), (b'{"a": 1}', 'application/test'))
+        self.assertEqual(encoder.encode('sensors.kitchen.temperature', {'a': 1}), (b'{"a": 1}', serialization.JSON))
+        self.assertEqual(encoder.encode('switches.kitchen', {'a': 1}), (b'{"a": 1}', serialization.JSON))
+
+    def test_unavailable_content_types_fall_back_to_json(self):
+        with self.assertLogs(serialization.LOGGER):
+            encoder = serialization.MessageEncoder({'sensors.#': 'application/unavailable'})
+
+        self.assertEqual(encoder.encode('sensors.temperature', {'a': 1}), (b'{"a": 1}', serialization.JSON))
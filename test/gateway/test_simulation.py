@@ -0,0 +1,140 @@
+import setup_test
+
+setup_test.setup()
+
+import unittest
+import random
+import radio
+import simulation
+from constants import PacketTypes
+from crypto import xor_checksum
+from struct import pack
+from unittest.mock import patch
+
+SERVER_ADDRESS = [0xf0, 0xf0, 0xf0, 0xf0, 0xe1]
+CLIENT_ADDRESS = [0xc0, 0x00, 0x00, 0x00, 0x01]
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestVirtualMedium(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.medium = simulation.VirtualMedium(0.0, 0.01, 2, random.Random(1), self.clock)
+        self.endpoint = simulation.Endpoint()
+        self.medium.attach(CLIENT_ADDRESS, self.endpoint)
+
+    def test_packets_arrive_after_the_latency(self):
+        self.assertEqual(self.medium.transmit(CLIENT_ADDRESS, bytes([1]), 1), (True, None))
+
+        self.endpoint.settle(self.clock.now)
+        self.assertEqual(len(self.endpoint.fifo), 0)
+        self.clock.now = 0.01
+        self.endpoint.settle(self.clock.now)
+        self.assertEqual(list(self.endpoint.fifo), [bytes([1])])
+
+    def test_full_fifo_is_not_acknowledged(self):
+        self.medium.transmit(CLIENT_ADDRESS, bytes([1]), 1)
+        self.medium.transmit(CLIENT_ADDRESS, bytes([2]), 1)
+
+        self.assertEqual(self.medium.transmit(CLIENT_ADDRESS, bytes([3]), 5), (False, None))
+        self.assertEqual(self.medium.stats.overflowed, 5)
+        self.assertEqual(self.medium.stats.delivered, 2)
+
+    def test_ack_payload_is_sent_once(self):
+        self.endpoint.ack_payload = bytes([7])
+
+        self.assertEqual(self.medium.transmit(CLIENT_ADDRESS, bytes([1]), 1), (True, bytes([7])))
+        self.assertEqual(self.medium.transmit(CLIENT_ADDRESS, bytes([2]), 1), (True, None))
+
+    def test_nothing_is_received_while_not_listening(self):
+        self.endpoint.listening = False
+
+        self.assertEqual(self.medium.transmit(CLIENT_ADDRESS, bytes([1]), 3), (False, None))
+        self.assertEqual(self.medium.transmit(SERVER_ADDRESS, bytes([1]), 3), (False, None))
+        self.assertEqual(self.medium.stats.attempts, 6)
+
+    def test_lost_packets(self):
+        medium = simulation.VirtualMedium(1.0, 0, 3, random.Random(1), self.clock)
+        medium.attach(CLIENT_ADDRESS, self.endpoint)
+
+        self.assertEqual(medium.transmit(CLIENT_ADDRESS, bytes([1]), 3), (False, None))
+        self.assertEqual(medium.stats.lost, 3)
+
+
+class TestVirtualClient(unittest.TestCase):
+    @patch.multiple(radio, SERVER_ADDRESS=SERVER_ADDRESS)
+    @patch.multiple(simulation, SERVER_ADDRESS=SERVER_ADDRESS)
+    def test_protocol_round_trip_with_the_radio(self):
+        medium = simulation.VirtualMedium(rng=random.Random(1))
+        radio_instance = radio.Radio(simulation.SimulatedNRF24(medium))
+        client = simulation.VirtualClient(medium, CLIENT_ADDRESS, rng=random.Random(2))
+        received = []
+
+        self.assertTrue(client.start_registration())
+        packets, dummy_read = radio_instance.get_packets()
+        client_id, message_id, dummy = packets[0]
+        self.assertEqual(message_id, PacketTypes.REGISTER)
+        self.assertEqual(radio_instance.clients.get(client_id).address, CLIENT_ADDRESS)
+
+        radio_instance.send_packet(client_id, PacketTypes.REGISTER_SERVER_ACK,
+                                   pack('B7sB', client_id, bytes(radio.SERVER_ID), radio_instance.server_id_checksum))
+        client.poll()
+        self.assertTrue(client.session.registered)
+        self.assertEqual(client.session.client_id, client_id)
+
+        self.assertEqual(client.subscribe_channel('some.key', 0, received.append), 0)
+        self.assertTrue(client.publish(3, bytes([1, 2])))
+        packets, dummy_read = radio_instance.get_packets()
+        self.assertEqual(packets, [
+            (client_id, PacketTypes.SUB_CHANNEL, bytes([0, 0]) + b'some.key'),
+            (client_id, PacketTypes.PUB, bytes([3, 1, 2])),
+        ])
+
+        radio_instance.send_packet(client_id, PacketTypes.PUB, bytes([0, 1]))
+        client.poll()
+        self.assertEqual(received, [bytes([1])])
+
+    def test_new_server_id_in_ack_payload_unregisters(self):
+        medium = simulation.VirtualMedium(rng=random.Random(1))
+        client = simulation.VirtualClient(medium, CLIENT_ADDRESS)
+        client.session.registered = True
+        client.session.server_id = bytes([1, 2, 3, 4, 5, 6, 7])
+
+        new_server_id = bytes([1, 2, 3, 4, 5, 6, 8])
+
+        client.check_server_id(client.session.server_id + bytes([xor_checksum(client.session.server_id)]))
+        self.assertTrue(client.session.registered)
+        client.check_server_id(new_server_id + bytes([xor_checksum(new_server_id) ^ 1]))
+        self.assertTrue(client.session.registered)
+        client.check_server_id(new_server_id + bytes([xor_checksum(new_server_id)]))
+        self.assertFalse(client.session.registered)
+
+
+class TestRunSimulation(unittest.TestCase):
+    def test_run_simulation_reports_throughput_drops_and_latency(self):
+        options = simulation.parse_args(['--clients', '3', '--rate', '20', '--duration', '0.3', '--seed', '1'])
+        report = simulation.run_simulation(options)
+
+        self.assertEqual(report['registrations'], 3)
+        self.assertGreater(report['received'], 0)
+        self.assertEqual(report['dropped'], report['published'] - report['received'])
+        self.assertGreaterEqual(report['latency_max_ms'], report['latency_p50_ms'])
+        self.assertIn('medium_overflowed', report)
+        self.assertIn('rx_fifo_overflows', report)
+
+    def test_run_simulation_spreads_clients_over_the_radios(self):
+        options = simulation.parse_args(['--clients', '4', '--rate', '20', '--duration', '0.3', '--seed', '1',
+                                         '--radios', '2'])
+        report = simulation.run_simulation(options)
+
+        self.assertEqual(report['registrations'], 4)
+        self.assertEqual(report['radio_clients'], [2, 2])
+        self.assertGreater(report['received'], 0)
+        self.assertEqual(len(report['radio_utilization']), 2)
@@ -0,0 +1,143 @@
+import setup_test
+
+setup_test.setup()
+
+import asyncio
+import tempfile
+import unittest
+import timeseries
+from unittest.mock import MagicMock as Mock, patch
+
+
+@unittest.skipUnless(timeseries.numpy, 'numpy is not installed')
+class TestTimeSeries(unittest.TestCase):
+    def setUp(self):
+        self.series = timeseries.TimeSeries(['humidity', 'temperature'], {0: 4, 60: 3, 3600: 2})
+
+    def test_raw_readings_wrap_around(self):
+        for minute in range(6):
+            self.series.add(1000.0 + minute, {'temperature': minute, 'humidity': 50})
+
+        result = self.series.range(0, 2000, resolution=0)
+        self.assertEqual(result['time'], [1002.0, 1003.0, 1004.0, 1005.0])
+        self.assertEqual(result['values']['temperature'], [2, 3, 4, 5])
+        self.assertEqual(result['values']['humidity'], [50, 50, 50, 50])
+
+    def test_readings_are_downsampled(self):
+        for second in range(0, 150, 30):
+            self.series.add(3600.0 + second, {'temperature': second, 'humidity': None})
+
+        result = self.series.range(3600, 3780, resolution=60)
+        self.assertEqual(result['time'], [3600.0, 3660.0, 3720.0])
+        self.assertEqual(result['values']['temperature'], [15.0, 75.0, 120.0])
+        self.assertEqual(result['values']['humidity'], [None, None, None])
+
+    def test_aggregate(self):
+        for second, temperature in enumerate([21.0, 23.0, 19.0]):
+            self.series.add(7200.0 + second, {'temperature': temperature, 'humidity': 40})
+
+        for resolution in (0, 3600):
+            aggregates = self.series.aggregate(7200, 7300, resolution)['aggregates']
+            self.assertEqual(aggregates['temperature'], {'count': 3, 'min': 19.0, 'max': 23.0, 'mean': 21.0})
+        self.assertEqual(self.series.aggregate(0, 100, 0)['aggregates']['humidity'], {
+            'count': 0, 'min': None, 'max': None, 'mean': None
+        })
+
+    def test_the_finest_resolution_with_all_readings_is_chosen(self):
+        for second in range(0, 600, 60):
+            self.series.add(3600.0 + second, {'temperature': 20})
+
+        self.assertEqual(self.series.range(4140, 4200)['resolution'], 0)
+        self.assertEqual(self.series.range(3900, 4200)['resolution'], 3600)
+
+    def test_time_does_not_go_back(self):
+        self.series.add(100.0, {'temperature': 1})
+        self.series.add(50.0, {'temperature': 2})
+
+        self.assertEqual(self.series.range(0, 200, resolution=0)['time'], [100.0, 100.0])
+
+    @patch.multiple(timeseries, FOLD_SIZE=3)
+    def test_readings_are_written_to_the_rings_in_batches(self):
+        for second in range(2):
+            self.series.add(1000.0 + second, {'temperature': second})
+        self.assertEqual([ring.size for ring in self.series.rings.values()], [0, 0, 0])
+
+        self.series.add(1002.0, {'temperature': 2})
+        self.assertEqual([ring.size for ring in self.series.rings.values()], [3, 1, 1])
+        self.assertEqual(self.series.pending, [])
+
+    def test_buckets_continue_across_batches(self):
+        for second in range(0, 50, 10):
+            self.series.add(3600.0 + second, {'temperature': second})
+            self.series.range(0, 4000)
+
+        aggregates = self.series.aggregate(3600, 3660, 60)['aggregates']
+        self.assertEqual(aggregates['temperature'], {'count': 5, 'min': 0.0, 'max': 40.0, 'mean': 20.0})
+        self.assertEqual(self.series.range(3600, 3660, 0)['time'], [3610.0, 3620.0, 3630.0, 3640.0])
+
+
+@unittest.skipUnless(timeseries.numpy, 'numpy is not installed')
+class TestTimeSeriesStore(unittest.TestCase):
+    def test_query(self):
+        store = timeseries.TimeSeriesStore(capacities={0: 10, 60: 10}, max_series=1)
+        store.add('house.kitchen.temperature', {'temperature': 21.5, 'name': 'kitchen'}, timestamp=1000.0)
+        store.add('house.hall.temperature', {'temperature': 19.0}, timestamp=1000.0)
+        store.add('house.kitchen.switch', 'on')
+
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.query({'routing_key': 'house.kitchen.temperature', 'start': 900, 'end': 1100}), {
+            'resolution': 0,
+            'time': [1000.0],
+            'values': {'temperature': [21.5]}
+        })
+        self.assertEqual(
+            store.query({'routing_key': 'house.kitchen.temperature', 'start': 900, 'end': 1100, 'aggregate': True,
+                         'resolution': 60}),
+            {'resolution': 60, 'aggregates': {'temperature': {'count': 1, 'min': 21.5, 'max': 21.5, 'mean': 21.5}}}
+        )
+        self.assertIn('error', store.query({'routing_key': 'house.hall.temperature'}))
+        self.assertIn('error', store.query({'routing_key': 'house.kitchen.temperature', 'resolution': 5}))
+
+    def test_malformed_queries_are_answered_with_an_error(self):
+        store = timeseries.TimeSeriesStore(capacities={0: 10})
+        store.add('house.kitchen.temperature', {'temperature': 21.5}, timestamp=1000.0)
+
+        self.assertIn('error', store.query({'routing_key': 'house.kitchen.temperature', 'start': 'abc'}))
+        self.assertIn('error', store.query({'routing_key': 'house.kitchen.temperature', 'end': [1]}))
+        self.assertIn('error', store.query({'routing_key': ['house.kitchen.temperature']}))
+        self.assertIn('error', store.query({'routing_key': 'house.kitchen.temperature', 'resolution': [0]}))
+
+    def test_time_series_survive_a_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = timeseries.TimeSeriesStore(directory, capacities={0: 3, 60: 3})
+            for second in range(5):
+                store.add('house/kitchen.temperature', {'temperature': second}, timestamp=60.0 + second)
+            store.flush()
+            del store
+
+            reopened = timeseries.TimeSeriesStore(directory, capacities={0: 3, 60: 3})
+            reopened.add('house/kitchen.temperature', {'temperature': 5}, timestamp=66.0)
+            result = reopened.query({'routing_key': 'house/kitchen.temperature', 'start': 0, 'end': 100,
+                                     'resolution': 0})
+            self.assertEqual(result['values']['temperature'], [3, 4, 5])
+            aggregate = reopened.query({'routing_key': 'house/kitchen.temperature', 'start': 0, 'end': 100,
+                                        'resolution': 60, 'aggregate': True})
+            self.assertEqual(aggregate['aggregates']['temperature']['count'], 6)
+
+
+class TestFlushPeriodically(unittest.TestCase):
+    @setup_test.async_test
+    def test_the_store_is_flushed_every_interval(self):
+        store = Mock()
+        task = asyncio.async(timeseries.flush_periodically(store, interval=0.01))
+        yield from asyncio.sleep(0.05)
+        task.cancel()
+
+        self.assertGreaterEqual(store.flush.call_count, 2)
+
+
+class TestCreateTimeSeries(unittest.TestCase):
+    @patch.multiple(timeseries, numpy=None)
+    def test_no_time_series_without_numpy(self):
+        with self.assertLogs(timeseries.LOGGER):
+            self.assertIsNone(timeseries.create_timeseries())
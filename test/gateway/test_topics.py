@@ -0,0 +1,56 @@
+import setup_test
+
+setup_test.setup()
+
+import unittest
+import topics
+
+
+class TestTopicTrie(unittest.TestCase):
+    def setUp(self):
+        self.trie = topics.TopicTrie()
+        for pattern in ['a.b.c', 'a.*.c', 'a.#', '#', 'a.#.c', '*.b', 'x.*.*']:
+            self.trie.add(pattern)
+
+    def test_match(self):
+        self.assertEqual(self.trie.match('a.b.c'), ('#', 'a.#', 'a.#.c', 'a.*.c', 'a.b.c'))
+        self.assertEqual(self.trie.match('a'), ('#', 'a.#'))
+        self.assertEqual(self.trie.match('a.c'), ('#', 'a.#', 'a.#.c'))
+        self.assertEqual(self.trie.match('a.x.y.c'), ('#', 'a.#', 'a.#.c'))
+        self.assertEqual(self.trie.match('z.b'), ('#', '*.b'))
+        self.assertEqual(self.trie.match('x.y'), ('#',))
+        self.assertEqual(self.trie.match('x.y.z'), ('#', 'x.*.*'))
+
+    def test_exact_keys_without_wildcards(self):
+        trie = topics.TopicTrie()
+        trie.add('test:routing:key')
+
+        self.assertEqual(trie.match('test:routing:key'), ('test:routing:key',))
+        self.assertEqual(trie.match('test:routing'), ())
+
+    def test_results_are_memoized_until_patterns_change(self):
+        self.assertEqual(self.trie.match('z.b'), ('#', '*.b'))
+        self.assertEqual(self.trie.match('z.b'), ('#', '*.b'))
+        self.assertEqual((self.trie.hits, self.trie.misses), (1, 1))
+
+        self.trie.add('z.b')
+        self.assertEqual(self.trie.match('z.b'), ('#', '*.b', 'z.b'))
+        self.assertEqual(self.trie.misses, 2)
+
+    def test_cache_is_bounded(self):
+        trie = topics.TopicTrie(cache_size=2)
+        trie.add('#')
+        for key in ['a', 'b', 'c']:
+            trie.match(key)
+
+        self.assertEqual(len(trie.cache), 1)
+
+    def test_remove_prunes_nodes(self):
+        self.trie.remove('a.#.c')
+        self.trie.remove('x.*.*')
+        self.trie.remove('unknown')
+
+        self.assertEqual(self.trie.match('a.x.y.c'), ('#', 'a.#'))
+        self.assertNotIn('x', self.trie.root.children)
+        self.assertNotIn('a.#.c', self.trie)
+        self.assertEqual(len(self.trie), 5)
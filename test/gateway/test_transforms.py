@@ -4,9 +4,13 @@ setup_test.setup()
 
 import unittest
 import transforms
+from constants import Priority
 
 
 class TestSwitchTransform(unittest.TestCase):
+    def test_priority(self):
+        self.assertEqual(transforms.SwitchTransform.priority, Priority.HIGH)
+
     def test_to_message_with_true(self):
         result = transforms.SwitchTransform.to_message(bytes([1]))
         expected = {'status': True}
@@ -29,6 +33,9 @@ class TestSwitchTransform(unittest.TestCase):
 
 
 class TestTemperatureTransform(unittest.TestCase):
+    def test_priority(self):
+        self.assertEqual(transforms.TemperatureTransform.priority, Priority.NORMAL)
+
     def test_to_message(self):
         result = transforms.TemperatureTransform.to_message(bytes([0, 0, 188, 65, 0, 0, 113, 66]))
         expected = {'temperature': 23.5, 'humidity': 60.25}